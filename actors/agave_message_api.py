@@ -4,7 +4,7 @@ from flask_cors import CORS
 from agaveflask.utils import AgaveApi, handle_error
 
 from auth import authn_and_authz
-from controllers import MessagesResource
+from controllers import MessagesResource, MessagesBatchResource
 
 app = Flask(__name__)
 CORS(app)
@@ -25,6 +25,7 @@ def handle_all_errors(e):
 
 # Resources
 api.add_resource(MessagesResource, '/agave/<string:actor_id>/messages')
+api.add_resource(MessagesBatchResource, '/agave/<string:actor_id>/messages/batch')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', debug=True)
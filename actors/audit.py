@@ -0,0 +1,69 @@
+# Audits the derived indexes in the abaco stores against the records they are derived from and repairs any drift.
+# Currently audits the per-user index of actors (user_actors_store), which is derived from the permissions_store.
+#
+# Execute from a container as follows (pass --dry-run to only report drift):
+# docker run -it --rm -v $(pwd)/abaco.conf:/etc/service.conf abaco/core python3 -u /actors/audit.py
+
+import sys
+import time
+
+from models import get_permissions, get_user_actors_key, index_user_permissions
+from stores import actors_store, permissions_store, user_actors_store
+
+from agaveflask.logs import get_logger
+logger = get_logger(__name__)
+
+
+def audit_user_actors(fix=True):
+    """
+    Compare the per-user index of actors with the permissions_store. Entries that are missing or differ from the
+    permissions are rewritten and entries for users or actors without permissions are removed, unless `fix` is False.
+    Returns a dictionary with the number of missing (or out of date), stale and orphaned entries found.
+    """
+    logger.info("Top of audit_user_actors(). fix: {}".format(fix))
+    result = {'missing': 0, 'stale': 0, 'orphaned': 0}
+    audited = set()
+    for actor_id in permissions_store:
+        try:
+            tenant = actors_store[actor_id]['tenant']
+        except KeyError:
+            # permissions for a deleted actor; any index entries for it are reported as orphaned below.
+            logger.info("Found permissions for actor {} which is not in the actors_store.".format(actor_id))
+            continue
+        audited.add(actor_id)
+        permissions = get_permissions(actor_id)
+        existing = dict(user_actors_store.find(actor_id=actor_id))
+        for user in set(pem['user'] for pem in permissions):
+            key = get_user_actors_key(user, actor_id)
+            expected = {'actor_id': actor_id, 'permissions': [pem for pem in permissions if pem['user'] == user]}
+            if existing.pop(key, None) != expected:
+                logger.info("Index entry for user {} and actor {} is missing or out of date.".format(user, actor_id))
+                result['missing'] += 1
+                if fix:
+                    index_user_permissions(user, actor_id, tenant, permissions)
+        # whatever remains belongs to users that no longer hold permissions for the actor.
+        for key in existing:
+            logger.info("Index entry {} is stale.".format(key))
+            result['stale'] += 1
+            if fix:
+                del user_actors_store[key]
+    for key, entry in list(user_actors_store.find()):
+        if entry['actor_id'] not in audited:
+            logger.info("Index entry {} is for an actor without permissions.".format(key))
+            result['orphaned'] += 1
+            if fix:
+                del user_actors_store[key]
+    return result
+
+
+def main():
+    logger.info("Running abaco audit. Now: {}".format(time.time()))
+    fix = '--dry-run' not in sys.argv
+    result = audit_user_actors(fix=fix)
+    logger.info("User actors index audit complete. fix: {}. Result: {}".format(fix, result))
+    print("User actors index: {} missing, {} stale and {} orphaned entries{}.".format(
+        result['missing'], result['stale'], result['orphaned'], '' if fix else ' (not repaired)'))
+
+
+if __name__ == '__main__':
+    main()
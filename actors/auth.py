@@ -1,13 +1,17 @@
 # Utilities for authn/z
 import base64
+import binascii
+import configparser
+import hashlib
 import json
 import os
 import re
+import time
 
 from Crypto.Signature import PKCS1_v1_5
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
-from flask import g, request, abort
+from flask import g, request, abort, has_request_context
 from flask_restful import Resource
 import jwt
 
@@ -17,35 +21,111 @@ logger = get_logger(__name__)
 
 from agaveflask.utils import ok, RequestParser
 
+import cache
 from config import Config
 import codes
 from errors import PermissionsException
-from models import Actor, get_permissions
+from models import Actor, get_cached_permissions
 
 from stores import actors_store, permissions_store
 
 
 
-jwt.verify_methods['SHA256WITHRSA'] = (
-    lambda msg, key, sig: PKCS1_v1_5.new(key).verify(SHA256.new(msg), sig))
-jwt.prepare_key_methods['SHA256WITHRSA'] = jwt.prepare_RS_key
+# prefix of the name of the request header carrying the JWT; the rest of the name is the tenant.
+JWT_HEADER_PREFIX = 'x-jwt-assertion-'
+
+# prefix of the config options holding the public keys of the apim instances of individual tenants.
+PUB_KEY_OPTION_PREFIX = 'apim_public_key_'
+
+
+def get_pub_key(tenant=None):
+    """Return the public key of the apim instance for `tenant` from the config, or the default key if tenant is None."""
+    option = '{}{}'.format(PUB_KEY_OPTION_PREFIX, tenant) if tenant else 'apim_public_key'
+    return RSA.importKey(base64.b64decode(Config.get('web', option)))
+
+
+def get_pub_keys():
+    """
+    Return the public keys configured for individual tenants (with apim_public_key_<tenant> options), by tenant.
+    Tenants are lower case and spelled as in the JWT header name (e.g. agave-prod for X-Jwt-Assertion-AGAVE-PROD).
+    """
+    return {option[len(PUB_KEY_OPTION_PREFIX):]: get_pub_key(option[len(PUB_KEY_OPTION_PREFIX):])
+            for option in Config.options('web') if option.startswith(PUB_KEY_OPTION_PREFIX)}
+
+
+PUB_KEYS = get_pub_keys()
+
+
+def get_jwt_cache_ttl():
+    """Return the maximum number of seconds a verified JWT signature is cached."""
+    try:
+        return int(Config.get('web', 'jwt_cache_ttl'))
+    except (configparser.NoOptionError, ValueError):
+        return 0
+
+
+def get_jwt_cache_size():
+    """Return the maximum number of verified JWT signatures cached."""
+    try:
+        return int(Config.get('web', 'cache_size'))
+    except (configparser.NoOptionError, ValueError):
+        return 1000
 
 
-def get_pub_key():
-    pub_key = Config.get('web', 'apim_public_key')
-    return RSA.importKey(base64.b64decode(pub_key))
+def get_token_expiration(signing_input):
+    """Return the expiration time (exp claim), in seconds, of the JWT with `signing_input`, or None if it has none."""
+    try:
+        payload = json.loads(jwt.base64url_decode(signing_input.split(b'.')[1]).decode('utf-8'))
+        exp = float(payload['exp'])
+    except (KeyError, IndexError, TypeError, ValueError, binascii.Error):
+        return None
+    # some versions of the apim issue exp in milliseconds.
+    if exp > 1e11:
+        exp = exp / 1000
+    return exp
 
 
-PUB_KEY = get_pub_key()
+# verified signatures, keyed by a hash of the JWT and the tenant. values are the expiration time of the token.
+_verified_tokens = cache.TTLCache(get_jwt_cache_ttl(), get_jwt_cache_size(),
+                                  ttl_of=lambda exp: 0 if exp is None else exp - time.time())
+
+
+def get_request_tenant():
+    """Return the tenant in the name of the JWT header of the current request, if any."""
+    if not has_request_context():
+        return None
+    for name in request.headers.keys():
+        if name.lower().startswith(JWT_HEADER_PREFIX):
+            return name[len(JWT_HEADER_PREFIX):].lower()
+    return None
+
+
+def verify_sha256_with_rsa(msg, key, sig):
+    """
+    Verify the SHA256WITHRSA signature `sig` of the JWT signing input `msg`, with the public key configured for the
+    tenant of the request, if any, or else with `key`. Successful verifications are cached until the token expires,
+    up to jwt_cache_ttl seconds, so repeated tokens skip the RSA verification.
+    """
+    tenant = get_request_tenant()
+    key = PUB_KEYS.get(tenant, key)
+
+    def _verify(cache_key):
+        if not PKCS1_v1_5.new(key).verify(SHA256.new(msg), sig):
+            return None
+        exp = get_token_expiration(msg)
+        return float('inf') if exp is None else exp
+
+    token_hash = hashlib.sha256(msg + b'.' + sig).hexdigest()
+    return _verified_tokens.get((token_hash, tenant), _verify) is not None
+
+
+jwt.verify_methods['SHA256WITHRSA'] = verify_sha256_with_rsa
+jwt.prepare_key_methods['SHA256WITHRSA'] = jwt.prepare_RS_key
 
 TOKEN_RE = re.compile('Bearer (.+)')
 
 WORLD_USER = 'world'
 
-def get_pub_key():
-    pub_key = Config.get('web', 'apim_public_key')
-    return RSA.importKey(base64.b64decode(pub_key))
-
 
 def authn_and_authz():
     """All-in-one convenience function for implementing the basic abaco authentication
@@ -159,10 +239,18 @@ def check_privileged():
         return True
 
 def check_permissions(user, actor_id, level):
-    """Check the permissions store for user and level"""
+    """Check the permissions of an actor for user and level. Decisions are cached until the permissions change."""
     logger.debug("Checking user: {} permissions for actor id: {}".format(user, actor_id))
+    return cache.get_cache(cache.DECISIONS).get((actor_id, user, level), _check_permissions)
+
+def _check_permissions(key):
+    actor_id, user, level = key
     # get all permissions for this actor
-    permissions = get_permissions(actor_id)
+    permissions = get_cached_permissions(actor_id)
+    return permissions_allow(user, permissions, level)
+
+def permissions_allow(user, permissions, level):
+    """Check whether a list of permissions, as returned by get_permissions, grants user the level."""
     for pem in permissions:
         # if the actor has been shared with the WORLD_USER anyone can use it
         if user == WORLD_USER:
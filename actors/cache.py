@@ -0,0 +1,198 @@
+"""
+In-process caches of records read from the abaco stores by the web APIs.
+
+Each process keeps a cache per kind of record (e.g. actors and permissions), bounded by the web cache_size config and
+with entries expiring after the web cache_ttl config. Write paths call invalidate() after changing a record; the
+entry is dropped from the local cache and the invalidation is published on a redis pub/sub channel so that every
+other process drops it as well. A daemon thread in each process listens on the channel. Invalidations published while
+the listener is not connected are lost, so the caches are cleared whenever it (re)connects; the TTL bounds how stale
+an entry can get otherwise.
+"""
+
+import collections
+import configparser
+import os
+import threading
+import time
+
+from config import Config
+from store import loads_json
+from stores import actors_store
+
+from agaveflask.logs import get_logger
+logger = get_logger(__name__)
+
+
+# names of the caches used by the web APIs; the keys of the first two are actor dbids, and the decisions of
+# check_permissions are keyed by (actor dbid, user, level).
+ACTORS = 'actors'
+PERMISSIONS = 'permissions'
+DECISIONS = 'decisions'
+
+# caches whose entries are derived from the entries of another cache; they are keyed by tuples starting with the key
+# of the entry they are derived from, and are invalidated together with it.
+DERIVED = {PERMISSIONS: (DECISIONS,)}
+
+# the redis pub/sub channel invalidations are published on.
+INVALIDATION_CHANNEL = 'abaco_cache_invalidations'
+
+# number of seconds between log messages with the statistics of the caches.
+STATS_INTERVAL = 300
+
+
+def _web_option(option, default):
+    """Return the integer value of `option` in the web section of the config, or `default` if it is missing."""
+    try:
+        value = Config.get('web', option)
+    except configparser.NoOptionError:
+        return default
+    if not value:
+        return default
+    return int(value)
+
+
+class TTLCache(object):
+    """
+    A thread-safe mapping of at most `max_size` entries, each of which expires `ttl` seconds after it was loaded.
+    The least recently used entries are evicted first. A `ttl` or `max_size` of 0 disables the cache. If given,
+    `ttl_of(value)` returns a shorter lifetime for a loaded value; values it gives no positive lifetime are not cached.
+    """
+
+    def __init__(self, ttl, max_size, ttl_of=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.ttl_of = ttl_of
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # incremented by every invalidation so that a load racing with an invalidation is not cached.
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        Return the value cached under `key`, calling `load(key)` to read it on a miss. Exceptions raised by `load`
+        (e.g. a KeyError for a missing record) are passed on and nothing is cached.
+        """
+        if self.ttl <= 0 or self.max_size <= 0:
+            return load(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            version = self._version
+        value = load(key)
+        ttl = self.ttl if self.ttl_of is None else min(self.ttl, self.ttl_of(value))
+        with self._lock:
+            if ttl > 0 and self._version == version:
+                self._entries[key] = (time.monotonic() + ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        """Drop the entry for `key`, if any."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._version += 1
+
+    def invalidate_group(self, key):
+        """Drop the entries whose keys are tuples starting with `key`."""
+        with self._lock:
+            for k in [k for k in self._entries if k[0] == key]:
+                del self._entries[k]
+            self._version += 1
+
+    def clear(self):
+        """Drop all entries."""
+        with self._lock:
+            self._entries.clear()
+            self._version += 1
+
+    def stats(self):
+        """Return the size, bounds and hit/miss counters of the cache."""
+        return {'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_listener_pid = None
+
+
+def get_cache(name):
+    """Return the cache `name` of the current process, starting the invalidation listener if needed."""
+    global _listener_pid
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = TTLCache(_web_option('cache_ttl', 60), _web_option('cache_size', 1000))
+        # threads do not survive a fork, and entries inherited from the parent may have missed invalidations.
+        if not _listener_pid == os.getpid():
+            for cache in _caches.values():
+                cache.clear()
+            listener = threading.Thread(target=_listen, name='cache-invalidations', daemon=True)
+            listener.start()
+            _listener_pid = os.getpid()
+        return _caches[name]
+
+
+def get_stats():
+    """Return the statistics of each cache of the current process, by name."""
+    return {name: cache.stats() for name, cache in list(_caches.items())}
+
+
+def _invalidate_local(name, key):
+    """Invalidate the entry for `key` in the cache `name`, and the entries derived from it, in this process."""
+    cache = _caches.get(name)
+    if cache is not None:
+        cache.invalidate(key)
+    for derived in DERIVED.get(name, ()):
+        cache = _caches.get(derived)
+        if cache is not None:
+            cache.invalidate_group(key)
+
+
+def invalidate(name, key):
+    """Invalidate the entry for `key` in the cache `name` in this process and, through redis, in all others."""
+    _invalidate_local(name, key)
+    try:
+        actors_store.publish(INVALIDATION_CHANNEL, {'cache': name, 'key': key})
+    except Exception as e:
+        # the write has already happened; other processes will pick it up when their entries expire.
+        logger.error("Could not publish cache invalidation for {} in {}. Exception: {}".format(key, name, e))
+
+
+def _listen():
+    """Apply the invalidations published by other processes to the caches of this process, reconnecting on errors."""
+    last_stats = time.monotonic()
+    while True:
+        pubsub = None
+        try:
+            pubsub = actors_store.subscribe(INVALIDATION_CHANNEL)
+            # anything published before the subscription was established has been missed.
+            for cache in list(_caches.values()):
+                cache.clear()
+            while True:
+                if time.monotonic() - last_stats > STATS_INTERVAL:
+                    logger.info("Cache statistics: {}".format(get_stats()))
+                    last_stats = time.monotonic()
+                message = pubsub.get_message(timeout=1.0)
+                if not message or not message['type'] == 'message':
+                    continue
+                data = loads_json(message['data'])
+                _invalidate_local(data['cache'], data['key'])
+        except Exception as e:
+            logger.error("Error listening for cache invalidations; reconnecting. Exception: {}".format(e))
+            if pubsub:
+                pubsub.close()
+            time.sleep(1)
@@ -1,8 +1,205 @@
+import json
+import os
+import threading
+
 from channelpy import Channel, RabbitConnection
+from channelpy.chan import ChannelEncoder
+from channelpy.connections import connections
+import rabbitpy
 
 from config import Config
 
 
+class RabbitConnectionPool(object):
+    """A long-lived connection to RabbitMQ shared by all of the channels of a process, and the idle AMQP channels
+    opened on it. rabbitpy never reuses channel ids, so AMQP channels are returned to the pool and handed out again
+    rather than closed. A new connection is opened once the current one fails.
+    """
+
+    # maximum number of idle AMQP channels of each kind kept for reuse.
+    MAX_IDLE_CHANNELS = 16
+
+    def __init__(self, uri):
+        self.uri = uri
+        self._conn = None
+        # idle channels, keyed by whether they are in transactional mode.
+        self._idle = {False: [], True: []}
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None or not self._conn.open:
+            self._conn = rabbitpy.Connection(self.uri)
+            self._idle = {False: [], True: []}
+        return self._conn
+
+    def acquire(self, transactional=False):
+        """Return a connection and an open AMQP channel on it. Pass the pair to release() when done with it."""
+        with self._lock:
+            conn = self._connection()
+            idle = self._idle[transactional]
+            while idle:
+                ch = idle.pop()
+                if ch.open:
+                    return conn, ch
+            try:
+                ch = conn.channel()
+            except rabbitpy.exceptions.TooManyChannelsError:
+                # channel ids of channels closed after errors are never reused; start over on a new connection.
+                self._discard_connection(conn)
+                conn = self._connection()
+                ch = conn.channel()
+        if transactional:
+            rabbitpy.Tx(ch).select()
+        return conn, ch
+
+    def release(self, conn, ch, transactional=False):
+        """Return a channel obtained from acquire() to the pool."""
+        with self._lock:
+            idle = self._idle[transactional]
+            if conn is self._conn and ch.open and len(idle) < self.MAX_IDLE_CHANNELS:
+                idle.append(ch)
+                return
+        _close_quietly(ch)
+
+    def discard(self, conn, ch):
+        """Discard a channel obtained from acquire() after an error, along with its connection if that has failed
+        too. Errors such as a failed declare only close the channel, and the connection stays in use."""
+        _close_quietly(ch)
+        if not conn.open:
+            with self._lock:
+                self._discard_connection(conn)
+
+    def _discard_connection(self, conn):
+        if conn is self._conn:
+            self._conn = None
+            self._idle = {False: [], True: []}
+        _close_quietly(conn)
+
+
+def _close_quietly(obj):
+    """Close a rabbitpy connection or channel, ignoring errors since it may already be broken."""
+    try:
+        obj.close()
+    except Exception:
+        pass
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(uri):
+    """Return the RabbitConnectionPool for `uri` of the current process. Pools are not inherited across forks."""
+    global _pools_pid
+    with _pools_lock:
+        if not _pools_pid == os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if uri not in _pools:
+            _pools[uri] = RabbitConnectionPool(uri)
+        return _pools[uri]
+
+
+class PooledRabbitConnection(RabbitConnection):
+    """A channelpy connection that takes its AMQP channel from the pool of the process instead of opening a new
+    connection to RabbitMQ. Closing it returns the channel to the pool.
+
+    channelpy deletes a channel on one thread while closing it on another (see Channel.delete), so the deletes and
+    close() are serialized: the AMQP channel is not returned to the pool while a delete is using it, and deletes that
+    come after close() run on a channel checked out for the purpose.
+    """
+    def __init__(self, uri):
+        super().__init__(uri)
+        self._local_queues = []
+        self._lock = threading.RLock()
+
+    def connect(self):
+        pool = get_pool(self._uri)
+        with self._lock:
+            if self._ch is not None:
+                # channelpy reconnects after an error, which closes the channel but not necessarily the connection.
+                pool.discard(self._conn, self._ch)
+                self._ch = None
+            self._local_queues = []
+            self._conn, self._ch = pool.acquire()
+
+    def create_local_queue(self):
+        queue = super().create_local_queue()
+        self._local_queues.append(queue)
+        return queue
+
+    def delete_queue(self, queue):
+        self._delete(queue, lambda ch: rabbitpy.Queue(ch, name=queue.name))
+
+    def delete_pubsub(self, pubsub):
+        self._delete(pubsub, lambda ch: rabbitpy.Exchange(ch, pubsub.name))
+
+    def _delete(self, obj, rebind):
+        """Delete a queue or exchange declared on this connection; `rebind` returns it on another AMQP channel."""
+        with self._lock:
+            if self._ch is not None:
+                try:
+                    obj.delete()
+                except rabbitpy.exceptions.RabbitpyException:
+                    pass
+                return
+        pool = get_pool(self._uri)
+        conn, ch = pool.acquire()
+        try:
+            rebind(ch).delete()
+        except rabbitpy.exceptions.RabbitpyException:
+            pool.discard(conn, ch)
+        else:
+            pool.release(conn, ch)
+
+    def close(self):
+        with self._lock:
+            if self._ch is None:
+                return
+            pool = get_pool(self._uri)
+            try:
+                # exclusive queues live as long as the connection, which outlives this channel.
+                for queue in self._local_queues:
+                    queue.delete()
+            except rabbitpy.exceptions.RabbitpyException:
+                pool.discard(self._conn, self._ch)
+            else:
+                pool.release(self._conn, self._ch)
+            self._local_queues = []
+            self._ch = None
+
+
+def get_queue_sizes(uri, names):
+    """
+    Return a dictionary mapping each of the queue names in `names` to the number of messages waiting in the queue,
+    reading all of them over a single pooled AMQP channel. Queues that do not exist are reported with a size of 0.
+    """
+    pool = get_pool(uri)
+    conn, ch = pool.acquire()
+    sizes = {}
+    try:
+        for name in names:
+            try:
+                # a passive declare only reads the queue's counts; it fails if the queue does not exist.
+                sizes[name], _ = rabbitpy.Queue(ch, name=name, durable=True).declare(passive=True)
+            except rabbitpy.exceptions.AMQPNotFound:
+                sizes[name] = 0
+                # the broker closes the channel after a failed declare; release() will close it for good.
+                pool.release(conn, ch)
+                conn, ch = pool.acquire()
+    except Exception:
+        pool.discard(conn, ch)
+        raise
+    pool.release(conn, ch)
+    return sizes
+
+
+# channels passed in messages (e.g. the reply_to channel of put_sync) are rebuilt from the name of their connection
+# type.
+connections['PooledRabbitConnection'] = PooledRabbitConnection
+
+
 class WorkerChannel(Channel):
     """Channel for communication with a worker. Pass the name of the worker to communicate with an
     existing worker.
@@ -10,7 +207,7 @@ class WorkerChannel(Channel):
     def __init__(self, name=None):
         self.uri = Config.get('rabbit', 'uri')
         super().__init__(name=name,
-                         connection_type=RabbitConnection,
+                         connection_type=PooledRabbitConnection,
                          uri=self.uri)
 
 
@@ -20,7 +217,7 @@ class ClientsChannel(Channel):
     def __init__(self, name='clients'):
         self.uri = Config.get('rabbit', 'uri')
         super().__init__(name=name,
-                         connection_type=RabbitConnection,
+                         connection_type=PooledRabbitConnection,
                          uri=self.uri)
 
     def request_client(self, tenant, actor_id, worker_id, secret):
@@ -49,7 +246,7 @@ class CommandChannel(Channel):
     def __init__(self):
         self.uri = Config.get('rabbit', 'uri')
         super().__init__(name='command',
-                         connection_type=RabbitConnection,
+                         connection_type=PooledRabbitConnection,
                          uri=self.uri)
 
     def put_cmd(self, actor_id, worker_ids, image, tenant, num=None, stop_existing=True):
@@ -70,7 +267,7 @@ class ActorMsgChannel(Channel):
     def __init__(self, actor_id):
         self.uri = Config.get('rabbit', 'uri')
         super().__init__(name='actor_msg_{}'.format(actor_id),
-                         connection_type=RabbitConnection,
+                         connection_type=PooledRabbitConnection,
                          uri=self.uri)
 
     def put_msg(self, message, d={}, **kwargs):
@@ -82,3 +279,32 @@ class ActorMsgChannel(Channel):
         for k, v in kwargs:
             d[k] = v
         self.put(d)
+
+    def put_msgs(self, msgs):
+        """Pass a list of messages to an actor's inbox in a single AMQP transaction. Each message is a dictionary
+        like the one built by put_msg. Either the broker accepts all of the messages or none of them, in which case
+        an exception is raised.
+        """
+        # transactional channels are pooled separately, since transactional mode cannot be turned off on a channel.
+        pool = get_pool(self.uri)
+        conn, ch = pool.acquire(transactional=True)
+        try:
+            for d in msgs:
+                body = json.dumps(d, cls=ChannelEncoder).encode('utf-8')
+                rabbitpy.Message(ch, body, {}).publish('', self.name)
+            rabbitpy.Tx(ch).commit()
+        # closing the channel discards the messages published so far.
+        except Exception:
+            pool.discard(conn, ch)
+            raise
+        pool.release(conn, ch, transactional=True)
+
+    def size(self):
+        """Return the number of messages waiting in the actor's inbox."""
+        return get_queue_sizes(self.uri, [self.name])[self.name]
+
+    @staticmethod
+    def get_sizes(actor_ids):
+        """Return a dictionary mapping each of the actor dbids in `actor_ids` to the size of its inbox."""
+        sizes = get_queue_sizes(Config.get('rabbit', 'uri'), ['actor_msg_{}'.format(id) for id in actor_ids])
+        return {id: sizes['actor_msg_{}'.format(id)] for id in actor_ids}
@@ -68,6 +68,8 @@ class ClientGenerator(object):
                 logger.error(msg)
                 anon_ch.put({'status': 'error',
                              'message': msg})
+            # return the pooled connection of the reply channel.
+            anon_ch.close()
 
     def new_client(self, cmd, anon_ch):
         valid, msg, owner = self.check_new_params(cmd)
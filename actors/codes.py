@@ -6,6 +6,8 @@ SUBMITTED = 'SUBMITTED'
 READY = 'READY'
 ERROR = 'ERROR'
 BUSY = 'BUSY'
+# a worker that has been sent a stop message but has not yet removed itself
+STOPPING = 'STOPPING'
 
 # order of permissions implies level; i.e. NONE < READ < EXECUTE < UPDATE
 NONE = 'NONE'
@@ -14,6 +16,21 @@ EXECUTE = 'EXECUTE'
 UPDATE = 'UPDATE'
 PERMISSION_LEVELS = (NONE, READ, EXECUTE, UPDATE)
 
+# default number of items returned in a page of a paginated listing when the page_size is not configured
+DEFAULT_PAGE_SIZE = 100
+
+# default maximum number of messages in a batch sent to an actor when the message_batch_size is not configured
+DEFAULT_MESSAGE_BATCH_SIZE = 1000
+
+# default number of seconds between the heartbeats of a worker when the heartbeat_interval is not configured
+DEFAULT_HEARTBEAT_INTERVAL = 5
+
+# number of consecutive heartbeats a worker can miss before it is considered dead
+HEARTBEAT_MISSES = 3
+
+# default number of seconds for which a pulled image is considered fresh when the image_pull_ttl is not configured
+DEFAULT_IMAGE_PULL_TTL = 300
+
 # role set by agaveflask in case the access_control_type is none
 ALL_ROLE = 'ALL'
 
@@ -1,3 +1,4 @@
+import configparser
 import json
 
 from flask import g, request
@@ -5,36 +6,99 @@ from flask_restful import Resource, Api, inputs
 
 from agaveflask.utils import RequestParser, ok
 
-from auth import check_permissions
+from auth import permissions_allow
+import cache
 from channels import ActorMsgChannel, CommandChannel
-from codes import SUBMITTED, PERMISSION_LEVELS, READ
+from codes import BUSY, SUBMITTED, PERMISSION_LEVELS, READ, DEFAULT_MESSAGE_BATCH_SIZE, DEFAULT_PAGE_SIZE
 from config import Config
 from errors import DAOError, ResourceError, PermissionsException, WorkerException
 from models import dict_to_camel, Actor, Execution, ExecutionsSummary, Worker, get_permissions, \
-    add_permission
+    get_user_actors, add_permission, delete_permissions
 
-from stores import actors_store, executions_store, logs_store, permissions_store
+from stores import actors_store, executions_store, logs_store, pending_store, summaries_store
 from worker import shutdown_workers, shutdown_worker
 
 from agaveflask.logs import get_logger
 logger = get_logger(__name__)
 
+
+def get_message_batch_size():
+    """Return the configured maximum number of messages in a batch sent to an actor."""
+    try:
+        return int(Config.get('web', 'message_batch_size'))
+    except (configparser.NoOptionError, ValueError):
+        return DEFAULT_MESSAGE_BATCH_SIZE
+
+
+def get_page_size():
+    """Return the configured default number of items in a page of a paginated listing."""
+    try:
+        return int(Config.get('web', 'page_size'))
+    except (configparser.NoOptionError, ValueError):
+        return DEFAULT_PAGE_SIZE
+
+
+def validate_page_args():
+    """Parse the `limit` and `cursor` query parameters used by paginated listings."""
+    parser = RequestParser()
+    parser.add_argument('limit', type=int, required=False, help="Maximum number of items to return.")
+    parser.add_argument('cursor', type=str, required=False,
+                        help="Cursor returned with the previous page; omit for the first page.")
+    args = parser.parse_args()
+    if args.get('limit') is None:
+        args['limit'] = get_page_size()
+    if args['limit'] < 1:
+        raise ResourceError("Invalid limit: {}. The limit must be a positive integer.".format(args['limit']))
+    return args
+
+
+def validate_worker_limits(args):
+    """Check the min_workers, max_workers and max_concurrency fields of an actor registration or update."""
+    min_workers = args.get('min_workers')
+    max_workers = args.get('max_workers')
+    if min_workers is not None and min_workers < 0:
+        raise ResourceError("min_workers must be non-negative.", 400)
+    if max_workers is not None and max_workers < 1:
+        raise ResourceError("max_workers must be at least 1.", 400)
+    if min_workers is not None and max_workers is not None and min_workers > max_workers:
+        raise ResourceError("min_workers cannot be greater than max_workers.", 400)
+    max_concurrency = args.get('max_concurrency')
+    if max_concurrency is not None and max_concurrency < 1:
+        raise ResourceError("max_concurrency must be at least 1.", 400)
+    # the executions of a stateful actor update its state one at a time.
+    if max_concurrency is not None and max_concurrency > 1 and not args.get('stateless'):
+        raise ResourceError("max_concurrency greater than 1 requires a stateless actor.", 400)
+
+
 class ActorsResource(Resource):
 
     def get(self):
         logger.debug("top of GET /actors")
+        args = validate_page_args()
+        # page through the actors the user holds permissions for, using the per-user index of actors.
+        entries, next_cursor = get_user_actors(g.tenant, g.user, cursor=args['cursor'], limit=args['limit'])
+        actor_ids = [entry['actor_id'] for entry in entries
+                     if permissions_allow(g.user, entry['permissions'], READ)]
         actors = []
-        for k, v in actors_store.items():
-            if v['tenant'] == g.tenant:
-                actor = Actor.from_db(v)
-                if check_permissions(g.user, actor.db_id, READ):
-                    actors.append(actor.display())
+        # retrieve the page of actors in one round trip.
+        for actor_id, actor in zip(actor_ids, actors_store.mget(actor_ids)):
+            if actor is None:
+                logger.info("actor {} in index for user {} but not in store.".format(actor_id, g.user))
+                continue
+            actors.append(Actor.from_db(actor).display())
         logger.info("actors retrieved.")
-        return ok(result=actors, msg="Actors retrieved successfully.")
+        rsp = ok(result=actors, msg="Actors retrieved successfully.")
+        if next_cursor:
+            # the result remains a list of actors, so the next page is advertised in a Link header.
+            rsp.headers['Link'] = '<{}/actors/v2?limit={}&cursor={}>; rel="next"'.format(
+                g.api_server, args['limit'], next_cursor)
+        return rsp
 
     def validate_post(self):
         parser = Actor.request_parser()
-        return parser.parse_args()
+        args = parser.parse_args()
+        validate_worker_limits(args)
+        return args
 
     def post(self):
         logger.info("top of POST to register a new actor.")
@@ -45,6 +109,7 @@ class ActorsResource(Resource):
         args['owner'] = g.user
         actor = Actor(**args)
         actors_store[actor.db_id] = actor.to_db()
+        cache.invalidate(cache.ACTORS, actor.db_id)
         logger.debug("new actor saved in db. id: {}. image: {}. tenant: {}".format(actor.db_id,
                                                                                    actor.image,
                                                                                    actor.tenant))
@@ -60,7 +125,7 @@ class ActorResource(Resource):
         logger.debug("top of GET /actors/{}".format(actor_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[dbid])
+            actor = Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor with id: {}".format(actor_id))
             raise ResourceError(
@@ -75,16 +140,18 @@ class ActorResource(Resource):
         shutdown_workers(id)
         logger.debug("shutdown_workers() done")
         try:
-            actor = Actor.from_db(actors_store[id])
-            executions = actor.get('executions') or {}
-            for ex_id, val in executions.items():
-                del logs_store[ex_id]
+            for execution in Execution.get_executions(id):
+                del logs_store[execution.id]
+            executions_store.delete_many(actor_id=id)
+            del summaries_store[id]
         except KeyError as e:
             logger.info("got KeyError {} trying to retrieve actor or executions with id {}".format(
                 e, id))
         del actors_store[id]
+        del pending_store[id]
+        cache.invalidate(cache.ACTORS, id)
         logger.info("actor {} deleted from store.".format(id))
-        del permissions_store[id]
+        delete_permissions(id)
         logger.info("actor {} permissions deleted from store.".format(id))
         return ok(result=None, msg='Actor deleted successfully.')
 
@@ -113,11 +180,13 @@ class ActorResource(Resource):
         args['owner'] = g.user
         actor = Actor(**args)
         actors_store[actor.db_id] = actor.to_db()
+        cache.invalidate(cache.ACTORS, actor.db_id)
         logger.info("updated actor {} stored in db.".format(actor_id))
         worker_ids = Worker.request_worker(actor.db_id)
         if update_image:
             ch = CommandChannel()
             ch.put_cmd(actor_id=actor.db_id, worker_ids=worker_ids, image=actor.image, tenant=args['tenant'])
+            ch.close()
             logger.debug("put new command on command channel to update actor.")
         return ok(result=actor.display(),
                   msg="Actor updated successfully.")
@@ -129,6 +198,7 @@ class ActorResource(Resource):
         parser.remove_argument('name')
         # this update overrides all required and optional attributes
         actor.update(parser.parse_args())
+        validate_worker_limits(actor)
         return actor
 
 
@@ -137,7 +207,7 @@ class ActorStateResource(Resource):
         logger.debug("top of GET /actors/{}/state".format(actor_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[dbid])
+            actor = Actor.get_actor(dbid)
         except KeyError:
             raise ResourceError(
                 "No actor found with id: {}.".format(actor_id), 404)
@@ -147,7 +217,7 @@ class ActorStateResource(Resource):
         logger.debug("top of POST /actors/{}/state".format(actor_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[dbid])
+            actor = Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor with id: {}.".format(actor_id))
             raise ResourceError(
@@ -159,6 +229,7 @@ class ActorStateResource(Resource):
         logger.debug("state post params validated: {}".format(actor_id))
         state = args['state']
         actors_store.update(dbid, 'state', state)
+        cache.invalidate(cache.ACTORS, dbid)
         logger.info("state updated: {}".format(actor_id))
         actor = Actor.from_db(actors_store[dbid])
         return ok(result=actor.display(), msg="State updated successfully.")
@@ -175,13 +246,19 @@ class ActorExecutionsResource(Resource):
         logger.debug("top of GET /actors/{}/executions".format(actor_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[dbid])
+            actor = Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError(
                 "No actor found with id: {}.".format(actor_id), 404)
+        args = validate_page_args()
+        if args['cursor']:
+            try:
+                Execution.get_create_time(args['cursor'])
+            except ValueError:
+                raise ResourceError("Invalid cursor: {}.".format(args['cursor']), 400)
         try:
-            summary = ExecutionsSummary(db_id=dbid)
+            summary = ExecutionsSummary(db_id=dbid, limit=args['limit'], cursor=args['cursor'])
         except DAOError as e:
             logger.debug("did not find executions summary: {}".format(actor_id))
             raise ResourceError("Could not retrieve executions summary for actor: {}. "
@@ -192,7 +269,7 @@ class ActorExecutionsResource(Resource):
         logger.debug("top of POST /actors/{}/executions".format(actor_id))
         id = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[id])
+            actor = Actor.get_actor(id)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError(
@@ -225,18 +302,13 @@ class ActorExecutionResource(Resource):
         logger.debug("top of GET /actors/{}/executions/{}.".format(actor_id, execution_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actors_store[dbid]
+            Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError(
                 "No actor found with id: {}.".format(actor_id), 404)
         try:
-            excs = executions_store[dbid]
-        except KeyError:
-            logger.debug("did not find executions: {}.".format(actor_id))
-            raise ResourceError("No executions found for actor {}.".format(actor_id))
-        try:
-            exc = Execution.from_db(excs[execution_id])
+            exc = Execution.get_execution(dbid, execution_id)
         except KeyError:
             logger.debug("did not find execution: {}. actor: {}.".format(execution_id,
                                                                          actor_id))
@@ -254,18 +326,13 @@ class ActorExecutionLogsResource(Resource):
         logger.debug("top of GET /actors/{}/executions/{}/logs.".format(actor_id, execution_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[dbid])
+            actor = Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError(
                 "No actor found with id: {}.".format(actor_id), 404)
         try:
-            excs = executions_store[dbid]
-        except KeyError:
-            logger.debug("did not find executions. actor: {}.".format(actor_id))
-            raise ResourceError("No executions found for actor {}.".format(actor_id))
-        try:
-            exc = Execution.from_db(excs[execution_id])
+            exc = Execution.get_execution(dbid, execution_id)
         except KeyError:
             logger.debug("did not find execution: {}. actor: {}.".format(execution_id, actor_id))
             raise ResourceError("Execution {} not found.".format(execution_id))
@@ -279,6 +346,36 @@ class ActorExecutionLogsResource(Resource):
         return ok(result, msg="Logs retrieved successfully.")
 
 
+def get_message_metadata():
+    """
+    Build the dictionary of metadata passed to an actor along with each message from the request: the query
+    parameters and details of the user making the request.
+    """
+    d = {}
+    # build a dictionary of k:v pairs from the query parameters, and pass a single
+    # additional object 'message' from within the post payload. Note that 'message'
+    # need not be JSON data.
+    for k, v in request.args.items():
+        if k == 'message':
+            continue
+        d[k] = v
+    logger.debug("extra fields added to message from query parameters: {}.".format(d))
+    if hasattr(g, 'user'):
+        d['_abaco_username'] = g.user
+        logger.debug("_abaco_username: {} added to message.".format(g.user))
+    if hasattr(g, 'api_server'):
+        d['_abaco_api_server'] = g.api_server
+        logger.debug("_abaco_api_server: {} added to message.".format(g.api_server))
+    # if hasattr(g, 'jwt'):
+    #     d['_abaco_jwt'] = g.jwt
+    # if hasattr(g, 'jwt_server'):
+    #     d['_abaco_jwt_server'] = g.jwt_server
+    if hasattr(g, 'jwt_header_name'):
+        d['_abaco_jwt_header_name'] = g.jwt_header_name
+        logger.debug("abaco_jwt_header_name: {} added to message.".format(g.jwt_header_name))
+    return d
+
+
 class MessagesResource(Resource):
 
     def get(self, actor_id):
@@ -291,15 +388,29 @@ class MessagesResource(Resource):
         # check that actor exists
         id = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[id])
+            actor = Actor.get_actor(id)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError(
                 "No actor found with id: {}.".format(actor_id), 404)
-        result={'messages': len(ActorMsgChannel(actor_id=id)._queue._queue)}
+        ch = ActorMsgChannel(actor_id=id)
+        result = {'messages': ch.size(), 'oldest_message_age': None}
+        ch.close()
+        # read from the record of waiting messages, since reading the inbox would take the message from it. the record
+        # can hold messages taken by workers that died before recording it, so it is not read when the inbox is empty.
+        if result['messages']:
+            result['oldest_message_age'] = Execution.oldest_pending_age(id)
+        # messages being executed have already been removed from the queue; workers record how many they are running.
+        workers = Worker.get_workers(id)
+        result['in_flight'] = sum(w.get('active') or (1 if w.get('status') == BUSY else 0)
+                                  for w in workers.values())
         logger.debug("messages found for actor: {}.".format(actor_id))
         result.update(get_hypermedia(actor))
-        return ok(result)
+        case = Config.get('web', 'case')
+        if not case == 'camel':
+            return ok(result)
+        else:
+            return ok(dict_to_camel(result))
 
     def validate_post(self):
         logger.debug("validating message payload.")
@@ -338,34 +449,13 @@ class MessagesResource(Resource):
         logger.debug("top of POST /actors/{}/messages.".format(actor_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            Actor.from_db(actors_store[dbid])
+            actor = Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError("No actor found with id: {}.".format(actor_id), 404)
         args = self.validate_post()
-        d = {}
-        # build a dictionary of k:v pairs from the query parameters, and pass a single
-        # additional object 'message' from within the post payload. Note that 'message'
-        # need not be JSON data.
         logger.debug("POST body validated. actor: {}.".format(actor_id))
-        for k, v in request.args.items():
-            if k == 'message':
-                continue
-            d[k] = v
-        logger.debug("extra fields added to message from query parameters: {}.".format(d))
-        if hasattr(g, 'user'):
-            d['_abaco_username'] = g.user
-            logger.debug("_abaco_username: {} added to message.".format(g.user))
-        if hasattr(g, 'api_server'):
-            d['_abaco_api_server'] = g.api_server
-            logger.debug("_abaco_api_server: {} added to message.".format(g.api_server))
-        # if hasattr(g, 'jwt'):
-        #     d['_abaco_jwt'] = g.jwt
-        # if hasattr(g, 'jwt_server'):
-        #     d['_abaco_jwt_server'] = g.jwt_server
-        if hasattr(g, 'jwt_header_name'):
-            d['_abaco_jwt_header_name'] = g.jwt_header_name
-            logger.debug("abaco_jwt_header_name: {} added to message.".format(g.jwt_header_name))
+        d = get_message_metadata()
 
         # create an execution
         exc = Execution.add_execution(dbid, {'cpu': 0,
@@ -377,11 +467,17 @@ class MessagesResource(Resource):
         d['_abaco_execution_id'] = exc
         d['_abaco_Content-Type'] = args.get('_abaco_Content-Type', '')
         logger.debug("Final message dictionary: {}".format(d))
+        Execution.add_pending(dbid, [exc])
         ch = ActorMsgChannel(actor_id=dbid)
-        ch.put_msg(message=args['message'], d=d)
+        try:
+            ch.put_msg(message=args['message'], d=d)
+        except Exception:
+            Execution.remove_pending(dbid, [exc])
+            raise
+        finally:
+            ch.close()
         logger.debug("Message added to actor inbox. id: {}.".format(actor_id))
         # make sure at least one worker is available
-        actor = Actor.from_db(actors_store[dbid])
         actor.ensure_one_worker()
         logger.debug("ensure_one_actor() called. id: {}.".format(actor_id))
         result={'execution_id': exc, 'msg': args['message']}
@@ -393,12 +489,80 @@ class MessagesResource(Resource):
             return ok(dict_to_camel(result))
 
 
+class MessagesBatchResource(Resource):
+
+    def validate_post(self):
+        logger.debug("validating message batch payload.")
+        json_data = request.get_json(silent=True)
+        # the batch may also be passed as the messages attribute of a JSON object
+        if isinstance(json_data, dict):
+            json_data = json_data.get('messages')
+        if not isinstance(json_data, list) or not json_data:
+            raise ResourceError("The POST body must be a non-empty JSON list of messages.", 400)
+        max_size = get_message_batch_size()
+        if len(json_data) > max_size:
+            raise ResourceError("A batch can contain at most {} messages; got {}.".format(max_size, len(json_data)), 400)
+        return json_data
+
+    def post(self, actor_id):
+        def get_hypermedia(actor):
+            return {'_links': {'self': '{}/actors/v2/{}/messages/batch'.format(actor.api_server, actor.id),
+                               'owner': '{}/profiles/v2/{}'.format(actor.api_server, actor.owner),
+                               'executions': '{}/actors/v2/{}/executions'.format(actor.api_server, actor.id)},}
+
+        logger.debug("top of POST /actors/{}/messages/batch.".format(actor_id))
+        dbid = Actor.get_dbid(g.tenant, actor_id)
+        try:
+            actor = Actor.get_actor(dbid)
+        except KeyError:
+            logger.debug("did not find actor: {}.".format(actor_id))
+            raise ResourceError("No actor found with id: {}.".format(actor_id), 404)
+        messages = self.validate_post()
+        logger.debug("POST body validated. actor: {}. number of messages: {}.".format(actor_id, len(messages)))
+        d = get_message_metadata()
+        # create all of the executions at once
+        exc_ids = Execution.add_executions(dbid, [{'cpu': 0,
+                                                   'io': 0,
+                                                   'runtime': 0,
+                                                   'status': SUBMITTED,
+                                                   'executor': g.user} for _ in messages])
+        logger.info("{} executions added for actor {}".format(len(exc_ids), actor_id))
+        msgs = []
+        for message, exc in zip(messages, exc_ids):
+            msg = dict(d)
+            msg['message'] = message
+            msg['_abaco_execution_id'] = exc
+            # strings are passed to the actor as is; anything else is JSON data
+            msg['_abaco_Content-Type'] = 'str' if isinstance(message, str) else 'application/json'
+            msgs.append(msg)
+        Execution.add_pending(dbid, exc_ids)
+        ch = ActorMsgChannel(actor_id=dbid)
+        try:
+            ch.put_msgs(msgs)
+        except Exception:
+            Execution.remove_pending(dbid, exc_ids)
+            raise
+        finally:
+            ch.close()
+        logger.debug("{} messages added to actor inbox. id: {}.".format(len(msgs), actor_id))
+        # make sure at least one worker is available
+        actor.ensure_one_worker()
+        logger.debug("ensure_one_actor() called. id: {}.".format(actor_id))
+        result = {'execution_ids': exc_ids}
+        result.update(get_hypermedia(actor))
+        case = Config.get('web', 'case')
+        if not case == 'camel':
+            return ok(result)
+        else:
+            return ok(dict_to_camel(result))
+
+
 class WorkersResource(Resource):
     def get(self, actor_id):
         logger.debug("top of GET /actors/{}/workers.".format(actor_id))
         dbid = Actor.get_dbid(g.tenant, actor_id)
         try:
-            Actor.from_db(actors_store[dbid])
+            Actor.get_actor(dbid)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError("No actor found with id: {}.".format(actor_id), 404)
@@ -424,7 +588,7 @@ class WorkersResource(Resource):
         logger.debug("top of POST /actors/{}/workers.".format(actor_id))
         id = Actor.get_dbid(g.tenant, actor_id)
         try:
-            actor = Actor.from_db(actors_store[id])
+            actor = Actor.get_actor(id)
         except KeyError:
             logger.debug("did not find actor: {}.".format(actor_id))
             raise ResourceError("No actor found with id: {}.".format(actor_id), 404)
@@ -458,6 +622,7 @@ class WorkersResource(Resource):
                        tenant=g.tenant,
                        num=num_to_add,
                        stop_existing=False)
+            ch.close()
             logger.info("Message put on command channel for new worker ids: {}".format(worker_ids))
             return ok(result=None, msg="Scheduled {} new worker(s) to start. There were only".format(num_to_add))
         else:
@@ -469,7 +634,7 @@ class WorkerResource(Resource):
         logger.debug("top of GET /actors/{}/workers/{}.".format(actor_id, worker_id))
         id = Actor.get_dbid(g.tenant, actor_id)
         try:
-            Actor.from_db(actors_store[id])
+            Actor.get_actor(id)
         except KeyError:
             logger.debug("Did not find actor: {}.".format(actor_id))
             raise ResourceError("No actor found with id: {}.".format(actor_id), 404)
@@ -499,7 +664,7 @@ class PermissionsResource(Resource):
         logger.debug("top of GET /actors/{}/permissions.".format(actor_id))
         id = Actor.get_dbid(g.tenant, actor_id)
         try:
-            Actor.from_db(actors_store[id])
+            Actor.get_actor(id)
         except KeyError:
             logger.debug("Did not find actor: {}.".format(actor_id))
             raise ResourceError("No actor found with id: {}.".format(actor_id), 404)
@@ -526,7 +691,7 @@ class PermissionsResource(Resource):
         logger.debug("top of POST /actors/{}/permissions.".format(actor_id))
         id = Actor.get_dbid(g.tenant, actor_id)
         try:
-            Actor.from_db(actors_store[id])
+            Actor.get_actor(id)
         except KeyError:
             logger.debug("Did not find actor: {}.".format(actor_id))
             raise ResourceError(
@@ -1,6 +1,13 @@
+import atexit
 import configparser
+import datetime
+import fcntl
+import hashlib
 import json
 import os
+import queue
+import re
+import threading
 import time
 import timeit
 
@@ -12,8 +19,7 @@ from agaveflask.logs import get_logger, get_log_file_strategy
 logger = get_logger(__name__)
 
 from config import Config
-from codes import BUSY
-from models import Worker
+from codes import BUSY, DEFAULT_IMAGE_PULL_TTL
 
 TAG = os.environ.get('TAG') or Config.get('general', 'TAG') or ''
 AE_IMAGE = '{}{}'.format(os.environ.get('AE_IMAGE', 'abaco/core'), TAG)
@@ -24,6 +30,36 @@ dd = Config.get('docker', 'dd')
 host_id = Config.get('spawner', 'host_id')
 host_ip = Config.get('spawner', 'host_ip')
 
+# the host's (v1) cgroup hierarchy, mounted read only into the containers started by run_container_with_docker; the
+# resource usage of actor containers is read from it.
+CGROUP_ROOT = '/host/sys/fs/cgroup'
+
+# host directory, mounted into the containers started by run_container_with_docker, holding a record of the last pull
+# of each image on the host and the lock files that keep workers on the host from pulling the same image at once.
+IMAGE_CACHE_DIR = '/var/lib/abaco/images'
+
+# number of seconds between samples of the cgroup counters of a running actor container.
+STATS_INTERVAL = 0.05
+
+# timeout, in seconds, of the client used to read the docker stats stream; the stream times out once the container
+# has stopped.
+STATS_TIMEOUT = 1
+
+# docker clients of this process, by timeout; see get_client.
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+# latency of the docker API calls made by this process, by call; see record_latency.
+api_latency = {}
+
+# containers of finished executions waiting to be removed, and the thread removing them; see remove_containers.
+_finished_containers = queue.Queue()
+_remover = None
+
+# maximum number of seconds to wait, when the process exits, for the queued containers to be removed.
+REMOVE_TIMEOUT = 10
+
 
 class DockerError(Exception):
     def __init__(self, message):
@@ -33,13 +69,61 @@ class DockerError(Exception):
 class DockerStartContainerError(DockerError):
     pass
 
+def _api_call(request):
+    """Return the name of a docker API call, e.g. 'POST /containers/{id}/wait', for a request."""
+    path = request.path_url.split('?')[0]
+    path = re.sub(r'^/v[0-9.]+', '', path)
+    return '{} {}'.format(request.method, re.sub(r'/[0-9a-f]{12,64}(?=/|$)', '/{id}', path))
+
+def record_latency(response, *args, **kwargs):
+    """
+    Response hook recording the latency, in milliseconds, of a docker API call: the time until the response headers
+    were received (for streams such as stats and logs, the time until the stream started).
+    """
+    call = _api_call(response.request)
+    ms = response.elapsed.total_seconds() * 1000
+    logger.debug("docker API call {} took {:.1f} ms (status {}).".format(call, ms, response.status_code))
+    with _clients_lock:
+        count, total, slowest = api_latency.get(call, (0, 0.0, 0.0))
+        api_latency[call] = (count + 1, total + ms, max(slowest, ms))
+
+def get_api_latency():
+    """Return the number, mean and max latency, in milliseconds, of the docker API calls made by this process."""
+    with _clients_lock:
+        return {call: {'count': count, 'mean': total / count, 'max': slowest}
+                for call, (count, total, slowest) in api_latency.items()}
+
+def get_client(timeout=None):
+    """
+    Return this process's docker client with the given timeout, in seconds (by default, the docker-py default). The
+    clients are cached so that the API version is negotiated with the daemon once per process and the connection pool
+    to the docker socket is reused across calls; they are safe to share between threads.
+    """
+    global _clients_pid
+    with _clients_lock:
+        # connections to the socket cannot be shared with a forked child.
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            api_latency.clear()
+            _clients_pid = os.getpid()
+        if timeout not in _clients:
+            kwargs = {'timeout': timeout} if timeout else {}
+            if _clients:
+                version = next(iter(_clients.values())).api_version
+                cli = docker.Client(base_url=dd, version=version, **kwargs)
+            else:
+                cli = docker.AutoVersionClient(base_url=dd, **kwargs)
+            cli.hooks['response'].append(record_latency)
+            _clients[timeout] = cli
+        return _clients[timeout]
+
 def rm_container(cid):
     """
     Remove a container.
     :param cid:
     :return:
     """
-    cli = docker.AutoVersionClient(base_url=dd)
+    cli = get_client()
     try:
         rsp = cli.remove_container(cid, force=True)
     except Exception as e:
@@ -47,14 +131,78 @@ def rm_container(cid):
         raise DockerError("Error removing container {}, exception: {}".format(cid, str(e)))
     logger.info("container {} removed.".format(cid))
 
+def get_image_pull_ttl():
+    """Return the configured number of seconds for which a pulled image is considered fresh."""
+    try:
+        return int(Config.get('workers', 'image_pull_ttl'))
+    except (configparser.NoOptionError, ValueError):
+        return DEFAULT_IMAGE_PULL_TTL
+
+def image_is_fresh(image, record_path, ttl):
+    """
+    Check whether the local copy of `image` was pulled on this host less than `ttl` seconds ago, according to its
+    pull record, and still has the id (digest) it had when it was pulled.
+    """
+    try:
+        with open(record_path) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if time.time() - record.get('time', 0) >= ttl:
+        return False
+    try:
+        image_id = get_client().inspect_image(image)['Id']
+    except docker.errors.APIError:
+        # the image has been removed from the host.
+        return False
+    return image_id == record.get('id')
+
+def record_pull(image, record_path):
+    """Record the id (digest) of the local copy of `image` and the time it was pulled."""
+    try:
+        image_id = get_client().inspect_image(image)['Id']
+    except docker.errors.APIError as e:
+        logger.info("Could not inspect image {} after pulling it. Exception: {}".format(image, e))
+        return
+    tmp = '{}.{}'.format(record_path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump({'image': image, 'id': image_id, 'time': time.time()}, f)
+    os.replace(tmp, record_path)
+
 def pull_image(image):
     """
-    Update the local registry with an actor's image.
-    :param actor_id:
-    :return:
+    Update the local registry with an actor's image, unless the local copy is still fresh (see image_is_fresh and the
+    image_pull_ttl config). Workers on the same host pull an image one at a time, so that those started together
+    wait for the first pull rather than repeating it.
+    :param image:
+    :return: True if the image was pulled, False if the local copy was fresh.
     """
     logger.debug("top of pull_image()")
-    cli = docker.AutoVersionClient(base_url=dd)
+    ttl = get_image_pull_ttl()
+    record_path = os.path.join(IMAGE_CACHE_DIR, hashlib.sha256(image.encode('utf-8')).hexdigest())
+    try:
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        lock = open('{}.lock'.format(record_path), 'a')
+    except OSError as e:
+        logger.info("Image cache {} is not available, pulling image {}. Exception: {}".format(IMAGE_CACHE_DIR, image, e))
+        _pull_image(image)
+        return True
+    # the lock is held until the file is closed, including when the process dies.
+    with lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if ttl > 0 and image_is_fresh(image, record_path, ttl):
+            logger.info("Image {} is fresh, skipping the pull.".format(image))
+            return False
+        _pull_image(image)
+        try:
+            record_pull(image, record_path)
+        except OSError as e:
+            logger.info("Could not record the pull of image {}. Exception: {}".format(image, e))
+    return True
+
+def _pull_image(image):
+    """Pull an image from the registry."""
+    cli = get_client()
     try:
         rsp = cli.pull(repository=image)
     except Exception as e:
@@ -83,7 +231,7 @@ def container_running(image=None, name=None):
         filters['name'] = name
     if image:
         filters['image'] = image
-    cli = docker.AutoVersionClient(base_url=dd)
+    cli = get_client()
     try:
         containers = cli.containers(filters=filters)
     except Exception as e:
@@ -99,11 +247,13 @@ def run_container_with_docker(image, command, name=None, environment={}, log_fil
     Note: this function always mounts the abaco conf file so it should not be used by execute_actor().
     """
     logger.debug("top of run_container_with_docker().")
-    cli = docker.AutoVersionClient(base_url=dd)
+    cli = get_client()
 
     # bind the docker socket as r/w since this container gets docker.
-    volumes = ['/var/run/docker.sock']
-    binds = {'/var/run/docker.sock': {'bind': '/var/run/docker.sock', 'ro': False}}
+    volumes = ['/var/run/docker.sock', CGROUP_ROOT, IMAGE_CACHE_DIR]
+    binds = {'/var/run/docker.sock': {'bind': '/var/run/docker.sock', 'ro': False},
+             '/sys/fs/cgroup': {'bind': CGROUP_ROOT, 'ro': True},
+             IMAGE_CACHE_DIR: {'bind': IMAGE_CACHE_DIR, 'ro': False}}
 
     # mount the abaco conf file. first we look for the environment variable, falling back to the value in Config.
     try:
@@ -148,6 +298,34 @@ def run_container_with_docker(image, command, name=None, environment={}, log_fil
     logger.info("container started successfully: {}".format(container))
     return container
 
+def remove_containers():
+    """Target for a thread that removes the containers of finished executions, ignoring errors."""
+    while True:
+        cid = _finished_containers.get()
+        try:
+            get_client().remove_container(container=cid)
+            logger.info("Container {} removed.".format(cid))
+        except Exception as e:
+            logger.error("Exception trying to remove actor container {}: {}".format(cid, e))
+        _finished_containers.task_done()
+
+def remove_container_async(cid):
+    """Queue the container of a finished execution to be removed by this process's remover thread."""
+    global _remover
+    with _clients_lock:
+        if _remover is None or not _remover.is_alive():
+            _remover = threading.Thread(target=remove_containers, name='container-remover', daemon=True)
+            _remover.start()
+    _finished_containers.put(cid)
+
+@atexit.register
+def wait_for_removals():
+    """Give the remover thread up to REMOVE_TIMEOUT seconds to remove the queued containers before exiting."""
+    deadline = time.time() + REMOVE_TIMEOUT
+    while _remover is not None and _remover.is_alive() and _finished_containers.unfinished_tasks \
+            and time.time() < deadline:
+        time.sleep(0.05)
+
 def run_worker(image, ch_name, worker_id):
     """
     Run an actor executor worker with a given channel and image.
@@ -182,12 +360,100 @@ def run_worker(image, ch_name, worker_id):
              'status': BUSY,
              'host_id': host_id,
              'host_ip': host_ip,
-             'last_execution': 0}
+             'last_execution': 0,
+             'create_time': round(time.time(), 3)}
+
+def read_cgroup_stats(cid):
+    """
+    Return the cpu usage, in user jiffies, and block I/O, in 512-byte sectors, of a container read from its cgroup
+    counters, or None if they cannot be read (e.g., the container has exited and its cgroup has been removed).
+    """
+    try:
+        with open(os.path.join(CGROUP_ROOT, 'cpuacct', 'docker', cid, 'cpuacct.stat')) as f:
+            cpu = int(dict(line.split() for line in f)['user'])
+        io = 0
+        with open(os.path.join(CGROUP_ROOT, 'blkio', 'docker', cid, 'blkio.throttle.io_service_bytes')) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[1] in ('Read', 'Write'):
+                    io += int(fields[2])
+    except (OSError, KeyError, ValueError):
+        return None
+    return {'cpu': cpu, 'io': io // 512}
+
+def parse_docker_stats(stats):
+    """Return the cpu usage, in user jiffies, and block I/O, in 512-byte sectors, from a docker stats record."""
+    if type(stats) == bytes:
+        stats = json.loads(stats.decode("utf-8"))
+    cpu = stats['cpu_stats']['cpu_usage'].get('usage_in_usermode', 0) * os.sysconf('SC_CLK_TCK') // 10**9
+    io = sum(entry['value'] for entry in stats.get('blkio_stats', {}).get('io_service_bytes_recursive') or []
+             if entry.get('op') in ('Read', 'Write'))
+    return {'cpu': cpu, 'io': io // 512}
+
+def parse_docker_time(value):
+    """Parse a timestamp reported by docker, e.g. 2017-01-01T12:00:02.987654321Z, into a (UTC) datetime."""
+    # docker reports nanoseconds, but datetime only supports microseconds.
+    date, _, fraction = value.rstrip('Z').partition('.')
+    return datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S') + \
+           datetime.timedelta(microseconds=int((fraction + '000000')[:6]))
+
+def get_runtime(container_state):
+    """Return the runtime, in milliseconds, of an exited container from its State, or None if it is not available."""
+    try:
+        runtime = parse_docker_time(container_state['FinishedAt']) - parse_docker_time(container_state['StartedAt'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return max(int(runtime.total_seconds() * 1000), 0)
+
+
+class StatsSampler(threading.Thread):
+    """
+    Samples the resource usage of a running container, keeping the latest sample. The counters are cumulative, so
+    the latest sample holds the usage of the whole execution. The cgroup counters are read every STATS_INTERVAL
+    seconds when they are available; otherwise, the stats streamed by the docker daemon (about once a second) are
+    used.
+    """
+
+    def __init__(self, cid):
+        super().__init__(name='stats-{}'.format(cid), daemon=True)
+        self.cid = cid
+        self.sample = {'cpu': 0, 'io': 0}
+        self._done = threading.Event()
+
+    def run(self):
+        sample = read_cgroup_stats(self.cid)
+        if sample is not None:
+            while sample is not None and not self._done.is_set():
+                self.sample = sample
+                self._done.wait(STATS_INTERVAL)
+                sample = read_cgroup_stats(self.cid)
+            return
+        stats_cli = get_client(timeout=STATS_TIMEOUT)
+        try:
+            for stats in stats_cli.stats(container=self.cid, decode=True):
+                self.sample = parse_docker_stats(stats)
+                if self._done.is_set():
+                    return
+        # the stream times out once the container has stopped.
+        except (ReadTimeout, ReadTimeoutError):
+            pass
+        except Exception as e:
+            logger.info("Got exception reading stats for container {}: {}".format(self.cid, e))
+
+    def stop(self):
+        """Stop sampling and return the final sample, reading the cgroup counters one last time if they remain."""
+        self._done.set()
+        sample = read_cgroup_stats(self.cid)
+        if sample is not None:
+            self.sample = sample
+        return self.sample
+
 
 def execute_actor(actor_id, worker_id, worker_ch, image, msg, d={}, privileged=False):
     """
     Creates and runs an actor container and supervises the execution, collecting statistics about resource consumption
-    from the Docker daemon.
+    from the container's cgroup counters (or the Docker daemon). The execution blocks on the container exiting while
+    the statistics are sampled on a separate thread.
 
     :param actor_id: the dbid of the actor; for updating worker status
     :param worker_id: the worker id; also for updating worker status
@@ -197,7 +463,8 @@ def execute_actor(actor_id, worker_id, worker_ch, image, msg, d={}, privileged=F
     :param d: dictionary representing the environment to instantiate within the actor container.
     :param privileged: whether this actor is "privileged"; i.e., its container should run in privileged mode with the
     docker daemon mounted.
-    :return: result (dict), logs (str) - `result`: statistics about resource consumption; `logs`: output from docker logs.
+    :return: result (dict), logs (str) - `result`: statistics about resource consumption (cpu in user jiffies, io in
+    512-byte sectors and runtime in milliseconds); `logs`: output from docker logs.
     """
     logger.debug("top of execute_actor()")
 
@@ -205,7 +472,7 @@ def execute_actor(actor_id, worker_id, worker_ch, image, msg, d={}, privileged=F
     result = {'cpu': 0,
               'io': 0,
               'runtime': 0 }
-    cli = docker.AutoVersionClient(base_url=dd)
+    cli = get_client()
     d['MSG'] = msg
     binds = {}
     volumes = []
@@ -228,96 +495,46 @@ def execute_actor(actor_id, worker_id, worker_ch, image, msg, d={}, privileged=F
         logger.info("Got exception starting actor container: {}".format(e))
         raise DockerStartContainerError("Could not start container {}. Exception {}".format(container.get('Id'), str(e)))
 
-    # start the timer to track total execution time.
+    cid = container.get('Id')
+    # start the timer to track total execution time, in case docker does not report it.
     start = timeit.default_timer()
-    Worker.update_worker_status(actor_id, worker_id, BUSY)
-    running = True
+    sampler = StatsSampler(cid)
+    sampler.start()
 
-    # create a separate cli for checking stats objects since these should be fast and we don't want to wait
-    stats_cli = docker.AutoVersionClient(base_url=dd, timeout=1)
-
-    #@todo - is it possible to simplify this stats collection code? perhaps replace with docker events or just
-    #        the State object set by docker at the end of the container run.. It's likely waiting for the timeout adds
-    #        latency to the execution time.  .
+    # block until the container exits, or until the max_run_time.
     try:
-        stats_obj = stats_cli.stats(container=container.get('Id'), decode=True)
-    except ReadTimeout:
-        # if the container execution is so fast that the initial stats object cannot be created,
-        # we skip the running loop and return a minimal stats object
-        logger.info("Got ReadTimeout before collecting any stats for container: {}".format(container.get('Id')))
-        result['cpu'] = 1
-        result['runtime'] = 1
-        return result
-    while running:
-        try:
-            logger.debug("waiting on a stats obj: {}".format(timeit.default_timer()))
-            stats = next(stats_obj)
-        except ReadTimeoutError:
-            # this is a ReadTimeoutError from docker, not requests. container is finished.
-            logger.debug("next(stats) just timed out: {}".format(timeit.default_timer()))
-            # container stopped before another stats record could be read, just ignore and move on
-            running = False
-            break
-        try:
-            result['cpu'] += stats['cpu_stats']['cpu_usage']['total_usage']
-            result['io'] += stats['network']['rx_bytes']
-        except KeyError as e:
-            # as of docker 1.9, the stats object returns bytes that must be decoded
-            # and the network key is now 'networks' with multiple subkeys.
-            logger.info("Got a KeyError trying to fetch the cpu or io object: {}".format(e))
-            if type(stats) == bytes:
-                stats = json.loads(stats.decode("utf-8"))
-            result['cpu'] += stats['cpu_stats']['cpu_usage']['total_usage']
-            # even running docker 1.9, there seems to be a race condition where the 'networks' key doesn't
-            # always get populated.
-            try:
-                result['io'] += stats['networks']['eth0']['rx_bytes']
-            except KeyError as e:
-                # grab and log the exception but don't let it break processing.
-                logger.info("Got KeyError exception trying to grab the io object. Exception: {}".format(e))
-
-        # if container is still running, use the cli.wait function with a 1 second timeout to let the container
-        # run for up to another second before trying to collect the next stats object
-        if running:
-            try:
-                logger.debug("waiting on cli.wait: {}".format(timeit.default_timer()))
-                cli.wait(container=container.get('Id'), timeout=1)
-                logger.info("container finished: {}".format(timeit.default_timer()))
-                running = False
-            except ReadTimeout:
-                logger.debug("cli.wait just timed out: {}".format(timeit.default_timer()))
-                # the wait timed out so check if we are beyond the max_run_time
-                runtime = timeit.default_timer() - start
-                if max_run_time > 0 and max_run_time < runtime:
-                    logger.info("hit runtime limit: {}".format(timeit.default_timer()))
-                    cli.stop(container.get('Id'))
-                    running = False
-    logger.info("container stopped:{}".format(timeit.default_timer()))
+        cli.wait(container=cid, timeout=max_run_time if max_run_time > 0 else None)
+        logger.info("container finished: {}".format(timeit.default_timer()))
+    except (ReadTimeout, ReadTimeoutError):
+        logger.info("hit runtime limit: {}".format(timeit.default_timer()))
+        cli.stop(cid)
     stop = timeit.default_timer()
+    result.update(sampler.stop())
+    logger.info("container stopped:{}".format(stop))
+
     # get info from container execution, including exit code
+    container_state = {'unavailable': True}
+    exit_code = 'undetermined'
     try:
-        container_info = cli.inspect_container(container.get('Id'))
+        container_info = cli.inspect_container(cid)
         try:
             container_state = container_info['State']
             try:
                 exit_code = container_state['ExitCode']
             except KeyError as e:
-                logger.error("Could not determine ExitCode for container {}. e: {}".format(container.get('Id'), e))
-                exit_code = 'undetermined'
+                logger.error("Could not determine ExitCode for container {}. e: {}".format(cid, e))
         except KeyError as e:
-            logger.error("Could not determine final state for container {}. e: {} ".format(container.get('Id')), e)
-            container_state = {'unavailable': True}
+            logger.error("Could not determine final state for container {}. e: {} ".format(cid, e))
     except docker.errors.APIError as e:
-        logger.error("Could not inspect container {}. e: {}".format(container.get('Id'), e))
+        logger.error("Could not inspect container {}. e: {}".format(cid, e))
 
     # get logs from container
     logs = cli.logs(container.get('Id'))
 
-    # remove container, ignore errors
-    try:
-        cli.remove_container(container=container)
-        logger.info("Container removed.")
-    except Exception as e:
-        logger.error("Exception trying to remove actor: {}".format(e))
-    result['runtime'] = int(stop - start)
+    # remove the container off the critical path of the execution; containers are never reused.
+    remove_container_async(cid)
+    # docker's timestamps exclude the time taken to create and start the container.
+    result['runtime'] = get_runtime(container_state)
+    if result['runtime'] is None:
+        result['runtime'] = int((stop - start) * 1000)
     return result, logs, container_state, exit_code
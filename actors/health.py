@@ -1,25 +1,33 @@
 # Ensures that:
-# 1. all worker containers in the database are still responsive; workers that have stopped
-#    responding are shutdown and removed from the database.
+# 1. all worker containers in the database are still alive; workers that have stopped sending
+#    heartbeats are shutdown and removed from the database.
 # 2. Enforce ttl for idle workers.
-#
-# In the future, this module will also implement:
-# 3. all actors with stateless=true have a number of workers proportional to the messages in the queue.
+# 3. all actors with stateless=true have a number of workers proportional to the messages in the queue (see
+#    manage_workers).
 
 # Execute from a container on a schedule as follows:
 # docker run -it --rm -v /var/run/docker.sock:/var/run/docker.sock abaco/core python3 -u /actors/health.py
+#
+# or run it as a long-running container that checks every health_interval seconds:
+# docker run -d -v /var/run/docker.sock:/var/run/docker.sock abaco/core python3 -u /actors/health.py --daemon
 
+import configparser
+import math
 import os
+import random
+import sys
+import threading
 import time
+import uuid
 
-import channelpy
-
+import cache
 import codes
 from config import Config
 from docker_utils import rm_container, DockerError, container_running, run_container_with_docker
-from models import Actor, Worker
-from channels import CommandChannel, WorkerChannel
-from stores import actors_store
+from models import WORKER_EVENTS_CHANNEL, Actor, Execution, Worker, get_heartbeat_interval
+from channels import ActorMsgChannel, CommandChannel
+from store import loads_json
+from stores import actors_store, locks_store, workers_store
 from worker import shutdown_worker
 
 AE_IMAGE = os.environ.get('AE_IMAGE', 'abaco/core')
@@ -28,58 +36,117 @@ from agaveflask.logs import get_logger, get_log_file_strategy
 logger = get_logger(__name__)
 
 
+# number of actors whose workers are retrieved from the workers_store in each round trip.
+BATCH_SIZE = 100
+
+# number of seconds between health check passes in daemon mode when the health_interval is not configured.
+DEFAULT_HEALTH_INTERVAL = 60
+
+# number of seconds after which a health daemon re-reads all actors and workers, in case events were lost.
+FULL_SCAN_INTERVAL = 3600
+
+# number of seconds after which a message recorded as on its way to an actor's inbox (see Execution.add_pending) must
+# have arrived; older records of actors whose inboxes are empty are cleared.
+PENDING_GRACE = 60
+
+# number of seconds after which the autoscaling lock of an actor expires if its holder fails to release it.
+AUTOSCALE_LOCK_TIMEOUT = 30
+
 def get_actor_ids():
     """Returns the list of actor ids currently registered."""
-    return [db_id for db_id, _ in actors_store.items()]
+    # keys are returned from redis as bytes
+    return [db_id.decode('utf-8') for db_id in actors_store]
 
-def check_workers(actor_id, ttl):
-    """Check health of all workers for an actor."""
-    logger.info("Checking health for actor: {}".format(actor_id))
+def get_queue_sizes(actor_ids):
+    """
+    Returns a dictionary mapping each of the actor ids in `actor_ids` to the number of messages in its inbox, read in
+    one pass over a single AMQP channel. Returns an empty dictionary if RabbitMQ cannot be reached.
+    """
     try:
-        workers = Worker.get_workers(actor_id)
+        return ActorMsgChannel.get_sizes(actor_ids)
     except Exception as e:
-        logger.error("Got exception trying to retrieve workers: {}".format(e))
+        logger.error("Got exception trying to retrieve queue sizes: {}".format(e))
+        return {}
+
+def is_local(worker):
+    """Returns whether the health of `worker` is checked by this host; each host checks the workers it runs."""
+    # if the worker has only been requested, it will not have a host_id.
+    # @todo- we will skip for now, but we need something more robust in case the worker is never claimed.
+    return worker.get('host_id') == Config.get('spawner', 'host_id')
+
+def get_heartbeats(workers):
+    """
+    Returns a dictionary mapping the id of each of `workers` to the time of its last heartbeat, or None for workers
+    that have stopped sending heartbeats, in one round trip. Returns None if the heartbeats cannot be read.
+    """
+    try:
+        return Worker.get_heartbeats([worker['id'] for worker in workers])
+    except Exception as e:
+        logger.error("Got exception trying to retrieve heartbeats: {}".format(e))
         return None
+
+def is_dead(worker, heartbeats):
+    """
+    Returns whether `worker` has stopped sending heartbeats. Workers whose heartbeats were not read (they are missing
+    from `heartbeats`), workers too new to have been expected to send one and workers started by versions of abaco
+    that did not send heartbeats are not considered dead.
+    """
+    if worker['id'] not in heartbeats:
+        logger.info("Heartbeat of worker {} was not read; skipping it in this pass.".format(worker['id']))
+        return False
+    if heartbeats[worker['id']] is not None:
+        return False
+    # workers started before heartbeats were introduced have no create_time. they are left to the ttl, since they
+    # would otherwise all be removed, even in the middle of an execution, by the first pass after an upgrade.
+    if not worker.get('create_time'):
+        logger.info("Worker {} predates heartbeats; not checking its heartbeat.".format(worker['id']))
+        return False
+    grace = get_heartbeat_interval() * codes.HEARTBEAT_MISSES
+    if float(worker['create_time']) + grace > time.time():
+        logger.info("Worker {} has not sent its first heartbeat yet.".format(worker['id']))
+        return False
+    return True
+
+def check_workers(actor_id, ttl, workers=None, heartbeats=None):
+    """
+    Check health of all workers for an actor. The workers are retrieved from the workers_store unless they are
+    passed as `workers`, and so are their heartbeats unless they are passed as `heartbeats` (see get_heartbeats).
+    Only workers that are dead according to is_dead are removed.
+    """
+    logger.info("Checking health for actor: {}".format(actor_id))
+    if workers is None:
+        try:
+            workers = Worker.get_workers(actor_id)
+        except Exception as e:
+            logger.error("Got exception trying to retrieve workers: {}".format(e))
+            return None
     logger.debug("workers: {}".format(workers))
-    for _, worker in workers.items():
-        # if the worker has only been requested, it will not have a host_id.
-        if 'host_id' not in worker:
-            # @todo- we will skip for now, but we need something more robust in case the worker is never claimed.
-            continue
-        # ignore workers on different hosts
-        if not Config.get('spawner', 'host_id') == worker['host_id']:
-            continue
-        # first check if worker is responsive; if not, will need to manually kill
+    # ignore workers on different hosts
+    workers = [worker for worker in workers.values() if is_local(worker)]
+    if heartbeats is None:
+        heartbeats = get_heartbeats(workers)
+        if heartbeats is None:
+            return None
+    for worker in workers:
+        # first check if worker is alive; if not, will need to manually kill
         logger.info("Checking health for worker: {}".format(worker))
-        ch = WorkerChannel(name=worker['ch_name'])
-        try:
-            logger.debug("Issuing status check to channel: {}".format(worker['ch_name']))
-            result = ch.put_sync('status', timeout=5)
-        except channelpy.exceptions.ChannelTimeoutException:
-            logger.info("Worker did not respond, removing container and deleting worker.")
+        if is_dead(worker, heartbeats):
+            logger.info("Worker stopped sending heartbeats, removing container and deleting worker.")
             try:
                 rm_container(worker['cid'])
             except DockerError:
                 pass
             try:
-                Worker.delete_worker(actor_id, worker['ch_name'])
+                Worker.delete_worker(actor_id, worker['id'])
             except Exception as e:
                 logger.error("Got exception trying to delete worker: {}".format(e))
             continue
-        if not result == 'ok':
-            logger.error("Worker responded unexpectedly: {}, deleting worker.".format(result))
-            try:
-                rm_container(worker['cid'])
-                Worker.delete_worker(actor_id, worker['ch_name'])
-            except Exception as e:
-                logger.error("Got error removing/deleting worker: {}".format(e))
-        else:
-            logger.info("Worker ok.")
+        logger.info("Worker ok.")
         # now check if the worker has been idle beyond the ttl:
         if ttl < 0:
             # ttl < 0 means infinite life
             logger.info("Infinite ttl configured; leaving worker")
-            return
+            continue
         if worker['status'] == codes.READY and \
             worker['last_execution'] + ttl < time.time():
             # shutdown worker
@@ -88,23 +155,104 @@ def check_workers(actor_id, ttl):
         else:
             logger.debug("Worker still has life.")
 
-def manage_workers(actor_id):
-    """Scale workers for an actor if based on message queue size and policy."""
-    logger.info("Entering manage_workers for {}".format(actor_id))
+def get_autoscale_config():
+    """
+    Returns the autoscaling policy from the workers section of the config, or None if autoscaling is disabled. See
+    manage_workers.
+    """
     try:
-        actor = Actor.from_db(actors_store[actor_id])
-    except KeyError:
-        logger.info("Did not find actor; returning.")
+        if not Config.get('workers', 'autoscale').lower() == 'true':
+            return None
+    except configparser.NoOptionError:
+        return None
+    policy = {'min_workers': 1, 'max_workers': 10, 'messages_per_worker': 1, 'cooldown': 60}
+    for name, default in policy.items():
+        try:
+            policy[name] = int(Config.get('workers', 'autoscale_{}'.format(name)))
+        except configparser.NoOptionError:
+            pass
+        except ValueError as e:
+            logger.error("Invalid autoscale_{} config: {}. Using {}.".format(name, e, default))
+    return policy
+
+def manage_workers(actor_id, actor, workers, queue_size, policy):
+    """
+    Scale the workers of a stateless actor based on the number of messages in its inbox, `queue_size`, and the
+    autoscaling `policy` returned by get_autoscale_config. The actor needs one execution slot for every
+    `messages_per_worker` queued messages on top of its running executions, and each worker has `max_concurrency`
+    slots; the number of workers stays within its min_workers and max_workers (the actor's own values, if set, or the
+    policy's; the policy's max_workers is a hard limit). Workers are added at most once per `cooldown`
+    seconds, and READY workers are stopped once they have been idle for `cooldown` seconds and there are no queued
+    messages. Stopped workers are marked STOPPING, and are not counted, until they remove themselves.
+    Call through scale_actor, which keeps the health checks of different hosts from scaling an actor at once.
+    """
+    logger.info("Entering manage_workers for {}".format(actor_id))
+    # stateful actors must have a single worker so that executions update their state one at a time.
+    if not actor.get('stateless'):
         return
-    workers = Worker.get_workers(actor_id)
-    #TODO - implement policy
+    min_workers = actor.get('min_workers')
+    if min_workers is None:
+        min_workers = policy['min_workers']
+    max_workers = actor.get('max_workers')
+    if max_workers is None:
+        max_workers = policy['max_workers']
+    max_workers = min(max_workers, policy['max_workers'])
+    min_workers = min(min_workers, max_workers)
+    workers = [w for w in workers.values() if w.get('status') not in (codes.ERROR, codes.STOPPING)]
+    # each worker runs up to max_concurrency executions at once.
+    active = sum(w.get('active') or (1 if w.get('status') == codes.BUSY else 0) for w in workers)
+    demand = active + math.ceil(queue_size / max(policy['messages_per_worker'], 1))
+    target = math.ceil(demand / max(actor.get('max_concurrency') or 1, 1))
+    target = max(min_workers, min(target, max_workers))
+    now = time.time()
+    if len(workers) < target:
+        # workers created within the cooldown (including those that have only been requested) may not be
+        # processing messages yet.
+        last_create = max([float(w.get('create_time') or 0) for w in workers] or [0])
+        if last_create + policy['cooldown'] > now:
+            logger.info("Actor {} needs {} worker(s) but is cooling down.".format(actor_id, target - len(workers)))
+            return
+        num = target - len(workers)
+        worker_ids = [Worker.request_worker(actor_id) for _ in range(num)]
+        ch = CommandChannel()
+        ch.put_cmd(actor_id=actor_id,
+                   worker_ids=worker_ids,
+                   image=actor['image'],
+                   tenant=actor['tenant'],
+                   num=num,
+                   stop_existing=False)
+        ch.close()
+        logger.info("Scaling up actor {} by {} worker(s) for {} queued message(s). New worker ids: {}".format(
+            actor_id, num, queue_size, worker_ids))
+    elif len(workers) > target and queue_size == 0:
+        idle = [w for w in workers if w.get('status') == codes.READY and
+                max(float(w.get('last_execution') or 0), float(w.get('create_time') or 0)) + policy['cooldown'] < now]
+        for worker in idle[:len(workers) - target]:
+            logger.info("Scaling down actor {}; stopping idle worker: {}".format(actor_id, worker['id']))
+            Worker.update_worker_status(actor_id, worker['id'], codes.STOPPING)
+            shutdown_worker(worker['ch_name'])
 
-def main():
-    logger.info("Running abaco health checks. Now: {}".format(time.time()))
+def scale_actor(actor_id, actor, queue_size, policy):
+    """
+    Run manage_workers for an actor while holding its autoscaling lock, so that the health checks of different hosts
+    do not scale the same actor at once; a host that does not get the lock leaves the actor to the holder. The
+    workers are re-read under the lock since the caller's view of them may be stale.
+    """
+    key = 'autoscale_{}'.format(actor_id)
+    # the lock holds a token unique to this call, so that a lock that has expired and been taken by another host is
+    # not released by this one.
+    token = '{}_{}'.format(Config.get('spawner', 'host_id'), uuid.uuid4().hex)
+    if not locks_store.set_if_absent(key, token, ex=AUTOSCALE_LOCK_TIMEOUT):
+        logger.debug("Actor {} is being scaled by another host.".format(actor_id))
+        return
     try:
-        ttl = Config.get('workers', 'worker_ttl')
-    except Exception as e:
-        logger.error("Could not get worker_ttl config. Exception: {}".format(e))
+        manage_workers(actor_id, actor, Worker.get_workers(actor_id), queue_size, policy)
+    finally:
+        if not locks_store.delete_if_equal(key, token):
+            logger.error("Autoscaling lock of actor {} expired while it was being scaled.".format(actor_id))
+
+def check_spawner():
+    """Launch a new spawner if none is running."""
     if not container_running(name='spawner*'):
         logger.critical("No spawners running! Launching new spawner..")
         command = 'python3 -u /actors/spawner.py'
@@ -121,17 +269,175 @@ def main():
                                       log_file=log_file)
         except Exception as e:
             logger.critical("Could not restart spanwer. Exception: {}".format(e))
+
+def get_ttl():
+    """Returns the configured worker_ttl, or -1 (infinite life) if it is missing or invalid."""
     try:
-        ttl = int(ttl)
+        return int(Config.get('workers', 'worker_ttl'))
     except Exception as e:
         logger.error("Invalid ttl config: {}. Setting to -1.".format(e))
-        ttl = -1
+        return -1
+
+def get_health_interval():
+    """Returns the number of seconds between the health check passes of the daemon."""
+    try:
+        return int(Config.get('workers', 'health_interval'))
+    except (configparser.NoOptionError, ValueError):
+        return DEFAULT_HEALTH_INTERVAL
+
+def load_actors(actor_ids):
+    """
+    Returns a dictionary mapping each of the actor ids in `actor_ids` to a tuple of the actor and its workers, read in
+    batches of BATCH_SIZE actors. Actors that no longer exist are mapped to None.
+    """
+    result = {}
+    for i in range(0, len(actor_ids), BATCH_SIZE):
+        batch = actor_ids[i:i + BATCH_SIZE]
+        try:
+            actors = actors_store.mget(batch)
+            workers = Worker.get_workers_batch(batch)
+        except Exception as e:
+            logger.error("Got exception trying to retrieve workers: {}".format(e))
+            continue
+        for id, actor, actor_workers in zip(batch, actors, workers):
+            result[id] = None if actor is None else (actor, actor_workers)
+    return result
+
+def check_actors(actors, ttl, policy):
+    """
+    Check the health of the workers of this host and scale the workers of stateless actors, if `policy` is not None.
+    `actors` maps actor ids to a tuple of the actor and its workers, as returned by load_actors.
+    """
+    start = time.time()
+    ids = [id for id, entry in actors.items() if entry is not None]
+    sizes = {}
+    for i in range(0, len(ids), BATCH_SIZE):
+        sizes.update(get_queue_sizes(ids[i:i + BATCH_SIZE]))
+    for id, size in sizes.items():
+        if size:
+            logger.info("Actor {} has {} queued message(s).".format(id, size))
+    try:
+        Execution.clear_pending([id for id, size in sizes.items() if not size], start - PENDING_GRACE)
+    except Exception as e:
+        logger.error("Got exception clearing the records of waiting messages: {}".format(e))
+    # the heartbeats of the workers of all actors are read at once.
+    local_workers = [worker for id in ids for worker in actors[id][1].values() if is_local(worker)]
+    heartbeats = get_heartbeats(local_workers)
+    if heartbeats is None:
+        logger.error("Could not read heartbeats; not checking workers in this pass.")
+        return
+    dead = len([worker for worker in local_workers if is_dead(worker, heartbeats)])
+    for id in ids:
+        actor, actor_workers = actors[id]
+        managed = policy and actor.get('stateless')
+        # the autoscaler stops the idle workers of the actors it manages instead of the ttl.
+        check_workers(id, -1 if managed else ttl, actor_workers, heartbeats)
+        if managed and id in sizes:
+            try:
+                scale_actor(id, actor, sizes[id], policy)
+            except Exception as e:
+                logger.error("Got exception scaling actor {}: {}".format(id, e))
+    logger.info("Health check pass complete in {:.2f}s. Checked {} worker(s), {} dead.".format(
+        time.time() - start, len(local_workers), dead))
+
+
+class WorkersView(object):
+    """
+    The actors and their workers, as last read from the stores by a health daemon. Actors are re-read before the next
+    pass when their workers change (see models.publish_worker_event) or they are updated or deleted (see
+    cache.invalidate). Everything is re-read every FULL_SCAN_INTERVAL seconds, and whenever events may have been missed.
+    """
+
+    def __init__(self):
+        self.actors = {}
+        self._dirty = set()
+        self._full_scan = True
+        self._last_full_scan = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Re-read the actors that changed since the last refresh, or all of them if a full scan is due."""
+        with self._lock:
+            full_scan = self._full_scan or time.time() - self._last_full_scan > FULL_SCAN_INTERVAL
+            dirty = self._dirty
+            self._full_scan = False
+            self._dirty = set()
+        if full_scan:
+            self.actors = {id: entry for id, entry in load_actors(get_actor_ids()).items() if entry is not None}
+            self._last_full_scan = time.time()
+            logger.info("Full scan found {} actor(s).".format(len(self.actors)))
+            return
+        for id, entry in load_actors(list(dirty)).items():
+            if entry is None:
+                self.actors.pop(id, None)
+            else:
+                self.actors[id] = entry
+        logger.info("Re-read {} changed actor(s).".format(len(dirty)))
+
+    def listen(self):
+        """Mark the actors named in worker and actor events as changed. Runs forever, reconnecting on errors."""
+        while True:
+            pubsub = None
+            try:
+                pubsub = workers_store.subscribe(WORKER_EVENTS_CHANNEL)
+                pubsub.subscribe(cache.INVALIDATION_CHANNEL)
+                # anything published before the subscriptions were established has been missed.
+                with self._lock:
+                    self._full_scan = True
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if not message or not message['type'] == 'message':
+                        continue
+                    data = loads_json(message['data'])
+                    if 'actor_id' in data:
+                        actor_id = data['actor_id']
+                    elif data.get('cache') == cache.ACTORS:
+                        actor_id = data['key']
+                    else:
+                        continue
+                    with self._lock:
+                        self._dirty.add(actor_id)
+            except Exception as e:
+                logger.error("Error listening for worker events; reconnecting. Exception: {}".format(e))
+                if pubsub:
+                    pubsub.close()
+                time.sleep(1)
+
+
+def run_daemon():
+    """Run health check passes every health_interval seconds, keeping the view of the workers between passes."""
+    interval = get_health_interval()
+    logger.info("Running abaco health daemon. Interval: {}s. Now: {}".format(interval, time.time()))
+    view = WorkersView()
+    listener = threading.Thread(target=view.listen, name='worker-events', daemon=True)
+    listener.start()
+    # hosts start at a random offset within the interval so that their passes do not coincide.
+    time.sleep(random.uniform(0, interval))
+    while True:
+        start = time.time()
+        try:
+            check_spawner()
+            view.refresh()
+            check_actors(view.actors, get_ttl(), get_autoscale_config())
+        except Exception as e:
+            logger.error("Got exception running health check pass: {}".format(e))
+        # the jitter keeps the passes of different hosts from drifting into step.
+        time.sleep(max(interval * random.uniform(0.9, 1.1) - (time.time() - start), 0))
+
+def main():
+    logger.info("Running abaco health checks. Now: {}".format(time.time()))
+    check_spawner()
+    ttl = get_ttl()
+    policy = get_autoscale_config()
+    logger.info("Autoscaling policy: {}".format(policy))
     ids = get_actor_ids()
     logger.info("Found {} actor(s). Now checking status.".format(len(ids)))
-    for id in ids:
-        check_workers(id, ttl)
-        # manage_workers(id)
+    actors = load_actors(ids)
+    check_actors(actors, ttl, policy)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if '--daemon' in sys.argv:
+        run_daemon()
+    else:
+        main()
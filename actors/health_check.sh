@@ -1,13 +1,9 @@
 #!/bin/bash
 #
-# Entrypoint for a health check worker process. Runs every ten minutes
+# Entrypoint for a health check worker process. Runs health.py as a daemon, which checks every health_interval
+# seconds (see the workers section of the config).
 
 # give initial processes some time to launch
 sleep 120
 
-# main loop runs every 10 minutes
-while :
-do
-    python3 -u /actors/health.py
-    sleep 600
-done
\ No newline at end of file
+exec python3 -u /actors/health.py --daemon
@@ -0,0 +1,148 @@
+# Migrates data persisted by earlier versions of abaco to the current storage layouts. Each migration is
+# idempotent, so it is safe to run this module more than once. Run it before starting upgraded services.
+#
+# Execute from a container as follows:
+# docker run -it --rm -v $(pwd)/abaco.conf:/etc/service.conf abaco/core python3 -u /actors/migrations.py
+
+import json
+import time
+
+from audit import audit_user_actors
+from models import Execution, ExecutionsSummary
+from stores import actors_store, executions_store, summaries_store, workers_store
+
+from agaveflask.logs import get_logger
+logger = get_logger(__name__)
+
+
+def migrate_executions():
+    """
+    Split the legacy executions documents, which held every execution of an actor in a single document keyed
+    by the actor's dbid, into one document per execution. Returns the number of executions migrated.
+    """
+    logger.info("Top of migrate_executions().")
+    total = 0
+    # legacy documents do not have the top level actor_id field used to index the new documents.
+    for actor_id, executions in list(executions_store.find(actor_id=None)):
+        for execution_id, execution in executions.items():
+            executions_store.set_with_fields(Execution.get_dbid(actor_id, execution_id),
+                                             execution,
+                                             Execution.get_index_fields(actor_id, execution_id))
+        # only remove the legacy document once all of its executions have been written.
+        del executions_store[actor_id]
+        logger.info("Migrated {} executions for actor: {}".format(len(executions), actor_id))
+        total += len(executions)
+    return total
+
+
+def index_execution_times():
+    """
+    Add the create_time field, by which the executions of an actor are paged, to the documents of executions
+    recorded before it was introduced. Returns the number of executions indexed.
+    """
+    logger.info("Top of index_execution_times().")
+    total = 0
+    for key, execution in list(executions_store.find(create_time=None)):
+        # legacy documents, which hold all of the executions of an actor, are split by migrate_executions().
+        if 'actor_id' not in execution or 'id' not in execution:
+            continue
+        executions_store.set_with_fields(key, execution,
+                                         Execution.get_index_fields(execution['actor_id'], execution['id']))
+        total += 1
+    return total
+
+
+def migrate_execution_summaries():
+    """
+    Compute the running execution totals for actors that do not have them yet. This migration should be run
+    after migrate_executions() and before the upgraded web APIs and workers start recording new executions.
+    Returns the number of actors migrated.
+    """
+    logger.info("Top of migrate_execution_summaries().")
+    total = 0
+    for actor_id in actors_store:
+        # keys are returned from redis as bytes
+        actor_id = actor_id.decode('utf-8')
+        try:
+            summaries_store[actor_id]
+            continue
+        except KeyError:
+            pass
+        summaries_store[actor_id] = ExecutionsSummary.compute_totals(actor_id)
+        logger.info("Computed execution totals for actor: {}".format(actor_id))
+        total += 1
+    return total
+
+
+# key, in the summaries_store, of the record of the reset of the resource usage totals (see reset_usage_totals).
+USAGE_UNITS_KEY = '_usage_units'
+
+
+def reset_usage_totals():
+    """
+    Reset the cpu, io and runtime totals of every actor, keeping the number of executions. Executions recorded by
+    earlier versions of abaco report cpu and io as sums of samples of docker's cumulative counters (cpu nanoseconds
+    and bytes received over the network) and runtime in seconds, so totals that include them cannot be added to
+    those of executions reporting user jiffies, 512-byte sectors and milliseconds. The totals are only reset once;
+    the time of the reset is kept in the summaries_store.
+    Returns the number of actors reset, or 0 if the totals were already reset.
+    """
+    logger.info("Top of reset_usage_totals().")
+    try:
+        summaries_store[USAGE_UNITS_KEY]
+        return 0
+    except KeyError:
+        pass
+    total = 0
+    for actor_id in actors_store:
+        actor_id = actor_id.decode('utf-8')
+        try:
+            summary = summaries_store[actor_id]
+        except KeyError:
+            continue
+        summaries_store[actor_id] = {'total_executions': summary.get('total_executions', 0),
+                                     'total_cpu': 0,
+                                     'total_io': 0,
+                                     'total_runtime': 0}
+        total += 1
+    summaries_store[USAGE_UNITS_KEY] = {'reset_time': time.time()}
+    return total
+
+
+def migrate_workers():
+    """
+    Convert the legacy workers records, which held all of the workers of an actor in a single JSON-encoded string,
+    into redis hashes with one field per worker. Returns the number of actors migrated.
+    """
+    logger.info("Top of migrate_workers().")
+    total = 0
+    for actor_id in workers_store:
+        if not workers_store._db.type(actor_id) == b'string':
+            continue
+        workers = json.loads(workers_store._db.get(actor_id).decode('utf-8'))
+        # replaces the string with a hash in a single transaction.
+        workers_store[actor_id] = workers
+        logger.info("Migrated {} workers for actor: {}".format(len(workers), actor_id))
+        total += 1
+    return total
+
+
+def main():
+    logger.info("Running abaco migrations. Now: {}".format(time.time()))
+    total = migrate_executions()
+    logger.info("Executions migration complete. Migrated {} executions.".format(total))
+    total = index_execution_times()
+    logger.info("Execution times migration complete. Indexed {} executions.".format(total))
+    total = migrate_execution_summaries()
+    logger.info("Execution summaries migration complete. Migrated {} actors.".format(total))
+    total = reset_usage_totals()
+    logger.info("Usage totals reset complete. Reset {} actors.".format(total))
+    total = migrate_workers()
+    logger.info("Workers migration complete. Migrated {} actors.".format(total))
+    # the per-user index of actors is built by auditing it against the permissions_store.
+    result = audit_user_actors()
+    logger.info("User actors index migration complete. Result: {}".format(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import configparser
 from copy import deepcopy
 import json
 import time
@@ -5,17 +6,23 @@ import uuid
 
 from agaveflask.utils import RequestParser
 
+import cache
 from channels import CommandChannel
-from codes import REQUESTED, SUBMITTED
+from codes import BUSY, DEFAULT_HEARTBEAT_INTERVAL, HEARTBEAT_MISSES, READY, REQUESTED, SUBMITTED
 from config import Config
 import errors
 
-from stores import actors_store, clients_store, executions_store, logs_store, permissions_store, workers_store
+from stores import actors_store, clients_store, executions_store, heartbeats_store, logs_store, pending_store, \
+    permissions_store, summaries_store, user_actors_store, workers_store
 
 from agaveflask.logs import get_logger
 logger = get_logger(__name__)
 
 
+# the time of the uuid1 epoch (1582-10-15), in 100 nanosecond intervals before the unix epoch.
+UUID1_EPOCH = 0x01b21dd213814000
+
+
 def under_to_camel(value):
     def camel_case():
         yield type(value).lower
@@ -150,6 +157,13 @@ class Actor(AbacoDAO):
         ('status_message', 'optional', 'status_message', str, 'Explanation of status.', ''),
         ('executions', 'optional', 'executions', dict, 'Executions for this actor.', {}),
         ('state', 'optional', 'state', dict, "Current state for this actor.", {}),
+        ('min_workers', 'optional', 'min_workers', int,
+         'Minimum number of workers kept for this actor when it is stateless. Defaults to the configured value.', None),
+        ('max_workers', 'optional', 'max_workers', int,
+         'Maximum number of workers started for this actor when it is stateless. Defaults to the configured value.',
+         None),
+        ('max_concurrency', 'optional', 'max_concurrency', int,
+         'Maximum number of executions each worker runs at once. Values above 1 require a stateless actor.', 1),
 
         ('tenant', 'provided', 'tenant', str, 'The tenant that this actor belongs to.', None),
         ('api_server', 'provided', 'api_server', str, 'The base URL for the tenant that this actor belongs to.', None),
@@ -224,11 +238,20 @@ class Actor(AbacoDAO):
                        tenant=self.tenant,
                        num=1,
                        stop_existing=False)
+            ch.close()
             return worker_ids
         else:
             logger.debug("Actor.ensure_one_worker() returning None.")
             return None
 
+    @classmethod
+    def get_actor(cls, db_id):
+        """
+        Return the actor with dbid `db_id`, from the cache of the current process when possible. Raises KeyError if
+        the actor does not exist. Read the actors_store directly when the actor will be modified and written back.
+        """
+        return cls.from_db(deepcopy(cache.get_cache(cache.ACTORS).get(db_id, actors_store.__getitem__)))
+
     @classmethod
     def get_dbid(cls, tenant, id):
         """Return the key used in redis from the "display_id" and tenant. """
@@ -246,9 +269,11 @@ class Actor(AbacoDAO):
     def set_status(cls, actor_id, status, status_message=None):
         """Update the status of an actor"""
         logger.debug("top of set_status for status: {}".format(status))
-        actors_store.update(actor_id, 'status', status)
+        fields = {'status': status}
         if status_message:
-            actors_store.update(actor_id, 'status_message', status_message)
+            fields['status_message'] = status_message
+        actors_store.update_fields(actor_id, fields)
+        cache.invalidate(cache.ACTORS, actor_id)
 
 
 class Execution(AbacoDAO):
@@ -296,15 +321,80 @@ class Execution(AbacoDAO):
                    'api_server': actor['api_server']
                    })
         execution = Execution(**ex)
-
-        try:
-            executions_store.update(actor_id, execution.id, execution)
-        except KeyError:
-            # if actor has no executions, a KeyError will be thrown
-            executions_store[actor_id] = {execution.id: execution}
+        # each execution is stored in its own document, indexed by the actor's dbid and the time it was created.
+        executions_store.set_with_fields(Execution.get_dbid(actor_id, execution.id),
+                                         execution,
+                                         Execution.get_index_fields(actor_id, execution.id))
+        summaries_store.increment(actor_id, {'total_executions': 1,
+                                             'total_cpu': int(execution.cpu),
+                                             'total_io': int(execution.io),
+                                             'total_runtime': int(execution.runtime)})
         logger.info("Execution: {} saved for actor: {}.".format(ex, actor_id))
         return execution.id
 
+    @classmethod
+    def add_executions(cls, actor_id, exs):
+        """
+        Add several executions to an actor with one write to the executions_store and one to the summaries_store.
+        :param actor_id: str; the dbid of the actor
+        :param exs: list of dicts describing the executions.
+        :return: the list of ids of the new executions, in the same order.
+        """
+        logger.debug("top of add_executions for actor: {}. number of executions: {}".format(actor_id, len(exs)))
+        actor = Actor.get_actor(actor_id)
+        executions = []
+        for ex in exs:
+            ex.update({'actor_id': actor_id,
+                       'tenant': actor.tenant,
+                       'api_server': actor['api_server']
+                       })
+            executions.append(Execution(**ex))
+        executions_store.insert_many_with_fields([(Execution.get_dbid(actor_id, execution.id),
+                                                   execution,
+                                                   Execution.get_index_fields(actor_id, execution.id))
+                                                  for execution in executions])
+        summaries_store.increment(actor_id, {'total_executions': len(executions),
+                                             'total_cpu': sum(int(e.cpu) for e in executions),
+                                             'total_io': sum(int(e.io) for e in executions),
+                                             'total_runtime': sum(int(e.runtime) for e in executions)})
+        logger.info("{} executions saved for actor: {}.".format(len(executions), actor_id))
+        return [execution.id for execution in executions]
+
+    @classmethod
+    def add_pending(cls, actor_id, execution_ids):
+        """
+        Record that the messages for `execution_ids` are being sent to the actor's inbox, so that the age of the
+        oldest waiting message can be reported without reading the inbox. Call before sending the messages;
+        add_worker_id removes them once a worker takes them. Pass db_id as `actor_id` parameter.
+        """
+        now = time.time()
+        pending_store.scored_add(actor_id, {execution_id: now for execution_id in execution_ids})
+
+    @classmethod
+    def remove_pending(cls, actor_id, execution_ids):
+        """Remove messages recorded with add_pending, e.g. when sending them failed."""
+        pending_store.scored_remove(actor_id, *execution_ids)
+
+    @classmethod
+    def clear_pending(cls, actor_ids, before):
+        """
+        Remove the messages recorded with add_pending before the time `before` for each of the actors `actor_ids`,
+        whose inboxes have been found empty. These messages were taken by workers that died before recording it (see
+        add_worker_id), and would otherwise be reported as waiting until the actor is deleted.
+        """
+        pending_store.scored_trim(actor_ids, before)
+
+    @classmethod
+    def oldest_pending_age(cls, actor_id):
+        """
+        Return the number of seconds the oldest message waiting in the actor's inbox has been waiting, or None if no
+        messages are waiting. Pass db_id as `actor_id` parameter.
+        """
+        first = pending_store.scored_first(actor_id)
+        if first is None:
+            return None
+        return max(time.time() - first[1], 0)
+
     @classmethod
     def add_worker_id(cls, actor_id, execution_id, worker_id):
         """
@@ -316,7 +406,9 @@ class Execution(AbacoDAO):
         logger.debug("top of add_worker_id() for actor: {} execution: {} worker: {}".format(
             actor_id, execution_id, worker_id))
         try:
-            executions_store.update_subfield(actor_id, execution_id, 'worker_id', worker_id)
+            # the message has left the inbox.
+            pending_store.scored_remove(actor_id, execution_id)
+            executions_store.update(Execution.get_dbid(actor_id, execution_id), 'worker_id', worker_id)
             logger.debug("worker added to execution: {} actor: {} worker: {}".format(
             execution_id, actor_id, worker_id))
         except KeyError as e:
@@ -347,16 +439,57 @@ class Execution(AbacoDAO):
         if not 'runtime' in stats:
             logger.error("Could not finalize execution. runtime missing. Params: {}".format(params_str))
             raise errors.ExecutionException("'runtime' parameter required to finalize execution.")
+        key = Execution.get_dbid(actor_id, execution_id)
         try:
-            executions_store.update_subfield(actor_id, execution_id, 'status', status)
-            executions_store.update_subfield(actor_id, execution_id, 'io', stats['io'])
-            executions_store.update_subfield(actor_id, execution_id, 'cpu', stats['cpu'])
-            executions_store.update_subfield(actor_id, execution_id, 'runtime', stats['runtime'])
-            executions_store.update_subfield(actor_id, execution_id, 'final_state', final_state)
-            executions_store.update_subfield(actor_id, execution_id, 'exit_code', exit_code)
+            executions_store.update_fields(key, {'status': status,
+                                                 'io': stats['io'],
+                                                 'cpu': stats['cpu'],
+                                                 'runtime': stats['runtime'],
+                                                 'final_state': final_state,
+                                                 'exit_code': exit_code})
         except KeyError:
             logger.error("Could not finalize execution. execution not found. Params: {}".format(params_str))
             raise errors.ExecutionException("Execution {} not found.".format(execution_id))
+        # executions are finalized once, starting from the zero stats they were submitted with, so the final
+        # stats can be added directly to the actor's totals.
+        summaries_store.increment(actor_id, {'total_cpu': int(stats['cpu']),
+                                             'total_io': int(stats['io']),
+                                             'total_runtime': int(stats['runtime'])})
+
+    @classmethod
+    def get_dbid(cls, actor_id, execution_id):
+        """Return the key used in the executions store from the actor's dbid and the execution id."""
+        return str('{}_{}'.format(actor_id, execution_id))
+
+    @classmethod
+    def get_create_time(cls, execution_id):
+        """
+        Return the time, in seconds since the epoch, at which the execution id was generated, from the uuid1 it
+        starts with. Raises ValueError if `execution_id` is not an execution id.
+        """
+        id = uuid.UUID(execution_id[:36])
+        if not id.version == 1:
+            raise ValueError('"{}" is not an execution id.'.format(execution_id))
+        return (id.time - UUID1_EPOCH) / 10**7
+
+    @classmethod
+    def get_index_fields(cls, actor_id, execution_id):
+        """
+        Return the fields stored at the top level of the document of an execution, which index the executions of an
+        actor in the order they were created (see ExecutionsSummary.compute_summary_stats).
+        """
+        return {'actor_id': actor_id, 'id': execution_id, 'create_time': cls.get_create_time(execution_id)}
+
+    @classmethod
+    def get_execution(cls, actor_id, execution_id):
+        """Retrieve a single execution. Pass db_id as `actor_id` parameter."""
+        return Execution.from_db(executions_store[Execution.get_dbid(actor_id, execution_id)])
+
+    @classmethod
+    def get_executions(cls, actor_id):
+        """Iterate over all executions for an actor. Pass db_id as `actor_id` parameter."""
+        for _, val in executions_store.find(actor_id=actor_id):
+            yield Execution.from_db(val)
 
     @classmethod
     def set_logs(cls, exc_id, logs):
@@ -406,7 +539,11 @@ class ExecutionsSummary(AbacoDAO):
         ('api_server', 'derived', 'api_server', str, 'Base URL for the tenant that associated actor belongs to.', None),
         ('actor_id', 'derived', 'actor_id', str, 'id for the actor.', None),
         ('owner', 'provided', 'owner', str, 'The user who created the associated actor.', None),
-        ('ids', 'derived', 'ids', list, 'List of all execution ids.', None),
+        ('limit', 'optional', 'limit', int, 'Maximum number of execution ids to return.', 0),
+        ('cursor', 'optional', 'cursor', str, 'Return the execution ids following this execution id.', None),
+        ('ids', 'derived', 'ids', list, 'List of execution ids, in pages of at most `limit` ids.', None),
+        ('next_cursor', 'derived', 'next_cursor', str,
+         'Cursor for retrieving the next page of execution ids; null on the last page.', None),
         ('total_executions', 'derived', 'total_executions', str, 'Total number of execution.', None),
         ('total_io', 'derived', 'total_io', str,
          'Block I/O usage, in number of 512-byte sectors read from and written to, by all executions.', None),
@@ -414,7 +551,21 @@ class ExecutionsSummary(AbacoDAO):
         ('total_cpu', 'derived', 'total_cpu', str, 'CPU usage, in user jiffies, of all execution.', None),
         ]
 
-    def compute_summary_stats(self, dbid):
+    @classmethod
+    def compute_totals(cls, dbid):
+        """Compute the totals for all executions of an actor by reading every execution."""
+        tot = {'total_executions': 0,
+               'total_cpu': 0,
+               'total_io': 0,
+               'total_runtime': 0}
+        for _, val in executions_store.find(actor_id=dbid):
+            tot['total_executions'] += 1
+            tot['total_cpu'] += int(val['cpu'])
+            tot['total_io'] += int(val['io'])
+            tot['total_runtime'] += int(val['runtime'])
+        return tot
+
+    def compute_summary_stats(self, dbid, limit=0, cursor=None):
         try:
             actor = actors_store[dbid]
         except KeyError:
@@ -427,34 +578,38 @@ class ExecutionsSummary(AbacoDAO):
                'total_cpu': 0,
                'total_io': 0,
                'total_runtime': 0,
-               'ids': []}
+               'ids': [],
+               'next_cursor': None}
+        # the totals are maintained by add_execution and finalize_execution
         try:
-            executions = executions_store[dbid]
+            tot.update(summaries_store[dbid])
         except KeyError:
-            executions = {}
-        for id, val in executions.items():
-            tot['ids'].append(id)
-            tot['total_executions'] += 1
-            tot['total_cpu'] += int(val['cpu'])
-            tot['total_io'] += int(val['io'])
-            tot['total_runtime'] += int(val['runtime'])
+            # if actor has no executions, a KeyError will be thrown
+            pass
+        # execution ids start with a uuid1, so they do not sort in the order the executions were created; the
+        # executions are paged in the order of their create_time, with the id breaking ties. the cursor is the id of
+        # the last execution of the previous page, from which its create_time is recovered.
+        if cursor:
+            cursor = [Execution.get_create_time(cursor), cursor]
+        page, next_cursor = executions_store.find_page(['create_time', 'id'], cursor=cursor, limit=limit,
+                                                       actor_id=dbid)
+        tot['ids'] = [val['id'] for _, val in page]
+        tot['next_cursor'] = next_cursor[-1] if next_cursor else None
         return tot
 
     def get_derived_value(self, name, d):
         """Compute a derived value for the attribute `name` from the dictionary d of attributes provided."""
-        # first, see if the attribute is already in the object:
-        try:
-            if d[name]:
-                return d[name]
-        except KeyError:
-            pass
+        # first, see if the attribute was already computed; zero totals and empty pages are valid values, so
+        # check for the key rather than its truthiness:
+        if name in d:
+            return d[name]
         # if not, compute and store all values, returning the one requested:
         try:
             dbid = d['db_id']
         except KeyError:
             logger.error("db_id missing from call to get_derived_value. d: {}".format(d))
             raise errors.ExecutionException('db_id is required.')
-        tot = self.compute_summary_stats(dbid)
+        tot = self.compute_summary_stats(dbid, limit=d.get('limit') or 0, cursor=d.get('cursor'))
         d.update(tot)
         return tot[name]
 
@@ -466,9 +621,33 @@ class ExecutionsSummary(AbacoDAO):
     def display(self):
         self.update(self.get_hypermedia())
         self.pop('db_id')
+        self.pop('limit')
+        self.pop('cursor')
         return self.case()
 
 
+# the redis pub/sub channel on which changes to the workers of an actor are announced, so that the health daemons
+# (health.py --daemon) only re-read the workers that changed.
+WORKER_EVENTS_CHANNEL = 'abaco_worker_events'
+
+
+def publish_worker_event(actor_id):
+    """Announce a change to the workers of an actor. Pass db_id as `actor_id` parameter."""
+    try:
+        workers_store.publish(WORKER_EVENTS_CHANNEL, {'actor_id': actor_id})
+    except Exception as e:
+        # the health daemons periodically re-read all workers, so a lost event only delays the change.
+        logger.error("Could not publish worker event for actor: {}. Exception: {}".format(actor_id, e))
+
+
+def get_heartbeat_interval():
+    """Return the configured number of seconds between the heartbeats of a worker."""
+    try:
+        return int(Config.get('workers', 'heartbeat_interval'))
+    except (configparser.NoOptionError, ValueError):
+        return DEFAULT_HEARTBEAT_INTERVAL
+
+
 class Worker(AbacoDAO):
     """Basic data access object for working with Workers."""
 
@@ -486,6 +665,9 @@ class Worker(AbacoDAO):
         ('host_id', 'required', 'host_id', str, 'id of the host where worker is running.', None),
         ('host_ip', 'required', 'host_ip', str, 'ip of the host where worker is running.', None),
         ('last_execution', 'required', 'last_execution', str, 'Last time the worker executed an actor container.', None),
+        ('create_time', 'optional', 'create_time', str, 'Time the worker was requested.', None),
+        ('active', 'optional', 'active', int, 'Number of executions the worker is running.', None),
+        ('idle', 'optional', 'idle', int, 'Number of additional executions the worker can run at once.', None),
         ]
 
     @classmethod
@@ -502,6 +684,14 @@ class Worker(AbacoDAO):
         except KeyError:
             return {}
 
+    @classmethod
+    def get_workers_batch(cls, actor_ids):
+        """
+        Retrieve all workers for each of the actors in `actor_ids`, in one round trip. Returns a list of the workers
+        of each actor, in the same order. Pass db_ids as `actor_ids` parameter.
+        """
+        return [workers or {} for workers in workers_store.mget(actor_ids)]
+
     @classmethod
     def get_worker(cls, actor_id, worker_id):
         """Retrieve a worker from the workers store. Pass db_id as `actor_id` parameter."""
@@ -520,6 +710,7 @@ class Worker(AbacoDAO):
         try:
             wk = workers_store.pop_field(actor_id, worker_id)
             logger.info("worker deleted. actor: {}. worker: {}.".format(actor_id, worker_id))
+            publish_worker_event(actor_id)
         except KeyError as e:
             logger.info("KeyError deleting worker. actor: {}. worker: {}. exception: {}".format(actor_id, worker_id, e))
             raise errors.WorkerException("Worker not found.")
@@ -533,10 +724,11 @@ class Worker(AbacoDAO):
         """
         logger.debug("top of ensure_one_worker.")
         worker_id = Worker.get_uuid()
-        worker = {'status': REQUESTED, 'id': worker_id}
+        worker = {'status': REQUESTED, 'id': worker_id, 'create_time': round(time.time(), 3)}
         val = workers_store.add_if_empty(actor_id, worker_id, worker)
         if val:
             logger.info("got worker: {} from add_if_empty.".format(val))
+            publish_worker_event(actor_id)
             return worker_id
         else:
             logger.debug("did not get worker from add_if_empty.")
@@ -550,17 +742,12 @@ class Worker(AbacoDAO):
         """
         logger.debug("top of request_worker().")
         worker_id = Worker.get_uuid()
-        worker = {'status': REQUESTED, 'id': worker_id}
-        # it's possible the actor_id is not in the workers_store yet (i.e., new actor with no workers)
-        # In that case we need to catch a KeyError:
-        try:
-            # we know this worker_id is new since we just generated it, so we don't need to use
-            # workers_store.update()
-            workers_store[actor_id][worker_id] = worker
-            logger.info("added additional worker with id: {} to workers_store.".format(worker_id))
-        except KeyError:
-            workers_store[actor_id] = {worker_id: worker}
-            logger.info("added first worker with id: {} to workers_store.".format(worker_id))
+        worker = {'status': REQUESTED, 'id': worker_id, 'create_time': round(time.time(), 3)}
+        # this also creates the actor's collection of workers if it is not in the workers_store yet (i.e., new
+        # actor with no workers).
+        workers_store.update(actor_id, worker_id, worker)
+        logger.info("added worker with id: {} to workers_store.".format(worker_id))
+        publish_worker_event(actor_id)
         return worker_id
 
     @classmethod
@@ -574,15 +761,18 @@ class Worker(AbacoDAO):
         logger.debug("top of add_worker().")
         workers_store.update(actor_id, worker['id'], worker)
         logger.info("worker {} added to actor: {}".format(worker, actor_id))
+        publish_worker_event(actor_id)
 
     @classmethod
     def update_worker_execution_time(cls, actor_id, worker_id):
         """Pass db_id as `actor_id` parameter."""
         logger.debug("top of update_worker_execution_time().")
-        now = time.time()
-        workers_store.update_subfield(actor_id, worker_id, 'last_execution', now)
-        workers_store.update_subfield(actor_id, worker_id, 'last_update', now)
+        # millisecond precision keeps the timestamp exactly representable by the workers_store's Lua scripts.
+        now = round(time.time(), 3)
+        workers_store.update_fields(actor_id, {'{}.last_execution'.format(worker_id): now,
+                                               '{}.last_update'.format(worker_id): now})
         logger.info("worker execution time updated. worker_id: {}".format(worker_id))
+        publish_worker_event(actor_id)
 
     @classmethod
     def update_worker_status(cls, actor_id, worker_id, status):
@@ -590,6 +780,39 @@ class Worker(AbacoDAO):
         logger.debug("top of update_worker_status().")
         workers_store.update_subfield(actor_id, worker_id, 'status', status)
         logger.info("worker status updated to: {}. worker_id: {}".format(status, worker_id))
+        publish_worker_event(actor_id)
+
+    @classmethod
+    def update_worker_activity(cls, actor_id, worker_id, active, idle):
+        """
+        Record the number of executions a worker is running (`active`) and the number it has room for (`idle`). The
+        worker is BUSY while it runs at least one execution. Pass db_id as `actor_id` parameter.
+        """
+        logger.debug("top of update_worker_activity().")
+        status = BUSY if active else READY
+        # one atomic write, which raises KeyError rather than recreating the worker if it has been deleted.
+        workers_store.update_fields(actor_id, {'{}.status'.format(worker_id): status,
+                                               '{}.active'.format(worker_id): active,
+                                               '{}.idle'.format(worker_id): idle})
+        logger.info("worker status updated to: {} ({} active, {} idle). worker_id: {}".format(
+            status, active, idle, worker_id))
+        publish_worker_event(actor_id)
+
+    @classmethod
+    def heartbeat(cls, worker_id):
+        """
+        Record that a worker is alive. The record expires once the worker has missed HEARTBEAT_MISSES heartbeats.
+        """
+        heartbeats_store.set_with_expiry(worker_id, round(time.time(), 3),
+                                         ex=get_heartbeat_interval() * HEARTBEAT_MISSES)
+
+    @classmethod
+    def get_heartbeats(cls, worker_ids):
+        """
+        Return a dictionary mapping each of the worker ids in `worker_ids` to the time of its last heartbeat, or to
+        None if the worker is no longer alive, in one round trip.
+        """
+        return dict(zip(worker_ids, heartbeats_store.mget(worker_ids)))
 
     def get_uuid_code(self):
         """ Return the Agave code for this object.
@@ -650,6 +873,10 @@ def get_permissions(actor_id):
     except KeyError:
         raise errors.PermissionsException("Actor {} does not exist".format(actor_id))
 
+def get_cached_permissions(actor_id):
+    """Return all permissions for an actor, from the cache of the current process when possible."""
+    return cache.get_cache(cache.PERMISSIONS).get(actor_id, get_permissions)
+
 def add_permission(user, actor_id, level):
     """Add a permission for a user and level to an actor."""
     logger.debug("top of add_permission().")
@@ -664,4 +891,36 @@ def add_permission(user, actor_id, level):
     permissions.append({'user': user,
                         'level': level})
     logger.info("permission: {} added for user: {} and actor: {}".format(level, user, actor_id))
-    permissions_store[actor_id] = json.dumps(permissions)
\ No newline at end of file
+    permissions_store[actor_id] = json.dumps(permissions)
+    cache.invalidate(cache.PERMISSIONS, actor_id)
+    tenant = actors_store[actor_id]['tenant']
+    index_user_permissions(user, actor_id, tenant, permissions)
+
+def delete_permissions(actor_id):
+    """Delete all permissions for an actor, including its entries in the per-user index of actors."""
+    del permissions_store[actor_id]
+    cache.invalidate(cache.PERMISSIONS, actor_id)
+    user_actors_store.delete_many(actor_id=actor_id)
+
+def get_user_actors_key(user, actor_id):
+    """Return the key used in the per-user index of actors from the user and the actor's dbid."""
+    return str('{}_{}'.format(user, actor_id))
+
+def index_user_permissions(user, actor_id, tenant, permissions):
+    """
+    Record the permissions `user` holds for an actor in the per-user index of actors, replacing any previous entry.
+    :param permissions: the complete list of permissions for the actor, as returned by get_permissions.
+    """
+    user_pems = [pem for pem in permissions if pem.get('user') == user]
+    user_actors_store.set_with_fields(get_user_actors_key(user, actor_id),
+                                      {'actor_id': actor_id, 'permissions': user_pems},
+                                      {'tenant': tenant, 'user': user, 'actor_id': actor_id})
+
+def get_user_actors(tenant, user, cursor=None, limit=0):
+    """
+    Return a page of the entries in the per-user index of actors for a user in a tenant, ordered by actor dbid,
+    together with the cursor for the next page. Each entry is a dictionary with the actor's dbid (`actor_id`) and the
+    list of `permissions` the user holds for the actor.
+    """
+    page, next_cursor = user_actors_store.find_page('actor_id', cursor=cursor, limit=limit, tenant=tenant, user=user)
+    return [entry for _, entry in page], next_cursor
\ No newline at end of file
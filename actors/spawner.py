@@ -7,7 +7,7 @@ import rabbitpy
 from codes import ERROR
 from config import Config
 from docker_utils import DockerError, run_worker
-from models import Actor, Worker
+from models import Actor, Worker, publish_worker_event
 from stores import workers_store
 from channels import ActorMsgChannel, ClientsChannel, CommandChannel, WorkerChannel
 
@@ -57,6 +57,7 @@ class Spawner(object):
                 if worker['id'] not in worker_ids:
                     ch = WorkerChannel(name=worker['ch_name'])
                     ch.put('stop')
+                    ch.close()
                     logger.info("Sent 'stop' message to worker channel: {}".format(ch))
         else:
             logger.info("No workers to stop.")
@@ -103,6 +104,7 @@ class Spawner(object):
             # be equal to the new_workers.
             workers_store[actor_id] = new_workers
             logger.info("workers_store set to new_workers: {}.".format(new_workers))
+            publish_worker_event(actor_id)
 
         # Tell new worker to subscribe to the actor channel.
         # If abaco is configured to generate clients for the workers, generate them now
@@ -120,6 +122,7 @@ class Spawner(object):
                                                       # of list(ner_workers) should be the key.
                                                       worker_id=new_workers[list(new_workers)[idx]]['id'],
                                                       secret=self.secret)
+                client_ch.close()
                 # we need to ignore errors when generating clients because it's possible it is not set up for a specific
                 # tenant. we log it instead.
                 if client_msg.get('status') == 'error':
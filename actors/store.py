@@ -4,26 +4,145 @@ from datetime import datetime
 import json
 
 import configparser
+import os
+import threading
+
 import redis
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, errors
 
 from config import Config
 
+# optional library for the msgpack serializer (see the redis_serializer config).
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Values in the redis stores are serialized as JSON, or optionally as msgpack (see the redis_serializer config).
+# msgpack values are prefixed with a marker that cannot start a JSON document: a zero byte followed by the version of
+# the format. Values without the marker, including all values written by earlier versions, are decoded as JSON.
+MSGPACK_MARKER = b'\x00\x01'
+
+
+def dumps_json(value):
+    """Serialize `value` as JSON bytes."""
+    return json.dumps(value).encode('utf-8')
+
+
+def loads_json(obj):
+    return json.loads(obj.decode('utf-8'))
+
 
 def _do_get(getter, key):
     obj = getter(key)
     if obj is None:
         raise KeyError('"{}" not found'.format(key))
+    return _do_decode(obj)
+
+
+def _do_decode(obj):
+    if obj.startswith(MSGPACK_MARKER):
+        if msgpack is None:
+            raise RuntimeError("msgpack must be installed to read values serialized with msgpack.")
+        return msgpack.unpackb(obj[len(MSGPACK_MARKER):], raw=False)
     try:
-        return json.loads(obj.decode('utf-8'))
+        return loads_json(obj)
     # handle non-JSON data
     except ValueError:
         return obj.decode('utf-8')
 
 
-def _do_set(setter, key, value):
-    obj = json.dumps(value)
-    setter(key, obj.encode('utf-8'))
+def _do_encode(value, serializer='json'):
+    if serializer == 'msgpack':
+        try:
+            return MSGPACK_MARKER + msgpack.packb(value, use_bin_type=True)
+        # msgpack does not support integers beyond 64 bits.
+        except (OverflowError, TypeError):
+            pass
+    return dumps_json(value)
+
+
+def _do_set(setter, key, value, serializer='json'):
+    setter(key, _do_encode(value, serializer))
+
+def _set_path(doc, path, value):
+    """Set the value at the dotted `path` within the nested dictionary `doc`, creating missing dictionaries."""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+        if not isinstance(doc, dict):
+            raise KeyError('"{}" is not a dictionary'.format(part))
+    doc[parts[-1]] = value
+
+def _check_paths(paths):
+    """
+    Raise ValueError if one of the dotted `paths` is equal to, or runs through, another; the result of updating both
+    in one call would depend on the order in which they are applied (and Mongo rejects such updates).
+    """
+    paths = set(paths)
+    for path in paths:
+        parts = path.split('.')
+        for i in range(1, len(parts)):
+            prefix = '.'.join(parts[:i])
+            if prefix in paths:
+                raise ValueError('overlapping paths: "{}" and "{}"'.format(prefix, path))
+
+# Redis connection pools and Mongo clients shared by all of the stores in a process. They are created on first use
+# and are discarded in a child process after a fork (e.g., by gunicorn), since connections cannot be shared across
+# processes.
+_connections = {}
+_connections_pid = None
+_connections_lock = threading.Lock()
+
+
+def _store_option(option, default, cast=int):
+    """Return the value of `option` in the store section of the config, or `default` if it is missing or blank."""
+    try:
+        value = Config.get('store', option)
+    except configparser.NoOptionError:
+        return default
+    if not value:
+        return default
+    return cast(value)
+
+
+def _get_connection(key, create):
+    """Return the connection object under `key` for the current process, calling `create` to create it if needed."""
+    global _connections_pid
+    with _connections_lock:
+        if not _connections_pid == os.getpid():
+            _connections.clear()
+            _connections_pid = os.getpid()
+        if key not in _connections:
+            _connections[key] = create()
+        return _connections[key]
+
+
+def get_redis_pool(host, port, db):
+    """
+    Return the connection pool for the redis db `db` in the current process. Redis connections are bound to a
+    single db, so each db has its own pool, sized by the redis_max_connections config.
+    """
+    return _get_connection(('redis', host, port, str(db)), lambda: redis.ConnectionPool(
+        host=host,
+        port=port,
+        db=db,
+        max_connections=_store_option('redis_max_connections', None),
+        socket_connect_timeout=_store_option('redis_connect_timeout', None, float),
+        socket_timeout=_store_option('redis_socket_timeout', None, float)))
+
+
+def get_mongo_client(host, port):
+    """Return the mongo client, which maintains its own pool of connections, in the current process."""
+    return _get_connection(('mongo', host, port), lambda: MongoClient(
+        'mongodb://{}:{}'.format(host, port),
+        maxPoolSize=_store_option('mongo_max_pool_size', 100),
+        connectTimeoutMS=_store_option('mongo_connect_timeout', 20000),
+        socketTimeoutMS=_store_option('mongo_socket_timeout', None),
+        # connect on the first operation rather than in the background right away.
+        connect=False))
+
 
 class StoreMutexException(Exception):
     pass
@@ -53,6 +172,14 @@ class AbstractStore(collections.MutableMapping):
         """Set `key` to `obj` with automatic expiration of the configured seconds."""
         pass
 
+    def set_if_absent(self, key, obj, ex=None):
+        """Atomically set `key` to `obj`, expiring after `ex` seconds, unless `key` exists. Returns whether it was set."""
+        pass
+
+    def delete_if_equal(self, key, obj):
+        """Atomically delete `key` if its value is `obj`. Returns whether it was deleted."""
+        pass
+
     def update(self, key, field, value):
         "Atomic ``self[key][field] = value``."""
         pass
@@ -65,10 +192,23 @@ class AbstractStore(collections.MutableMapping):
         "Atomic ``self[key][field1][field2] = value``."""
         pass
 
+    def update_fields(self, key, fields):
+        """
+        Atomic ``self[key][path] = value`` for each path, value pair in the dictionary `fields`, where a path is
+        either a field or a dotted path to a field in nested dictionaries (e.g. ``'field1.field2'``). Missing
+        dictionaries along a path are created. Raises KeyError if `key` does not exist, and ValueError if a path runs
+        through another.
+        """
+        pass
+
     def getset(self, key, value):
         "Atomically: ``self[key] = value`` and return previous ``self[key]``."
         pass
 
+    def mget(self, keys):
+        """Return a list of the values for `keys`, in the same order, with None for missing keys, in one round trip."""
+        pass
+
     def mutex_acquire(self, key):
         """Try to use key as a mutex.
         Raise StoreMutexException if not available.
@@ -88,20 +228,244 @@ class AbstractTransactionalStore(AbstractStore):
         """Execute a callable, f, within a lock on key `key`."""
         pass
 
+# Lua function shared by the scripts below. cjson cannot represent every JSON document exactly: empty arrays decode
+# to the same table as empty objects and numbers are encoded with 14 significant digits. The scripts use `exact` to
+# check that a document survives the decode/encode round trip and never rewrite a document that does not; in that
+# case they return INEXACT and the store falls back to an optimistic (WATCH) transaction.
+EXACT = """
+local function exact(raw, obj)
+    if string.find(raw, '%[%s*%]') then
+        return false
+    end
+    local function check(v)
+        if type(v) == 'number' then
+            return tonumber(string.format('%.14g', v)) == v
+        elseif type(v) == 'table' then
+            for _, x in pairs(v) do
+                if not check(x) then
+                    return false
+                end
+            end
+        end
+        return true
+    end
+    return check(obj)
+end
+"""
+
+# Lua function that sets the value at a dotted path within a table, creating missing tables. returns false if the
+# path runs through a value that is not a table.
+SET_PATH = """
+local function set_path(doc, path, value)
+    local parts = {}
+    for part in string.gmatch(path, '[^.]+') do
+        table.insert(parts, part)
+    end
+    for i = 1, #parts - 1 do
+        if doc[parts[i]] == nil then
+            doc[parts[i]] = {}
+        end
+        doc = doc[parts[i]]
+        if type(doc) ~= 'table' then
+            return false
+        end
+    end
+    doc[parts[#parts]] = value
+    return true
+end
+"""
+
+# Lua function that checks whether a value was serialized with msgpack (see MSGPACK_MARKER). the scripts leave such
+# values to the optimistic transactions by returning INEXACT.
+PACKED = """
+local function packed(raw)
+    return string.byte(raw, 1) == 0
+end
+"""
+
+# return code of the scripts for documents that cjson cannot represent exactly.
+INEXACT = -1
+
+# number of times an optimistic (WATCH) transaction is attempted before giving up with a StoreMutexException.
+WATCH_RETRIES = 100
+
+
 class RedisStore(AbstractStore):
 
-    def __init__(self, host, port, db=0):
-        self._db = redis.StrictRedis(host=host, port=port, db=db)
+    # each script returns 1 on success, 0 if the key (or field) does not exist and INEXACT as described above.
+    UPDATE = EXACT + PACKED + """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then
+        return 0
+    end
+    if packed(raw) then
+        return -1
+    end
+    local cur = cjson.decode(raw)
+    local value = cjson.decode(ARGV[2])
+    if not (exact(raw, cur) and exact(ARGV[2], value)) then
+        return -1
+    end
+    cur[ARGV[1]] = value
+    redis.call('SET', KEYS[1], cjson.encode(cur))
+    return 1
+    """
+
+    # deletes the key if its (serialized) value is ARGV[1]; returns the number of keys deleted.
+    DELETE_IF_EQUAL = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    UPDATE_SUBFIELD = EXACT + PACKED + """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then
+        return 0
+    end
+    if packed(raw) then
+        return -1
+    end
+    local cur = cjson.decode(raw)
+    if type(cur[ARGV[1]]) ~= 'table' then
+        return 0
+    end
+    local value = cjson.decode(ARGV[3])
+    if not (exact(raw, cur) and exact(ARGV[3], value)) then
+        return -1
+    end
+    cur[ARGV[1]][ARGV[2]] = value
+    redis.call('SET', KEYS[1], cjson.encode(cur))
+    return 1
+    """
+
+    # ARGV[1] is the JSON-encoded dictionary of paths and values. nothing is written unless every path can be set.
+    UPDATE_FIELDS = EXACT + PACKED + SET_PATH + """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then
+        return 0
+    end
+    if packed(raw) then
+        return -1
+    end
+    local cur = cjson.decode(raw)
+    local fields = cjson.decode(ARGV[1])
+    if not (exact(raw, cur) and exact(ARGV[1], fields)) then
+        return -1
+    end
+    for path, value in pairs(fields) do
+        if not set_path(cur, path, value) then
+            return 0
+        end
+    end
+    redis.call('SET', KEYS[1], cjson.encode(cur))
+    return 1
+    """
+
+    # returns the return code followed by the JSON-encoded value of the field on success.
+    POP_FIELD = EXACT + PACKED + """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then
+        return {0}
+    end
+    if packed(raw) then
+        return {-1}
+    end
+    local cur = cjson.decode(raw)
+    local value = cur[ARGV[1]]
+    if value == nil then
+        return {0}
+    end
+    if not exact(raw, cur) then
+        return {-1}
+    end
+    cur[ARGV[1]] = nil
+    redis.call('SET', KEYS[1], cjson.encode(cur))
+    return {1, cjson.encode(value)}
+    """
+
+    # returns 0 without writing anything if the key exists and is not empty.
+    ADD_IF_EMPTY = EXACT + PACKED + """
+    local raw = redis.call('GET', KEYS[1])
+    local cur = {}
+    if raw then
+        if packed(raw) then
+            return -1
+        end
+        cur = cjson.decode(raw)
+        if not exact(raw, cur) then
+            return -1
+        end
+        if next(cur) ~= nil then
+            return 0
+        end
+    end
+    local value = cjson.decode(ARGV[2])
+    if not exact(ARGV[2], value) then
+        return -1
+    end
+    cur[ARGV[1]] = value
+    redis.call('SET', KEYS[1], cjson.encode(cur))
+    return 1
+    """
+
+    def __init__(self, host, port, db=0, serializer=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        # the format new values are written in; values in either format are always read.
+        self.serializer = serializer or _store_option('redis_serializer', 'json', str)
+        if self.serializer == 'msgpack' and msgpack is None:
+            raise RuntimeError("The msgpack redis_serializer requires msgpack to be installed.")
+        self._client = None
+        self._scripts = {}
         try:
             self.ex = int(Config.get('web', 'log_ex'))
         except ValueError:
             self.ex = -1
 
+    @property
+    def _db(self):
+        """The redis client for this store, created from the process's connection pool on first use."""
+        pool = get_redis_pool(self.host, self.port, self.db)
+        if self._client is None or self._client.connection_pool is not pool:
+            self._client = redis.StrictRedis(connection_pool=pool)
+            self._scripts = {}
+        return self._client
+
+    def _watch_transaction(self, func, key):
+        """
+        Execute ``func(pipe)`` in an optimistic transaction that watches `key`, as redis-py's transaction() does, and
+        return the value returned by func. Raises StoreMutexException if the key is modified by another client in
+        each of WATCH_RETRIES attempts.
+        """
+        with self._db.pipeline() as pipe:
+            for _ in range(WATCH_RETRIES):
+                try:
+                    pipe.watch(key)
+                    value = func(pipe)
+                    pipe.execute()
+                    return value
+                except redis.WatchError:
+                    continue
+        raise StoreMutexException('{} is busy; gave up after {} attempts.'.format(key, WATCH_RETRIES))
+
+    def _script(self, name):
+        """
+        Return the Lua script stored in the class attribute `name`. The scripts are loaded into redis on first use
+        and then executed by their SHA1 digest.
+        """
+        db = self._db
+        if name not in self._scripts:
+            self._scripts[name] = db.register_script(getattr(self, name))
+        return self._scripts[name]
+
     def __getitem__(self, key):
         return _do_get(self._db.get, key)
 
     def __setitem__(self, key, value):
-        _do_set(self._db.set, key, value)
+        _do_set(self._db.set, key, value, self.serializer)
 
     def __delitem__(self, key):
         self._db.delete(key)
@@ -112,71 +476,132 @@ class RedisStore(AbstractStore):
     def __len__(self):
         return self._db.dbsize()
 
-    def set_with_expiry(self, key, obj):
-        """Set `key` to `obj` with automatic expiration of `ex` seconds."""
-        self._db.set(key, obj, ex=self.ex)
+    def set_with_expiry(self, key, obj, ex=None):
+        """Set `key` to `obj` with automatic expiration of `ex` seconds, or the store's `ex` if not given."""
+        self._db.set(key, obj, ex=ex or self.ex)
+
+    def set_if_absent(self, key, obj, ex=None):
+        """Atomically set `key` to `obj`, expiring after `ex` seconds, unless `key` exists. Returns whether it was set."""
+        return bool(self._db.set(key, dumps_json(obj), ex=ex, nx=True))
+
+    def delete_if_equal(self, key, obj):
+        """Atomically delete `key` if its value is `obj`. Returns whether it was deleted."""
+        return bool(self._script('DELETE_IF_EQUAL')(keys=[key], args=[dumps_json(obj)]))
 
     def update(self, key, field, value):
         "Atomic ``self[key][field] = value``."""
+        result = self._script('UPDATE')(keys=[key], args=[field, dumps_json(value)])
+        if result == INEXACT:
+            self.watch_update(key, field, value)
+        elif not result:
+            raise KeyError('"{}" not found'.format(key))
+
+    def watch_update(self, key, field, value):
+        "Atomic ``self[key][field] = value`` using an optimistic transaction."""
 
         def _update(pipe):
             cur = _do_get(pipe.get, key)
             cur[field] = value
             pipe.multi()
-            _do_set(pipe.set, key, cur)
+            _do_set(pipe.set, key, cur, self.serializer)
 
-        self._db.transaction(_update, key)
+        self._watch_transaction(_update, key)
 
     def pop_field(self, key, field):
         "Atomic pop ``self[key][field]``."""
+        result = self._script('POP_FIELD')(keys=[key], args=[field])
+        if result[0] == INEXACT:
+            return self.watch_pop_field(key, field)
+        elif not result[0]:
+            raise KeyError('"{}" not found in "{}"'.format(field, key))
+        return _do_decode(result[1])
 
-        # Note: it is problematic to return items from within the _db.transaction() wrapper, as these
-        # We initially had the following implementation, but it did not work: the value returned was a list of
-        # results returned from the redis pipe (e.g. [True]) instead of the actual return value.
-        #     def _pop(pipe):
-        #         cur = _do_get(pipe.get, key)
-        #         value = cur.pop(field)
-        #         pipe.multi()
-        #         _do_set(pipe.set, key, cur)
-        #         return value
-        #
-        #     return self._db.transaction(_pop, key)
+    def watch_pop_field(self, key, field):
+        "Atomic pop ``self[key][field]`` using an optimistic transaction."""
 
-        with self._db.pipeline() as pipe:
-            while 1:
-                try:
-                    pipe.watch(key)
-                    cur = _do_get(pipe.get, key)
-                    value = cur.pop(field)
-                    _do_set(pipe.set, key, cur)
-                    pipe.execute()
-                    return value
-                except redis.WatchError:
-                    continue
+        def _pop(pipe):
+            cur = _do_get(pipe.get, key)
+            value = cur.pop(field)
+            pipe.multi()
+            _do_set(pipe.set, key, cur, self.serializer)
+            return value
+
+        return self._watch_transaction(_pop, key)
 
     def update_subfield(self, key, field1, field2, value):
         "Atomic ``self[key][field1][field2] = value``."""
+        result = self._script('UPDATE_SUBFIELD')(keys=[key], args=[field1, field2, dumps_json(value)])
+        if result == INEXACT:
+            self.watch_update_subfield(key, field1, field2, value)
+        elif not result:
+            raise KeyError('"{}" not found in "{}"'.format(field1, key))
+
+    def watch_update_subfield(self, key, field1, field2, value):
+        "Atomic ``self[key][field1][field2] = value`` using an optimistic transaction."""
 
         def _update(pipe):
             cur = _do_get(pipe.get, key)
             cur[field1][field2] = value
             pipe.multi()
-            _do_set(pipe.set, key, cur)
+            _do_set(pipe.set, key, cur, self.serializer)
+
+        self._watch_transaction(_update, key)
+
+    def update_fields(self, key, fields):
+        """
+        Atomic ``self[key][path] = value`` for each path, value pair in the dictionary `fields`, where a path is
+        either a field or a dotted path to a field in nested dictionaries (e.g. ``'field1.field2'``). Missing
+        dictionaries along a path are created. Raises KeyError if `key` does not exist, and ValueError if a path runs
+        through another.
+        """
+        _check_paths(fields)
+        result = self._script('UPDATE_FIELDS')(keys=[key], args=[dumps_json(fields)])
+        if result == INEXACT:
+            self.watch_update_fields(key, fields)
+        elif not result:
+            raise KeyError('"{}" not found or a path in {} is not a dictionary'.format(key, list(fields)))
+
+    def watch_update_fields(self, key, fields):
+        """Atomic ``self[key][path] = value`` for each path, value pair in `fields` using an optimistic transaction."""
+
+        def _update(pipe):
+            cur = _do_get(pipe.get, key)
+            for path, value in fields.items():
+                _set_path(cur, path, value)
+            pipe.multi()
+            _do_set(pipe.set, key, cur, self.serializer)
 
-        self._db.transaction(_update, key)
+        self._watch_transaction(_update, key)
 
     def getset(self, key, value):
         "Atomically: ``self[key] = value`` and return previous ``self[key]``."
 
-        value = self._db.getset(key, json.dumps(value).encode('utf-8'))
+        value = self._db.getset(key, _do_encode(value, self.serializer))
         if value is not None:
-            return json.loads(value.decode('utf-8'))
+            return _do_decode(value)
+
+    def mget(self, keys):
+        """Return a list of the values for `keys`, in the same order, with None for missing keys, in one round trip."""
+        if not keys:
+            return []
+        return [None if obj is None else _do_decode(obj) for obj in self._db.mget(keys)]
 
     def add_if_empty(self, key, field, value):
         """
-        Atomic ``self[key][field] = value`` if s``self[key]`` does not exist or is empty.
-        Add a value, `value`, to a field, `field`, under key, `key`, only if the key does not exist
-        or it's value is currently empty. Returns the value if it was added; otherwise, returns None.
+        Atomic ``self[key][field] = value`` if ``self[key]`` does not exist or is empty. Returns the value if it was
+        added; otherwise, returns None.
+        """
+        result = self._script('ADD_IF_EMPTY')(keys=[key], args=[field, dumps_json(value)])
+        if result == INEXACT:
+            return self.watch_add_if_empty(key, field, value)
+        elif result:
+            return value
+        return None
+
+    def watch_add_if_empty(self, key, field, value):
+        """
+        Atomic ``self[key][field] = value`` if s``self[key]`` does not exist or is empty, using an optimistic
+        transaction. Returns the value if it was added; otherwise, returns None.
         """
         def _transaction(pipe):
             try:
@@ -184,7 +609,7 @@ class RedisStore(AbstractStore):
                 if cur is None or cur == {}:
                     cur[field] = value
                     pipe.multi()
-                    _do_set(pipe.set, key, cur)
+                    _do_set(pipe.set, key, cur, self.serializer)
                     return value
                 else:
                     return None
@@ -192,9 +617,54 @@ class RedisStore(AbstractStore):
                 # if the key doesn't exist at all, go ahead and set the value.
                 obj = {field: value}
                 pipe.multi()
-                _do_set(pipe.set, key, obj)
-            # the key exists in the store; if it is the value empty, and the field:
-        return self._db.transaction(_transaction, key)
+                _do_set(pipe.set, key, obj, self.serializer)
+                return value
+        return self._watch_transaction(_transaction, key)
+
+    def scored_remove(self, key, *members):
+        """Remove `members` from the scored set stored under `key`."""
+        if members:
+            self._db.zrem(key, *members)
+
+    def scored_add(self, key, scores):
+        """Add the members of the dictionary `scores` to the scored set stored under `key`, with their scores."""
+        # we issue the command directly since the signature of zadd differs across versions of redis-py.
+        args = []
+        for member, score in scores.items():
+            args.extend([score, member])
+        if args:
+            self._db.execute_command('ZADD', key, *args)
+
+    def scored_trim(self, keys, score):
+        """
+        Remove the members scoring lower than `score` from the scored sets stored under each of `keys`, in one round
+        trip.
+        """
+        with self._db.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zremrangebyscore(key, '-inf', '({}'.format(score))
+            pipe.execute()
+
+    def scored_first(self, key):
+        """Return the (member, score) pair with the lowest score in the scored set stored under `key`, or None."""
+        first = self._db.zrange(key, 0, 0, withscores=True)
+        if not first:
+            return None
+        member, score = first[0]
+        return member.decode('utf-8'), score
+
+    def publish(self, channel, message):
+        """Publish `message`, encoded as JSON, on the redis pub/sub `channel`."""
+        self._db.publish(channel, dumps_json(message))
+
+    def subscribe(self, channel):
+        """
+        Return a redis PubSub object subscribed to `channel`. It holds a connection of its own; poll it for messages
+        with get_message() and decode their data with loads_json().
+        """
+        pubsub = self._db.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return pubsub
 
     def within_transaction(self, f, key):
         """Execute a callable, f, within a lock on key `key`. The executable, f, should take a single argument that
@@ -206,9 +676,186 @@ class RedisStore(AbstractStore):
         return self._db.transaction(_transaction, key)
 
 
+class RedisHashStore(RedisStore):
+    """
+    A RedisStore whose values are dictionaries stored as native redis hashes, with each field of the dictionary
+    stored as a separate (JSON-encoded) field of the hash. Updates to a single field, or to a subfield of a single
+    field, are executed in one round trip on the server and so do not contend with updates to other fields.
+    """
+
+    # replaces the value of a subfield of a single field of the hash. returns 0 if the field does not exist and
+    # INEXACT if the field cannot be represented exactly by cjson (see EXACT).
+    UPDATE_SUBFIELD = EXACT + PACKED + """
+    local raw = redis.call('HGET', KEYS[1], ARGV[1])
+    if not raw then
+        return 0
+    end
+    if packed(raw) then
+        return -1
+    end
+    local cur = cjson.decode(raw)
+    local value = cjson.decode(ARGV[3])
+    if not (exact(raw, cur) and exact(ARGV[3], value)) then
+        return -1
+    end
+    cur[ARGV[2]] = value
+    redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(cur))
+    return 1
+    """
+
+    # ARGV[1] is the JSON-encoded dictionary of paths and values, where the first part of each path is a field of
+    # the hash. a path that is just a field replaces the whole field. nothing is written unless every path can be set.
+    UPDATE_FIELDS = EXACT + PACKED + SET_PATH + """
+    local fields = cjson.decode(ARGV[1])
+    if not exact(ARGV[1], fields) then
+        return -1
+    end
+    local docs = {}
+    for path, value in pairs(fields) do
+        local field, rest = string.match(path, '^([^.]+)%.?(.*)$')
+        if rest == '' then
+            docs[field] = value
+        else
+            if docs[field] == nil then
+                local raw = redis.call('HGET', KEYS[1], field)
+                if not raw then
+                    return 0
+                end
+                if packed(raw) then
+                    return -1
+                end
+                docs[field] = cjson.decode(raw)
+                if not exact(raw, docs[field]) then
+                    return -1
+                end
+            end
+            if type(docs[field]) ~= 'table' or not set_path(docs[field], rest, value) then
+                return 0
+            end
+        end
+    end
+    for field, doc in pairs(docs) do
+        redis.call('HSET', KEYS[1], field, cjson.encode(doc))
+    end
+    return 1
+    """
+
+    # sets a field of the hash only if the hash does not exist (redis removes hashes with no fields).
+    ADD_IF_EMPTY = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+    return 1
+    """
+
+    def __getitem__(self, key):
+        obj = self._db.hgetall(key)
+        if not obj:
+            raise KeyError('"{}" not found'.format(key))
+        return self._decode(obj)
+
+    def _decode(self, obj):
+        return {field.decode('utf-8'): _do_decode(value) for field, value in obj.items()}
+
+    def __setitem__(self, key, value):
+        with self._db.pipeline() as pipe:
+            pipe.delete(key)
+            if value:
+                pipe.hmset(key, {field: _do_encode(v, self.serializer) for field, v in value.items()})
+            pipe.execute()
+
+    def update(self, key, field, value):
+        "Atomic ``self[key][field] = value``."""
+        self._db.hset(key, field, _do_encode(value, self.serializer))
+
+    def mget(self, keys):
+        """Return a list of the values for `keys`, in the same order, with None for missing keys, in one round trip."""
+        with self._db.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            return [self._decode(obj) if obj else None for obj in pipe.execute()]
+
+    def pop_field(self, key, field):
+        "Atomic pop ``self[key][field]``."""
+        with self._db.pipeline() as pipe:
+            pipe.hget(key, field)
+            pipe.hdel(key, field)
+            value, _ = pipe.execute()
+        if value is None:
+            raise KeyError('"{}" not found in "{}"'.format(field, key))
+        return _do_decode(value)
+
+    def update_subfield(self, key, field1, field2, value):
+        "Atomic ``self[key][field1][field2] = value``."""
+        result = self._script('UPDATE_SUBFIELD')(keys=[key], args=[field1, field2, dumps_json(value)])
+        if result == INEXACT:
+            self.watch_update_subfield(key, field1, field2, value)
+        elif not result:
+            raise KeyError('"{}" not found in "{}"'.format(field1, key))
+
+    def watch_update_subfield(self, key, field1, field2, value):
+        "Atomic ``self[key][field1][field2] = value`` using an optimistic transaction."""
+
+        def _update(pipe):
+            cur = pipe.hget(key, field1)
+            if cur is None:
+                raise KeyError('"{}" not found in "{}"'.format(field1, key))
+            cur = _do_decode(cur)
+            cur[field2] = value
+            pipe.multi()
+            pipe.hset(key, field1, _do_encode(cur, self.serializer))
+
+        self._watch_transaction(_update, key)
+
+    def update_fields(self, key, fields):
+        """
+        Atomic ``self[key][path] = value`` for each path, value pair in the dictionary `fields`, where the first part
+        of each path is a field of the hash and a path that is just a field replaces the whole field. Raises KeyError
+        if a field that a longer path runs through does not exist, and ValueError if a path runs through another.
+        """
+        _check_paths(fields)
+        result = self._script('UPDATE_FIELDS')(keys=[key], args=[dumps_json(fields)])
+        if result == INEXACT:
+            self.watch_update_fields(key, fields)
+        elif not result:
+            raise KeyError('a field of "{}" in {} was not found or is not a dictionary'.format(key, list(fields)))
+
+    def watch_update_fields(self, key, fields):
+        """Atomic ``self[key][path] = value`` for each path, value pair in `fields` using an optimistic transaction."""
+
+        def _update(pipe):
+            docs = {}
+            for path, value in fields.items():
+                field, _, rest = path.partition('.')
+                if not rest:
+                    docs[field] = value
+                    continue
+                if field not in docs:
+                    cur = pipe.hget(key, field)
+                    if cur is None:
+                        raise KeyError('"{}" not found in "{}"'.format(field, key))
+                    docs[field] = _do_decode(cur)
+                _set_path(docs[field], rest, value)
+            pipe.multi()
+            for field, doc in docs.items():
+                pipe.hset(key, field, _do_encode(doc, self.serializer))
+
+        self._watch_transaction(_update, key)
+
+    def add_if_empty(self, key, field, value):
+        """
+        Atomic ``self[key][field] = value`` if ``self[key]`` does not exist or is empty. Returns the value if it was
+        added; otherwise, returns None.
+        """
+        if self._script('ADD_IF_EMPTY')(keys=[key], args=[field, _do_encode(value, self.serializer)]):
+            return value
+        return None
+
+
 class MongoStore(AbstractStore):
 
-    def __init__(self, host, port, database='abaco', db='0'):
+    def __init__(self, host, port, database='abaco', db='0', indexes=None):
         """
         Creates an abaco `store` which maps to a single mongo
         collection within some database.
@@ -217,13 +864,37 @@ class MongoStore(AbstractStore):
         :param database: the mongo database to use for abaco.
         :param db: an integer mapping to a mongo collection within the
         mongo database.
+        :param indexes: a list of (keys, options) pairs describing indexes
+        to create on the collection, passed to pymongo's create_index.
 
         :return:
         """
-        mongo_uri = 'mongodb://{}:{}'.format(host, port)
-        self._mongo_client = MongoClient(mongo_uri)
-        self._mongo_database = self._mongo_client[database]
-        self._db = self._mongo_database[db]
+        self.host = host
+        self.port = port
+        self.database = database
+        self.db = db
+        self.indexes = indexes or []
+        self._client = None
+        self._collection = None
+
+    @property
+    def _db(self):
+        """
+        The mongo collection for this store, from the process's mongo client. The indexes for the collection are
+        created the first time it is used in each process.
+        """
+        client = get_mongo_client(self.host, self.port)
+        if self._client is not client:
+            collection = client[self.database][self.db]
+            for keys, options in self.indexes:
+                try:
+                    collection.create_index(keys, **options)
+                except errors.OperationFailure:
+                    # this will happen if the index already exists with different options.
+                    pass
+            self._collection = collection
+            self._client = client
+        return self._collection
 
     def __getitem__(self, key):
         result = self._db.find_one({'_id': key})
@@ -272,8 +943,93 @@ class MongoStore(AbstractStore):
         "Atomic ``self[key][field1][field2] = value``."""
         self._db.update_one({'_id': key}, {'$set': {'{}.{}.{}'.format(key, field1, field2): value}})
 
+    def update_fields(self, key, fields):
+        """
+        Atomic ``self[key][path] = value`` for each path, value pair in the dictionary `fields`, where a path is
+        either a field or a dotted path to a field in nested dictionaries (e.g. ``'field1.field2'``). Missing
+        dictionaries along a path are created. Raises KeyError if `key` does not exist, and ValueError if a path runs
+        through another.
+        """
+        _check_paths(fields)
+        result = self._db.update_one({'_id': key},
+                                     {'$set': {'{}.{}'.format(key, path): value for path, value in fields.items()}})
+        if not result.matched_count:
+            raise KeyError()
+
     def getset(self, key, value):
         "Atomically: ``self[key] = value`` and return previous ``self[key]``."
         value = self._db.find_and_modify(query={'_id': key},
                                          update={key: value})
-        return value[key]
\ No newline at end of file
+        return value[key]
+
+    def increment(self, key, fields):
+        """
+        Atomic ``self[key][field] += value`` for each field, value pair in the dictionary `fields`. Creates the
+        document and any missing fields (starting from 0) if they do not already exist.
+        """
+        self._db.update_one({'_id': key},
+                            {'$inc': {'{}.{}'.format(key, field): value for field, value in fields.items()}},
+                            upsert=True)
+
+    def mget(self, keys):
+        """Return a list of the values for `keys`, in the same order, with None for missing keys, in one query."""
+        docs = {doc['_id']: doc[doc['_id']] for doc in self._db.find({'_id': {'$in': list(keys)}})}
+        return [docs.get(key) for key in keys]
+
+    def set_with_fields(self, key, value, fields):
+        """
+        Set ``self[key] = value``, additionally storing the dictionary `fields` at the top level of the document
+        so that documents can be indexed and queried on them (see `find` and `delete_many`).
+        """
+        doc = {'_id': key, key: value}
+        doc.update(fields)
+        self._db.save(doc)
+
+    def insert_many_with_fields(self, items):
+        """
+        Insert several new documents in one round trip. `items` is a list of (key, value, fields) tuples with the
+        arguments of `set_with_fields` for each document; none of the keys may exist yet.
+        """
+        docs = []
+        for key, value, fields in items:
+            doc = {'_id': key, key: value}
+            doc.update(fields)
+            docs.append(doc)
+        if docs:
+            self._db.insert_many(docs)
+
+    def find(self, **fields):
+        """Iterate over the (key, value) pairs of all documents whose top level fields match `fields`."""
+        for doc in self._db.find(fields):
+            yield doc['_id'], doc[doc['_id']]
+
+    def find_page(self, field, cursor=None, limit=0, **fields):
+        """
+        Return a page of the (key, value) pairs of at most `limit` documents whose top level fields match `fields`,
+        ordered by the top level field, `field`, together with the cursor for the next page (None on the last
+        page). Pass the returned cursor as `cursor` to retrieve the next page. A `limit` of 0 returns all
+        remaining documents. `field` can also be a list of top level fields, in which case the documents are ordered
+        by the first field, then by the next for documents with equal values, and so on, and cursors are lists of
+        the values of these fields.
+        """
+        order = field if isinstance(field, list) else [field]
+        query = dict(fields)
+        if cursor is not None:
+            values = cursor if isinstance(field, list) else [cursor]
+            # documents after the cursor: equal on the first i fields and greater on the next one.
+            after = []
+            for i, f in enumerate(order):
+                clause = dict(zip(order[:i], values[:i]))
+                clause[f] = {'$gt': values[i]}
+                after.append(clause)
+            query['$or'] = after
+        docs = list(self._db.find(query).sort([(f, ASCENDING) for f in order]).limit(limit))
+        page = [(doc['_id'], doc[doc['_id']]) for doc in docs]
+        if limit and len(docs) == limit:
+            last = [docs[-1][f] for f in order]
+            return page, last if isinstance(field, list) else last[0]
+        return page, None
+
+    def delete_many(self, **fields):
+        """Delete all documents whose top level fields match `fields`."""
+        self._db.delete_many(fields)
\ No newline at end of file
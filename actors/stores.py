@@ -1,37 +1,59 @@
 from functools import partial
 
 import configparser
-from pymongo import errors
+from pymongo import ASCENDING
 
-from store import RedisStore, MongoStore
+from store import RedisStore, RedisHashStore, MongoStore
 from config import Config
 
 
+# Stores do not connect to their databases until they are first used. Each process shares a pool of connections
+# for each redis db and a single mongo client between all of its stores (see store.py).
+
 # redis is used for actor and worker run time state for its speed and transactional semantics.
 redis_config_store = partial(
     RedisStore, Config.get('store', 'redis_host'), Config.getint('store', 'redis_port'))
 
 actors_store = redis_config_store(db='1')
-workers_store = redis_config_store(db='2')
+# the workers for each actor are stored as a redis hash keyed by the actor's dbid, with one field per worker, so that
+# workers can update their own records without contending with the other workers of the actor.
+workers_store = RedisHashStore(Config.get('store', 'redis_host'), Config.getint('store', 'redis_port'), db='2')
+# the time of the last heartbeat of each running worker, keyed by worker id. the keys expire unless the workers keep
+# renewing them (see Worker.heartbeat).
+heartbeats_store = redis_config_store(db='4')
+# short-lived locks, e.g. the lock that keeps the health checks of different hosts from scaling an actor at once.
+locks_store = redis_config_store(db='5')
+# the messages waiting in each actor's inbox, keyed by the actor's dbid: a scored set of the execution ids of the
+# messages, scored by the time they were sent (see Execution.add_pending).
+pending_store = redis_config_store(db='6')
 
 
 # Mongo is used for accounting, permissions and logging data for its scalability.
 mongo_config_store = partial(
     MongoStore, Config.get('store', 'mongo_host'), Config.getint('store', 'mongo_port'))
 
-logs_store = mongo_config_store(db='1')
+# indexes are created the first time each store is used in a process, rather than at import time.
+logs_indexes = []
 # create an expiry index for the log store if we want logs to expire
 log_ex = Config.get('web', 'log_ex')
 try:
     log_ex = int(log_ex)
     if not log_ex == -1:
-        try:
-            logs_store._db.create_index("exp", expireAfterSeconds=log_ex)
-        except errors.OperationFailure:
-            # this will happen if the index already exists.
-            pass
+        logs_indexes.append(('exp', {'expireAfterSeconds': log_ex}))
 except (ValueError, configparser.NoOptionError):
     pass
+logs_store = mongo_config_store(db='1', indexes=logs_indexes)
 permissions_store = mongo_config_store(db='2')
-executions_store = mongo_config_store(db='3')
+# executions are stored one document per execution with the actor's dbid, the execution id and the time the execution
+# was created at the top level of the document so that an actor's executions can be found, in order, without scanning
+# the collection.
+executions_store = mongo_config_store(db='3', indexes=[
+    ([('actor_id', ASCENDING), ('create_time', ASCENDING), ('id', ASCENDING)], {})])
 clients_store = mongo_config_store(db='4')
+# running totals of the executions for each actor, keyed by the actor's dbid.
+summaries_store = mongo_config_store(db='5')
+# reverse index of permissions from each user to the actors they hold permissions for, with one document per user and
+# actor. the compound index serves paginated listings of a user's actors and the second index serves actor deletion.
+user_actors_store = mongo_config_store(db='6', indexes=[
+    ([('tenant', ASCENDING), ('user', ASCENDING), ('actor_id', ASCENDING)], {}),
+    ('actor_id', {})])
@@ -1,15 +1,18 @@
 import os
 import sys
 import threading
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
 
 import channelpy
 from agave import Agave
 
 from channels import ActorMsgChannel, ClientsChannel, CommandChannel,WorkerChannel
-from codes import ERROR, READY, BUSY, COMPLETE
-from docker_utils import DockerError, DockerStartContainerError, execute_actor, pull_image
+from codes import ERROR, READY, COMPLETE
+from docker_utils import DockerError, DockerStartContainerError, execute_actor, get_api_latency, pull_image
 from errors import WorkerException
-from models import Actor, Execution, Worker
+from models import Actor, Execution, Worker, get_heartbeat_interval
 from stores import actors_store, workers_store
 
 from agaveflask.logs import get_logger
@@ -25,6 +28,7 @@ def shutdown_worker(ch_name):
     logger.debug("shutdown_worker called for ch_name: {}".format(ch_name))
     ch = WorkerChannel(name=ch_name)
     ch.put("stop")
+    ch.close()
     logger.info("A 'stop' message was sent to worker channel: {}".format(ch_name))
 
 def shutdown_workers(actor_id):
@@ -69,6 +73,7 @@ def process_worker_ch(tenant, worker_ch, actor_id, worker_id, actor_ch, ag_clien
                 logger.debug("received health check. returning 'ok'.")
                 ch = msg['reply_to']
                 ch.put('ok')
+                ch.close()
         elif msg == 'stop':
             logger.info("Received stop message, stopping worker...")
             # first, delete an associated client
@@ -83,6 +88,7 @@ def process_worker_ch(tenant, worker_ch, actor_id, worker_id, actor_ch, ag_clien
                                                        worker_id=worker_id,
                                                        client_id=ag_client.api_key,
                                                        secret=secret)
+                clients_ch.close()
 
                 if msg['status'] == 'ok':
                     logger.info("Delete request completed successfully.")
@@ -100,6 +106,19 @@ def process_worker_ch(tenant, worker_ch, actor_id, worker_id, actor_ch, ag_clien
             logger.info("Worker is now exiting.")
             sys.exit()
 
+def send_heartbeats(worker_id):
+    """
+    Target for a thread that records that the worker is alive every heartbeat interval. The health checks consider
+    workers whose heartbeats have stopped dead.
+    """
+    interval = get_heartbeat_interval()
+    while keep_running:
+        try:
+            Worker.heartbeat(worker_id)
+        except Exception as e:
+            logger.error("Got exception recording heartbeat: {}".format(e))
+        time.sleep(interval)
+
 def subscribe(tenant,
               actor_id,
               worker_id,
@@ -129,84 +148,134 @@ def subscribe(tenant,
     logger.info("Starting the process worker channel thread.")
     t = threading.Thread(target=process_worker_ch, args=(tenant, worker_ch, actor_id, worker_id, actor_ch, ag))
     t.start()
+    # the executions of a stateful actor update its state one at a time.
+    actor = Actor.from_db(actors_store[actor_id])
+    max_concurrency = (actor.get('max_concurrency') or 1) if actor.get('stateless') else 1
+    logger.info("Worker running up to {} execution(s) at once.".format(max_concurrency))
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    # a slot is taken before a message is read from the inbox, so that the worker takes at most max_concurrency
+    # messages off the queue at once.
+    slots = threading.BoundedSemaphore(max_concurrency)
+    activity = {'active': 0}
+    activity_lock = threading.Lock()
+    ag_lock = threading.Lock()
+
+    def update_activity(delta):
+        with activity_lock:
+            activity['active'] += delta
+            Worker.update_worker_activity(actor_id, worker_id, activity['active'],
+                                          max_concurrency - activity['active'])
+
+    def run(msg):
+        try:
+            execute(actor_id, worker_id, worker_ch, msg, ag, ag_lock)
+        except Exception as e:
+            logger.error("Got exception processing message {}: {}".format(msg, e))
+        finally:
+            slots.release()
+            try:
+                update_activity(-1)
+            except Exception as e:
+                logger.error("Got exception updating the worker's activity: {}".format(e))
+
     logger.info("Worker subscribing to actor channel.")
-    update_worker_status = True
+    update_activity(0)
     global keep_running
-    while keep_running:
-        if update_worker_status:
-            Worker.update_worker_status(actor_id, worker_id, READY)
-            update_worker_status = False
-        try:
-            msg = actor_ch.get(timeout=2)
-        except channelpy.ChannelTimeoutException:
-            continue
-        except channelpy.ChannelClosedException:
-            logger.info("Channel closed, worker exiting...")
-            keep_running = False
-            sys.exit()
-        update_worker_status = True
-        logger.info("Received message {}. Starting actor container...".format(msg))
-        # the msg object is a dictionary with an entry called message and an arbitrary
-        # set of k:v pairs coming in from the query parameters.
-        message = msg.pop('message', '')
-        actor = Actor.from_db(actors_store[actor_id])
-        execution_id = msg['_abaco_execution_id']
-
-        # the execution object was created by the controller, but we need to add the worker id to it now that we
-        # know which worker will be working on the execution.
-        logger.debug("Adding worker_id to execution.")
-        Execution.add_worker_id(actor_id, execution_id, worker_id)
-
-        # privileged dictates whether the actor container runs in privileged mode and if docker daemon is mounted.
-        privileged = False
-        if actor['privileged'] == 'TRUE':
-            privileged = True
-        logger.debug("privileged: {}".format(privileged))
-
-        # retrieve the default environment registered with the actor.
-        environment = actor['default_environment']
-        logger.debug("Actor default environment: {}".format(environment))
-
-        # overlay the default_environment registered for the actor with the msg
-        # dictionary
-        environment.update(msg)
-        environment['_abaco_access_token'] = ''
-        environment['_abaco_actor_dbid'] = actor_id
-        environment['_abaco_actor_id'] = actor.id
-        environment['_abaco_actor_state'] = actor.state
-        logger.debug("Overlayed environment: {}".format(environment))
-
-        # if we have an agave client, get a fresh set of tokens:
-        if ag:
+    try:
+        while keep_running:
+            if not slots.acquire(timeout=2):
+                continue
             try:
-                ag.token.refresh()
-                token = ag.token.token_info['access_token']
-                environment['_abaco_access_token'] = token
-                logger.info("Refreshed the tokens. Passed {} to the environment.".format(token))
+                msg = actor_ch.get(timeout=2)
+            except channelpy.ChannelTimeoutException:
+                slots.release()
+                continue
+            except channelpy.ChannelClosedException:
+                logger.info("Channel closed, worker exiting...")
+                keep_running = False
+                sys.exit()
+            # the message is already off the queue, so it is run even if the activity cannot be recorded (e.g., the
+            # worker has been deleted); run releases the slot.
+            try:
+                update_activity(1)
             except Exception as e:
-                logger.error("Got an exception trying to get an access token: {}".format(e))
-        else:
-            logger.info("Agave client `ag` is None -- not passing access token.")
-        logger.info("Passing update environment: {}".format(environment))
+                logger.error("Got exception updating the worker's activity: {}".format(e))
+            executor.submit(run, msg)
+    finally:
+        # let the running executions finish and be finalized.
+        executor.shutdown(wait=True)
+
+def execute(actor_id, worker_id, worker_ch, msg, ag, ag_lock):
+    """
+    Run an execution of the actor for the message `msg` taken off its inbox and record its stats and logs. `ag`, if
+    not None, is the worker's agave client, which is used to pass a fresh access token to the actor; concurrent
+    executions share it under `ag_lock`.
+    """
+    logger.info("Received message {}. Starting actor container...".format(msg))
+    # the msg object is a dictionary with an entry called message and an arbitrary
+    # set of k:v pairs coming in from the query parameters.
+    message = msg.pop('message', '')
+    actor = Actor.from_db(actors_store[actor_id])
+    execution_id = msg['_abaco_execution_id']
+
+    # the execution object was created by the controller, but we need to add the worker id to it now that we
+    # know which worker will be working on the execution.
+    logger.debug("Adding worker_id to execution.")
+    Execution.add_worker_id(actor_id, execution_id, worker_id)
+
+    # privileged dictates whether the actor container runs in privileged mode and if docker daemon is mounted.
+    privileged = False
+    if actor['privileged'] == 'TRUE':
+        privileged = True
+    logger.debug("privileged: {}".format(privileged))
+
+    # retrieve the default environment registered with the actor.
+    environment = actor['default_environment']
+    logger.debug("Actor default environment: {}".format(environment))
+
+    # overlay the default_environment registered for the actor with the msg
+    # dictionary
+    environment.update(msg)
+    environment['_abaco_access_token'] = ''
+    environment['_abaco_actor_dbid'] = actor_id
+    environment['_abaco_actor_id'] = actor.id
+    environment['_abaco_actor_state'] = actor.state
+    logger.debug("Overlayed environment: {}".format(environment))
+
+    # if we have an agave client, get a fresh set of tokens:
+    if ag:
         try:
-            stats, logs, final_state, exit_code = execute_actor(actor_id, worker_id, worker_ch, image,
-                                                                message, environment, privileged)
-        except DockerStartContainerError as e:
-            logger.error("Got DockerStartContainerError: {}".format(str(e)))
-            Actor.set_status(actor_id, ERROR)
-            continue
-        # Add the completed stats to the execution
-        logger.info("Actor container finished successfully. Got stats object:{}".format(str(stats)))
-        Execution.finalize_execution(actor_id, execution_id, COMPLETE, stats, final_state, exit_code)
-        logger.info("Added execution: {}".format(execution_id))
+            # the client is shared by the concurrent executions.
+            with ag_lock:
+                ag.token.refresh()
+                token = ag.token.token_info['access_token']
+            environment['_abaco_access_token'] = token
+            logger.info("Refreshed the tokens. Passed {} to the environment.".format(token))
+        except Exception as e:
+            logger.error("Got an exception trying to get an access token: {}".format(e))
+    else:
+        logger.info("Agave client `ag` is None -- not passing access token.")
+    logger.info("Passing update environment: {}".format(environment))
+    try:
+        stats, logs, final_state, exit_code = execute_actor(actor_id, worker_id, worker_ch, image,
+                                                            message, environment, privileged)
+    except DockerStartContainerError as e:
+        logger.error("Got DockerStartContainerError: {}".format(str(e)))
+        Actor.set_status(actor_id, ERROR)
+        return
+    # Add the completed stats to the execution
+    logger.info("Actor container finished successfully. Got stats object:{}".format(str(stats)))
+    Execution.finalize_execution(actor_id, execution_id, COMPLETE, stats, final_state, exit_code)
+    logger.info("Added execution: {}".format(execution_id))
 
-        # Add the logs to the execution
-        Execution.set_logs(execution_id, logs)
-        logger.info("Added execution logs.")
+    # Add the logs to the execution
+    Execution.set_logs(execution_id, logs)
+    logger.info("Added execution logs.")
 
-        # Update the worker's last updated and last execution fields:
-        Worker.update_worker_execution_time(actor_id, worker_id)
-        logger.info("worker time stamps updated.")
+    # Update the worker's last updated and last execution fields:
+    Worker.update_worker_execution_time(actor_id, worker_id)
+    logger.info("worker time stamps updated.")
+    logger.debug("docker API latency (ms) for this worker: {}".format(get_api_latency()))
 
 def main(worker_ch_name, worker_id, image):
     """
@@ -218,10 +287,15 @@ def main(worker_ch_name, worker_id, image):
         worker_id, worker_ch_name, image))
     worker_ch = WorkerChannel(name=worker_ch_name)
 
+    # heartbeats start right away since the worker is added to the workers_store before it subscribes to its inbox.
+    t = threading.Thread(target=send_heartbeats, args=(worker_id,), daemon=True)
+    t.start()
+
     # first, attempt to pull image from docker hub:
+    start = timeit.default_timer()
     try:
         logger.info("Worker pulling image {}...".format(image))
-        pull_image(image)
+        pulled = pull_image(image)
     except DockerError as e:
         # return a message to the spawner that there was an error pulling image and abort
         # this is not necessarily an error state: the user simply could have provided an
@@ -230,7 +304,8 @@ def main(worker_ch_name, worker_id, image):
         logger.info("worker got a DockerError trying to pull image. Error: {}.".format(e))
         worker_ch.put({'status': 'error', 'msg': str(e)})
         raise e
-    logger.info("Image {} pulled successfully.".format(image))
+    logger.info("Image {} ready after {:.0f} ms (image cache {}).".format(
+        image, 1e3 * (timeit.default_timer() - start), 'miss' if pulled else 'hit'))
 
     # inform spawner that image pulled successfully and, simultaneously,
     # wait to receive message from spawner that it is time to subscribe to the actor channel
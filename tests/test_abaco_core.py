@@ -164,6 +164,18 @@ def get_actor_id(headers, name='abaco_test_suite'):
     # didn't find the test actor
     assert False
 
+def test_list_actors_paginated(headers):
+    url = '{}/{}'.format(base_url, '/actors')
+    rsp = requests.get(url, headers=headers, params={'limit': 1})
+    result = basic_response_checks(rsp)
+    assert len(result) == 1
+    assert 'next' in rsp.links
+    cursor = rsp.links['next']['url'].split('cursor=')[1]
+    rsp = requests.get(url, headers=headers, params={'limit': 1, 'cursor': cursor})
+    result2 = basic_response_checks(rsp)
+    assert len(result2) == 1
+    assert not result2[0]['id'] == result[0]['id']
+
 def test_list_actor(headers):
     actor_id = get_actor_id(headers)
     url = '{}/actors/{}'.format(base_url, actor_id)
@@ -246,6 +258,12 @@ def test_list_messages(headers):
     rsp = requests.get(url, headers=headers)
     result = basic_response_checks(rsp)
     assert result.get('messages') == 0
+    if case == 'snake':
+        assert result.get('in_flight') == 0
+        assert result.get('oldest_message_age') is None
+    else:
+        assert result.get('inFlight') == 0
+        assert result.get('oldestMessageAge') is None
 
 def test_cors_list_messages(headers):
     actor_id = get_actor_id(headers)
@@ -364,6 +382,24 @@ def test_list_execution_logs(headers):
     assert '_abaco_execution_id' in result['logs']
     assert '_abaco_Content-Type' in result['logs']
 
+def test_list_executions_paginated(headers):
+    actor_id = get_actor_id(headers)
+    url = '{}/actors/{}/executions'.format(base_url, actor_id)
+    rsp = requests.get(url, headers=headers, params={'limit': 1})
+    result = basic_response_checks(rsp)
+    assert len(result.get('ids')) == 1
+    if case == 'snake':
+        assert result['total_executions'] == 1
+        assert result.get('next_cursor') == result['ids'][0]
+        cursor = result['next_cursor']
+    else:
+        assert result['totalExecutions'] == 1
+        assert result.get('nextCursor') == result['ids'][0]
+        cursor = result['nextCursor']
+    rsp = requests.get(url, headers=headers, params={'limit': 1, 'cursor': cursor})
+    result = basic_response_checks(rsp)
+    assert len(result.get('ids')) == 0
+
 
 def test_execute_actor_json(headers):
     actor_id = get_actor_id(headers)
@@ -406,6 +442,37 @@ def test_execute_actor_json(headers):
         count += 1
     assert False
 
+def test_execute_actor_batch(headers):
+    actor_id = get_actor_id(headers)
+    url = '{}/actors/{}/messages/batch'.format(base_url, actor_id)
+    rsp = requests.post(url, json=['testing batch 1', {'key1': 'value1'}], headers=headers)
+    result = basic_response_checks(rsp)
+    if case == 'snake':
+        exc_ids = result.get('execution_ids')
+    else:
+        exc_ids = result.get('executionIds')
+    assert len(exc_ids) == 2
+    # check for the executions to complete
+    count = 0
+    while count < 10:
+        time.sleep(3)
+        statuses = []
+        for exc_id in exc_ids:
+            url = '{}/actors/{}/executions/{}'.format(base_url, actor_id, exc_id)
+            rsp = requests.get(url, headers=headers)
+            result = basic_response_checks(rsp)
+            statuses.append(result.get('status'))
+        if statuses == ['COMPLETE', 'COMPLETE']:
+            return
+        count += 1
+    assert False
+
+def test_execute_actor_batch_empty(headers):
+    actor_id = get_actor_id(headers)
+    url = '{}/actors/{}/messages/batch'.format(base_url, actor_id)
+    rsp = requests.post(url, json=[], headers=headers)
+    assert rsp.status_code == 400
+
 def test_update_actor(headers):
     actor_id = get_actor_id(headers)
     url = '{}/actors/{}'.format(base_url, actor_id)
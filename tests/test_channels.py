@@ -0,0 +1,124 @@
+# Tests for the pooled RabbitMQ connections used by the channels.
+# Like the store tests, these tests require the development stack (in particular, RabbitMQ) to be running; see the
+# header of test_store.py. Execute them from the root directory with:
+#     docker run -v $(pwd)/local-dev.conf:/etc/abaco.conf --entrypoint=py.test -it --rm jstubbs/abaco_testsuite /tests/test_channels.py -s
+
+import os
+import sys
+import threading
+import time
+import timeit
+import uuid
+sys.path.append(os.path.split(os.getcwd())[0])
+sys.path.append('/actors')
+
+import pytest
+import rabbitpy
+from channelpy import Channel, RabbitConnection
+
+from channels import ActorMsgChannel, PooledRabbitConnection, WorkerChannel, get_pool
+from config import Config
+
+# this is the number of messages posted in each benchmark.
+n = 200
+
+
+def post_msgs(connection_type, name):
+    """Post n messages the way the messages endpoint does, opening a channel per request, and return the mean
+    latency in milliseconds."""
+    uri = Config.get('rabbit', 'uri')
+    start = timeit.default_timer()
+    for i in range(n):
+        ch = Channel(name=name, connection_type=connection_type, uri=uri)
+        ch.put({'message': i})
+        ch.close()
+    return 1e3 * (timeit.default_timer() - start) / n
+
+
+def test_message_post_benchmark():
+    # compares posting messages with a new connection per request to posting them with the pooled connection; run
+    # with -s to see the results.
+    name = 'test_benchmark_{}'.format(uuid.uuid4())
+    for connection_type in [RabbitConnection, PooledRabbitConnection]:
+        latency = post_msgs(connection_type, name)
+        print("{}: {:.2f} ms per message.".format(connection_type.__name__, latency))
+    ch = Channel(name=name, connection_type=PooledRabbitConnection, uri=Config.get('rabbit', 'uri'))
+    for i in range(2 * n):
+        assert ch.get(timeout=5)['message'] == i % n
+    ch.delete()
+
+
+def test_channels_are_reused():
+    pool = get_pool(Config.get('rabbit', 'uri'))
+    conn, ch = pool.acquire()
+    pool.release(conn, ch)
+    conn2, ch2 = pool.acquire()
+    assert conn2 is conn
+    assert ch2 is ch
+    pool.release(conn2, ch2)
+
+
+def test_discard_keeps_connection():
+    # discarding a channel after a channel-level error leaves the shared connection in use.
+    pool = get_pool(Config.get('rabbit', 'uri'))
+    conn, ch = pool.acquire()
+    pool.discard(conn, ch)
+    conn2, ch2 = pool.acquire()
+    assert conn2 is conn
+    assert ch2 is not ch
+    pool.release(conn2, ch2)
+
+
+def test_delete():
+    # channelpy deletes the queue on one thread and closes the connection on another; the queue must still be
+    # deleted, and the pooled channel must not be handed out while the delete is using it.
+    ch = WorkerChannel()
+    name = ch.name
+    ch.delete()
+    time.sleep(1)
+    pool = get_pool(Config.get('rabbit', 'uri'))
+    conn, pool_ch = pool.acquire()
+    with pytest.raises(rabbitpy.exceptions.AMQPNotFound):
+        rabbitpy.Queue(pool_ch, name=name, durable=True).declare(passive=True)
+    pool.release(conn, pool_ch)
+
+
+def test_put_sync():
+    # the reply channel of put_sync is rebuilt from its connection type by the receiver and must be deleted with
+    # the channel it was created on.
+    ch = WorkerChannel()
+    worker_ch = WorkerChannel(name=ch.name)
+
+    def respond():
+        msg = worker_ch.get(timeout=5)
+        assert msg['value'] == 'status'
+        msg['reply_to'].put('ok')
+        msg['reply_to'].close()
+
+    t = threading.Thread(target=respond)
+    t.start()
+    assert ch.put_sync('status', timeout=5) == 'ok'
+    t.join()
+    ch.delete()
+    worker_ch.close()
+
+
+def test_put_msgs():
+    actor_id = 'test_{}'.format(uuid.uuid4())
+    ch = ActorMsgChannel(actor_id)
+    ch.put_msgs([{'message': i} for i in range(10)])
+    for i in range(10):
+        assert ch.get(timeout=5)['message'] == i
+    ch.delete()
+
+
+def test_sizes():
+    actor_id = 'test_{}'.format(uuid.uuid4())
+    ch = ActorMsgChannel(actor_id)
+    assert ch.size() == 0
+    ch.put_msgs([{'message': i} for i in range(3)])
+    assert ch.size() == 3
+    missing = 'test_{}'.format(uuid.uuid4())
+    assert ActorMsgChannel.get_sizes([missing, actor_id]) == {missing: 0, actor_id: 3}
+    assert ch.get(timeout=5)['message'] == 0
+    ch.delete()
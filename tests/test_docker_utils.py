@@ -0,0 +1,62 @@
+# Tests for the parsing of the resource usage and runtime of actor containers in docker_utils. These functions only
+# read docker's responses and the cgroup hierarchy (which is replaced here by a temporary directory), so these tests do
+# not need the development stack to be running. Execute them from the root directory with:
+#     docker run -v $(pwd)/local-dev.conf:/etc/abaco.conf --entrypoint=py.test -it --rm jstubbs/abaco_testsuite /tests/test_docker_utils.py
+
+import datetime
+import os
+import sys
+sys.path.append(os.path.split(os.getcwd())[0])
+sys.path.append('/actors')
+
+import pytest
+
+import docker_utils
+
+
+def test_parse_docker_time():
+    # docker reports nanoseconds; they are truncated to microseconds.
+    assert docker_utils.parse_docker_time('2017-01-01T12:00:02.987654321Z') == \
+        datetime.datetime(2017, 1, 1, 12, 0, 2, 987654)
+    assert docker_utils.parse_docker_time('2017-01-01T12:00:02.5Z') == datetime.datetime(2017, 1, 1, 12, 0, 2, 500000)
+    assert docker_utils.parse_docker_time('2017-01-01T12:00:02Z') == datetime.datetime(2017, 1, 1, 12, 0, 2)
+
+
+def test_get_runtime():
+    state = {'StartedAt': '2017-01-01T12:00:00.100000000Z', 'FinishedAt': '2017-01-01T12:00:02.350999999Z'}
+    assert docker_utils.get_runtime(state) == 2250
+    # a container that has not exited reports the zero time as FinishedAt.
+    assert docker_utils.get_runtime({'StartedAt': '2017-01-01T12:00:00Z',
+                                     'FinishedAt': '0001-01-01T00:00:00Z'}) == 0
+    assert docker_utils.get_runtime({'StartedAt': '2017-01-01T12:00:00Z'}) is None
+    assert docker_utils.get_runtime(None) is None
+    assert docker_utils.get_runtime({'StartedAt': 'bad', 'FinishedAt': 'bad'}) is None
+
+
+@pytest.fixture
+def cgroup_root(tmpdir, monkeypatch):
+    monkeypatch.setattr(docker_utils, 'CGROUP_ROOT', str(tmpdir))
+    return tmpdir
+
+
+def write_cgroup(root, cid, cpuacct=None, blkio=None):
+    if cpuacct is not None:
+        root.join('cpuacct', 'docker', cid, 'cpuacct.stat').write(cpuacct, ensure=True)
+    if blkio is not None:
+        root.join('blkio', 'docker', cid, 'blkio.throttle.io_service_bytes').write(blkio, ensure=True)
+
+
+def test_read_cgroup_stats(cgroup_root):
+    write_cgroup(cgroup_root, 'c1',
+                 cpuacct='user 42\nsystem 7\n',
+                 blkio='8:0 Read 4096\n8:0 Write 1024\n8:0 Sync 5120\n8:0 Total 5120\nTotal 5120\n')
+    assert docker_utils.read_cgroup_stats('c1') == {'cpu': 42, 'io': 10}
+
+
+def test_read_cgroup_stats_missing(cgroup_root):
+    # the cgroup of a container is removed once it exits.
+    assert docker_utils.read_cgroup_stats('gone') is None
+    write_cgroup(cgroup_root, 'c2', cpuacct='user 42\nsystem 7\n')
+    assert docker_utils.read_cgroup_stats('c2') is None
+    write_cgroup(cgroup_root, 'c3', cpuacct='system 7\n', blkio='')
+    assert docker_utils.read_cgroup_stats('c3') is None
@@ -0,0 +1,225 @@
+# Tests for the decisions of the health checks: which workers are dead (health.check_workers) and how workers are
+# scaled (health.manage_workers). Both only act through Worker methods, the CommandChannel, rm_container and
+# shutdown_worker, which are replaced here, so these tests do not need the development stack to be running. Execute them from the root directory with:
+#     docker run -v $(pwd)/local-dev.conf:/etc/abaco.conf --entrypoint=py.test -it --rm jstubbs/abaco_testsuite /tests/test_health.py
+
+import os
+import sys
+import time
+sys.path.append(os.path.split(os.getcwd())[0])
+sys.path.append('/actors')
+
+import pytest
+
+import codes
+import health
+
+policy = {'min_workers': 1, 'max_workers': 10, 'messages_per_worker': 1, 'cooldown': 60}
+
+
+class Recorder(object):
+    """Records the workers requested, marked and stopped by manage_workers."""
+
+    def __init__(self):
+        self.requested = []
+        self.marked = []
+        self.stopped = []
+        self.commands = []
+
+    def request_worker(self, actor_id):
+        worker_id = 'new{}'.format(len(self.requested))
+        self.requested.append(worker_id)
+        return worker_id
+
+    def put_cmd(self, **kwargs):
+        self.commands.append(kwargs)
+
+    def update_worker_status(self, actor_id, worker_id, status):
+        self.marked.append((worker_id, status))
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    rec = Recorder()
+    monkeypatch.setattr(health.Worker, 'request_worker', rec.request_worker)
+    monkeypatch.setattr(health.Worker, 'update_worker_status', rec.update_worker_status)
+    monkeypatch.setattr(health, 'shutdown_worker', rec.stopped.append)
+
+    class CommandChannel(object):
+        def put_cmd(self, **kwargs):
+            rec.put_cmd(**kwargs)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(health, 'CommandChannel', CommandChannel)
+    return rec
+
+
+def actor(**kwargs):
+    a = {'stateless': True, 'image': 'abacosamples/test', 'tenant': 'dev'}
+    a.update(kwargs)
+    return a
+
+
+def worker(id, status=codes.READY, age=3600, idle=3600, **kwargs):
+    """A worker created `age` seconds ago whose last execution was `idle` seconds ago."""
+    now = time.time()
+    w = {'id': id, 'ch_name': 'ch_{}'.format(id), 'status': status, 'create_time': now - age,
+         'last_execution': now - idle}
+    w.update(kwargs)
+    return w
+
+
+def workers(*ws):
+    return {w['id']: w for w in ws}
+
+
+def test_scale_up_to_queue(recorder):
+    # one busy worker plus one worker per queued message.
+    health.manage_workers('a', actor(), workers(worker('w1', codes.BUSY)), 3, policy)
+    assert len(recorder.requested) == 3
+    assert recorder.commands[0]['num'] == 3
+    assert recorder.commands[0]['stop_existing'] is False
+
+
+def test_messages_per_worker_and_concurrency(recorder):
+    p = dict(policy, messages_per_worker=2)
+    # 1 running execution + ceil(5 / 2) = 4 slots, 2 per worker.
+    health.manage_workers('a', actor(max_concurrency=2), workers(worker('w1', codes.BUSY, active=1)), 5, p)
+    assert len(recorder.requested) == 1
+
+
+def test_max_workers(recorder):
+    health.manage_workers('a', actor(), workers(worker('w1')), 100, policy)
+    assert len(recorder.requested) == policy['max_workers'] - 1
+    # the actor's own max_workers cannot exceed the policy's.
+    recorder.requested.clear()
+    health.manage_workers('b', actor(max_workers=50), workers(worker('w1')), 100, policy)
+    assert len(recorder.requested) == policy['max_workers'] - 1
+    recorder.requested.clear()
+    health.manage_workers('c', actor(max_workers=3), workers(worker('w1')), 100, policy)
+    assert len(recorder.requested) == 2
+
+
+def test_min_workers(recorder):
+    health.manage_workers('a', actor(min_workers=3), {}, 0, policy)
+    assert len(recorder.requested) == 3
+    # min_workers is capped by max_workers.
+    recorder.requested.clear()
+    health.manage_workers('b', actor(min_workers=5, max_workers=2), {}, 0, policy)
+    assert len(recorder.requested) == 2
+
+
+def test_cooldown(recorder):
+    # a worker was created within the cooldown, so no more are requested yet.
+    health.manage_workers('a', actor(), workers(worker('w1', age=10)), 5, policy)
+    assert recorder.requested == []
+
+
+def test_stateful_actors_are_not_scaled(recorder):
+    health.manage_workers('a', actor(stateless=False), workers(worker('w1', codes.BUSY)), 10, policy)
+    health.manage_workers('a', actor(stateless=False), workers(worker('w1'), worker('w2')), 0, policy)
+    assert recorder.requested == []
+    assert recorder.stopped == []
+
+
+def test_scale_down_idle_workers(recorder):
+    ws = workers(worker('busy', codes.BUSY),
+                 worker('recent', idle=10),
+                 worker('new', age=10, idle=3600),
+                 worker('idle1'),
+                 worker('idle2'))
+    health.manage_workers('a', actor(), ws, 0, policy)
+    # the target is the one busy worker; only workers idle beyond the cooldown are stopped, and they are marked
+    # STOPPING first.
+    assert sorted(recorder.stopped) == ['ch_idle1', 'ch_idle2']
+    assert sorted(recorder.marked) == [('idle1', codes.STOPPING), ('idle2', codes.STOPPING)]
+
+
+def test_no_scale_down_with_queued_messages(recorder):
+    health.manage_workers('a', actor(), workers(worker('w1'), worker('w2'), worker('w3')), 1, policy)
+    assert recorder.stopped == []
+
+
+def test_stopping_workers_are_not_counted(recorder):
+    # the STOPPING workers of an earlier pass are neither counted towards the target nor stopped again.
+    ws = workers(worker('s1', codes.STOPPING), worker('s2', codes.STOPPING), worker('idle1'))
+    health.manage_workers('a', actor(min_workers=2), ws, 0, policy)
+    assert recorder.stopped == []
+    assert len(recorder.requested) == 1
+
+
+class Locks(dict):
+    """In-memory stand-in for the locks_store."""
+
+    def set_if_absent(self, key, obj, ex=None):
+        if key in self:
+            return False
+        self[key] = obj
+        return True
+
+    def delete_if_equal(self, key, obj):
+        if self.get(key) != obj:
+            return False
+        del self[key]
+        return True
+
+
+def test_scale_actor_lock(recorder, monkeypatch):
+    locks = Locks()
+    monkeypatch.setattr(health, 'locks_store', locks)
+    monkeypatch.setattr(health.Worker, 'get_workers', lambda actor_id: {})
+    # another host holds the lock for this actor.
+    locks['autoscale_a'] = 'other'
+    health.scale_actor('a', actor(), 2, policy)
+    assert recorder.requested == []
+    # without it, the actor is scaled and the lock is released.
+    del locks['autoscale_a']
+    health.scale_actor('a', actor(), 2, policy)
+    assert len(recorder.requested) == 2
+    assert locks == {}
+
+
+def test_scale_actor_expired_lock(recorder, monkeypatch):
+    locks = Locks()
+    monkeypatch.setattr(health, 'locks_store', locks)
+
+    def get_workers(actor_id):
+        # the lock expires while the actor is being scaled and another host takes it.
+        locks['autoscale_a'] = 'other'
+        return {}
+
+    monkeypatch.setattr(health.Worker, 'get_workers', get_workers)
+    health.scale_actor('a', actor(), 2, policy)
+    assert locks == {'autoscale_a': 'other'}
+
+
+@pytest.fixture
+def removed(monkeypatch):
+    rec = []
+    monkeypatch.setattr(health, 'is_local', lambda worker: True)
+    monkeypatch.setattr(health, 'rm_container', lambda cid: None)
+    monkeypatch.setattr(health.Worker, 'delete_worker', lambda actor_id, worker_id: rec.append(worker_id))
+    return rec
+
+
+def test_check_workers_removes_dead_workers(removed):
+    ws = workers(worker('alive', cid='c1'), worker('dead', cid='c2'))
+    health.check_workers('a', -1, ws, {'alive': time.time(), 'dead': None})
+    assert removed == ['dead']
+
+
+def test_check_workers_skips_unchecked_and_new_workers(removed):
+    # the heartbeat of 'unread' was not read in this pass, and 'new' has not had time to send its first one.
+    ws = workers(worker('unread', cid='c1'), worker('new', age=1, cid='c2'))
+    health.check_workers('a', -1, ws, {'new': None})
+    assert removed == []
+
+
+def test_check_workers_skips_workers_without_heartbeats(removed):
+    # workers started before heartbeats were introduced have no create_time and never send a heartbeat.
+    w = worker('legacy', codes.BUSY, cid='c1')
+    del w['create_time']
+    health.check_workers('a', -1, workers(w), {'legacy': None})
+    assert removed == []
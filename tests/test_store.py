@@ -12,6 +12,7 @@
 
 
 from _datetime import datetime
+import json
 import pytest
 import os
 import sys
@@ -21,8 +22,10 @@ import timeit
 sys.path.append(os.path.split(os.getcwd())[0])
 sys.path.append('/actors')
 
+from cache import TTLCache
 from config import Config
-from store import RedisStore, MongoStore
+from store import RedisStore, RedisHashStore, MongoStore, StoreMutexException, WATCH_RETRIES, _do_decode, _do_encode, \
+    _do_get, loads_json, msgpack
 
 # this is the store to test
 store = os.environ.get('store', 'redis')
@@ -48,6 +51,10 @@ def st():
         ms._db.create_index('exp', expireAfterSeconds=1)
         return ms
 
+@pytest.fixture(scope='session')
+def hst():
+    return RedisHashStore(Config.get('store', 'redis_host'), Config.getint('store', 'redis_port'), db='12')
+
 def test_set_key(st):
     st['test'] = 'val'
     assert st.get('test') == 'val'
@@ -62,6 +69,32 @@ def test_set_with_expiry(st):
         with pytest.raises(KeyError):
             st['test_exp']
 
+def test_set_with_expiry_ex(st):
+    if not store == 'redis':
+        return
+    # heartbeats pass their own expiration, overriding the store's.
+    st.set_with_expiry('test_hb', 12.5, ex=3)
+    time.sleep(1)
+    assert st.mget(['test_hb', 'test_hb_missing']) == [12.5, None]
+    time.sleep(2.5)
+    assert st.mget(['test_hb']) == [None]
+
+def test_set_if_absent(st):
+    if not store == 'redis':
+        return
+    del st['test_lock']
+    assert st.set_if_absent('test_lock', 'host1', ex=1)
+    assert not st.set_if_absent('test_lock', 'host2', ex=1)
+    assert st['test_lock'] == 'host1'
+    time.sleep(1.5)
+    assert st.set_if_absent('test_lock', 'host2', ex=1)
+    # only the holder of the lock releases it.
+    assert not st.delete_if_equal('test_lock', 'host1')
+    assert st['test_lock'] == 'host2'
+    assert st.delete_if_equal('test_lock', 'host2')
+    with pytest.raises(KeyError):
+        st['test_lock']
+
 def _thread(st, n):
     for i in range(n):
         st.update('test', 'k2', 'w{}'.format(i))
@@ -117,6 +150,212 @@ def test_update_subfield(st):
     t.join()
     assert st['test'] == {'k': {'sub': 'v{}'.format(n-1)}, 'k2': 'w{}'.format(n-1)}
 
+def _fields_thread(st, n):
+    for i in range(n):
+        st.update_fields('test', {'k2': 'w{}'.format(i), 'k3.sub': 'w{}'.format(i)})
+
+def test_update_fields(st):
+    st['test'] = {'k': {'sub': 'v'},
+                  'k2': 'v2'}
+    t = threading.Thread(target=_fields_thread, args=(st, n))
+    t.start()
+    for i in range(n):
+        st.update_fields('test', {'k.sub': 'v{}'.format(i), 'k.sub2': 'v{}'.format(i)})
+    t.join()
+    assert st['test'] == {'k': {'sub': 'v{}'.format(n-1), 'sub2': 'v{}'.format(n-1)},
+                          'k2': 'w{}'.format(n-1),
+                          'k3': {'sub': 'w{}'.format(n-1)}}
+    with pytest.raises(KeyError):
+        st.update_fields('test_missing', {'k': 'v'})
+    # the result of updating a path and a path through it in one call would depend on the order they are applied.
+    with pytest.raises(ValueError):
+        st.update_fields('test', {'k': {'sub': 'v'}, 'k.sub2': 'v'})
+    assert st['test']['k'] == {'sub': 'v{}'.format(n-1), 'sub2': 'v{}'.format(n-1)}
+
+def test_mget(st):
+    st['test'] = {'k': 'v'}
+    st['test2'] = 'v2'
+    del st['test_missing']
+    assert st.mget(['test', 'test_missing', 'test2']) == [{'k': 'v'}, None, 'v2']
+    assert st.mget([]) == []
+
+def test_pubsub(st):
+    if not store == 'redis':
+        return
+    pubsub = st.subscribe('test_channel')
+    st.publish('test_channel', {'cache': 'actors', 'key': 'k'})
+    message = None
+    for i in range(10):
+        message = pubsub.get_message(timeout=1.0)
+        if message:
+            break
+    pubsub.close()
+    assert loads_json(message['data']) == {'cache': 'actors', 'key': 'k'}
+
+def test_ttl_cache():
+    loads = []
+    def _load(key):
+        loads.append(key)
+        if key == 'missing':
+            raise KeyError(key)
+        return key.upper()
+    cache = TTLCache(ttl=1, max_size=2)
+    assert cache.get('a', _load) == 'A'
+    assert cache.get('a', _load) == 'A'
+    assert loads == ['a']
+    # misses are not cached.
+    for i in range(2):
+        with pytest.raises(KeyError):
+            cache.get('missing', _load)
+    assert loads == ['a', 'missing', 'missing']
+    # 'b' is the least recently used entry when 'c' is added.
+    cache.get('b', _load)
+    cache.get('a', _load)
+    cache.get('c', _load)
+    assert len(cache) == 2
+    cache.get('a', _load)
+    assert loads[3:] == ['b', 'c']
+    cache.get('b', _load)
+    assert loads[5:] == ['b']
+    cache.invalidate('b')
+    cache.get('b', _load)
+    assert loads[6:] == ['b']
+    time.sleep(1.1)
+    cache.get('b', _load)
+    assert loads[7:] == ['b']
+    # a ttl of 0 disables the cache.
+    disabled = TTLCache(ttl=0, max_size=2)
+    disabled.get('a', _load)
+    disabled.get('a', _load)
+    assert loads[8:] == ['a', 'a']
+
+def test_ttl_cache_groups():
+    cache = TTLCache(ttl=60, max_size=10)
+    for key in [('a1', 'u1', 'READ'), ('a1', 'u2', 'READ'), ('a2', 'u1', 'READ')]:
+        cache.get(key, lambda k: True)
+    cache.get(('a1', 'u1', 'READ'), lambda k: False)
+    assert cache.stats() == {'size': 3, 'max_size': 10, 'ttl': 60, 'hits': 1, 'misses': 3}
+    cache.invalidate_group('a1')
+    assert len(cache) == 1
+    assert cache.get(('a1', 'u1', 'READ'), lambda k: False) is False
+    assert cache.get(('a2', 'u1', 'READ'), lambda k: False) is True
+
+def test_ttl_cache_ttl_of():
+    # values are cached until the time they hold, and None is never cached.
+    cache = TTLCache(ttl=60, max_size=10, ttl_of=lambda exp: 0 if exp is None else exp - time.time())
+    cache.get('short', lambda k: time.time() + 1)
+    cache.get('long', lambda k: time.time() + 120)
+    cache.get('invalid', lambda k: None)
+    assert len(cache) == 2
+    time.sleep(1.1)
+    assert cache.get('short', lambda k: None) is None
+    assert cache.get('long', lambda k: None) is not None
+
+def test_update_inexact(st):
+    # only the redis store uses Lua scripts
+    if not store == 'redis':
+        return
+    # cjson cannot represent these values exactly, so the updates fall back to optimistic transactions.
+    st['test'] = {'k': {'sub': []}, 'n': 1792294292.939437, 'k2': 'v2'}
+    st.update('test', 'k2', 'w')
+    st.update_subfield('test', 'k', 'sub2', [])
+    assert st.pop_field('test', 'k2') == 'w'
+    assert st['test'] == {'k': {'sub': [], 'sub2': []}, 'n': 1792294292.939437}
+    with pytest.raises(KeyError):
+        st.update('test_missing', 'k', 'v')
+
+def test_watch_retries(st):
+    # only the redis store uses optimistic transactions
+    if not store == 'redis':
+        return
+    st['test'] = {'k': 'v', 'n': 0}
+
+    def _conflict(pipe):
+        # another client writes the key after it is watched, so every attempt fails.
+        st.update('test', 'n', _do_get(pipe.get, 'test')['n'] + 1)
+        pipe.multi()
+        pipe.set('test', '{}')
+
+    with pytest.raises(StoreMutexException):
+        st._watch_transaction(_conflict, 'test')
+    assert st['test'] == {'k': 'v', 'n': WATCH_RETRIES}
+
+def _bench_thread(f, field, n):
+    for i in range(n):
+        f('test_bench', field, i)
+
+def _bench(st, f, threads):
+    """Return the number of operations per second made by `threads` threads updating fields of the same key with f."""
+    st['test_bench'] = {'k{}'.format(i): 0 for i in range(threads)}
+    ts = [threading.Thread(target=_bench_thread, args=(f, 'k{}'.format(i), n)) for i in range(threads)]
+    start = timeit.default_timer()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    tot = timeit.default_timer() - start
+    assert st['test_bench'] == {'k{}'.format(i): n-1 for i in range(threads)}
+    return threads * n / tot
+
+def test_update_contention(st):
+    # compares the Lua scripts with the optimistic transactions they replaced; run with -s to see the results.
+    if not store == 'redis':
+        return
+    threads = 4
+    lua = _bench(st, st.update, threads)
+    watch = _bench(st, st.watch_update, threads)
+    print("update ops/sec with {} threads. lua: {:.0f} watch: {:.0f}".format(threads, lua, watch))
+
+def test_msgpack(st):
+    # only the redis stores support msgpack
+    if not store == 'redis' or msgpack is None:
+        return
+    mst = RedisStore(Config.get('store', 'redis_host'), Config.getint('store', 'redis_port'), db='11',
+                     serializer='msgpack')
+    mst['test_mp'] = {'k': 'v', 'l': [], 'n': 1792294292.939437}
+    # values in either format can be read by any store.
+    assert st['test_mp'] == mst['test_mp'] == {'k': 'v', 'l': [], 'n': 1792294292.939437}
+    mst.update_fields('test_mp', {'k': 'v2', 'd.k': 'v'})
+    st.update('test_mp', 'k2', 'v')
+    assert mst.pop_field('test_mp', 'k') == 'v2'
+    assert mst.mget(['test_mp']) == [{'k2': 'v', 'l': [], 'n': 1792294292.939437, 'd': {'k': 'v'}}]
+
+# realistic payloads for the serializer benchmark.
+ACTOR = {'name': 'word_counter', 'image': 'abacosamples/wc', 'description': 'Counts the words in a message.',
+         'privileged': False, 'stateless': False, 'default_environment': {'key1': 'value1', 'key2': 'value2'},
+         'status': 'READY', 'status_message': '', 'executions': {}, 'state': {'count': 17, 'words': ['a', 'b']},
+         'tenant': 'dev_staging', 'api_server': 'https://dev.tenants.staging.agaveapi.co', 'owner': 'testuser',
+         'db_id': 'dev_staging_6e9fc5c8-caa4-11f1-a3f5-02fc00000001-059',
+         'id': '6e9fc5c8-caa4-11f1-a3f5-02fc00000001-059'}
+WORKER = {'tenant': 'dev_staging', 'id': '6a23de22-caa4-11f1-81c1-02fc00000001-060',
+          'ch_name': 'worker_6a23de22-caa4-11f1-81c1-02fc00000001-060', 'image': 'abacosamples/wc',
+          'location': 'unix://var/run/docker.sock', 'cid': 'f1c3a7e9b3f64d5a8e0b7c6d5e4f3a2b1c0d9e8f7a6b5c4d3e2f1a0b9c8d7e6f',
+          'status': 'READY', 'host_id': '0', 'host_ip': '172.17.0.1', 'last_execution': 1792294519.499,
+          'last_update': 1792294519.499}
+EXECUTION = {'tenant': 'dev_staging', 'actor_id': 'dev_staging_6e9fc5c8-caa4-11f1-a3f5-02fc00000001-059',
+             'id': '8f3b2c1a-caa4-11f1-9d7e-02fc00000001-053', 'status': 'COMPLETE', 'cpu': 118348276, 'io': 1284,
+             'runtime': 2, 'executor': 'testuser', 'worker_id': '6a23de22-caa4-11f1-81c1-02fc00000001-060',
+             'exit_code': 0,
+             'final_state': {'Status': 'exited', 'Running': False, 'Paused': False, 'Restarting': False,
+                             'OOMKilled': False, 'Dead': False, 'Pid': 0, 'ExitCode': 0, 'Error': '',
+                             'StartedAt': '2026-10-18T12:00:00.123456789Z',
+                             'FinishedAt': '2026-10-18T12:00:02.987654321Z'}}
+
+def test_serializer_benchmark():
+    # compares the serializers used by the redis stores with the stdlib json module; run with -s to see the results.
+    serializers = [('stdlib json', lambda v: json.dumps(v).encode('utf-8'), lambda o: json.loads(o.decode('utf-8'))),
+                   ('json', _do_encode, _do_decode)]
+    if msgpack is not None:
+        serializers.append(('msgpack', lambda v: _do_encode(v, 'msgpack'), _do_decode))
+    for payload_name, payload in [('actor', ACTOR), ('worker', {WORKER['id']: WORKER}), ('execution', EXECUTION)]:
+        for name, encode, decode in serializers:
+            obj = encode(payload)
+            assert decode(obj) == payload
+            encode_time = timeit.timeit(lambda: encode(payload), number=10 * n)
+            decode_time = timeit.timeit(lambda: decode(obj), number=10 * n)
+            print("{} with {}: {} bytes. encode: {:.1f} us. decode: {:.1f} us.".format(
+                payload_name, name, len(obj), 1e6 * encode_time / (10 * n), 1e6 * decode_time / (10 * n)))
+
 def test_getset(st):
     st['test'] = {'k': 'v',
                   'k2': 'v2'}
@@ -133,6 +372,146 @@ def test_getset(st):
     assert st['test'] == {'k': 'v', 'k2': 'w{}'.format(n-1)}
     assert st['k'] == 'v{}'.format(n-1)
 
+def test_set_with_fields(st):
+    # only the mongo store supports indexed fields
+    if not store == 'mongo':
+        return
+    st.delete_many(group='g')
+    st.set_with_fields('test_f1', {'k': 'v1'}, {'group': 'g', 'id': 'f1'})
+    st.set_with_fields('test_f2', {'k': 'v2'}, {'group': 'g', 'id': 'f2'})
+    st.set_with_fields('test_f3', {'k': 'v3'}, {'group': 'h', 'id': 'f3'})
+    assert st['test_f1'] == {'k': 'v1'}
+    st.update('test_f1', 'k', 'w1')
+    assert sorted(st.find(group='g')) == [('test_f1', {'k': 'w1'}), ('test_f2', {'k': 'v2'})]
+    st.delete_many(group='g')
+    assert list(st.find(group='g')) == []
+    assert st['test_f3'] == {'k': 'v3'}
+
+def test_insert_many_with_fields(st):
+    if not store == 'mongo':
+        return
+    st.delete_many(group='m')
+    st.insert_many_with_fields([('test_m{}'.format(i), {'k': i}, {'group': 'm', 'id': i}) for i in range(3)])
+    st.insert_many_with_fields([])
+    assert sorted(st.find(group='m')) == [('test_m0', {'k': 0}), ('test_m1', {'k': 1}), ('test_m2', {'k': 2})]
+    st.delete_many(group='m')
+
+def test_find_page(st):
+    # only the mongo store supports indexed fields
+    if not store == 'mongo':
+        return
+    st.delete_many(group='p')
+    for i in range(5):
+        st.set_with_fields('test_p{}'.format(i), {'k': i}, {'group': 'p', 'id': 'p{}'.format(i)})
+    page, cursor = st.find_page('id', limit=2, group='p')
+    assert [val['k'] for _, val in page] == [0, 1]
+    assert cursor == 'p1'
+    page, cursor = st.find_page('id', cursor=cursor, limit=2, group='p')
+    assert [val['k'] for _, val in page] == [2, 3]
+    assert cursor == 'p3'
+    page, cursor = st.find_page('id', cursor=cursor, group='p')
+    assert [val['k'] for _, val in page] == [4]
+    assert cursor is None
+    st.delete_many(group='p')
+
+def test_find_page_fields(st):
+    # only the mongo store supports indexed fields
+    if not store == 'mongo':
+        return
+    st.delete_many(group='q')
+    # ordered by time, then by id for equal times.
+    for i, (t, id) in enumerate([(2.5, 'a'), (1.5, 'c'), (1.5, 'b'), (3.5, 'a'), (2.5, 'b')]):
+        st.set_with_fields('test_q{}'.format(i), {'k': i}, {'group': 'q', 'time': t, 'id': id})
+    page, cursor = st.find_page(['time', 'id'], limit=2, group='q')
+    assert [val['k'] for _, val in page] == [2, 1]
+    assert cursor == [1.5, 'c']
+    page, cursor = st.find_page(['time', 'id'], cursor=cursor, limit=2, group='q')
+    assert [val['k'] for _, val in page] == [0, 4]
+    assert cursor == [2.5, 'b']
+    page, cursor = st.find_page(['time', 'id'], cursor=cursor, group='q')
+    assert [val['k'] for _, val in page] == [3]
+    assert cursor is None
+    st.delete_many(group='q')
+
+def _increment_thread(st, n):
+    for i in range(n):
+        st.increment('test_inc', {'a': 1, 'b': 2})
+
+def test_increment(st):
+    # only the mongo store supports increment
+    if not store == 'mongo':
+        return
+    del st['test_inc']
+    t = threading.Thread(target=_increment_thread, args=(st, n))
+    t.start()
+    _increment_thread(st, n)
+    t.join()
+    assert st['test_inc'] == {'a': 2*n, 'b': 4*n}
+
+def test_scored(st):
+    # only the redis store supports scored sets
+    if not store == 'redis':
+        return
+    del st['test_scored']
+    assert st.scored_first('test_scored') is None
+    st.scored_add('test_scored', {'b': 2.5, 'a': 3, 'c': 1.25})
+    assert st.scored_first('test_scored') == ('c', 1.25)
+    st.scored_remove('test_scored', 'c', 'b')
+    assert st.scored_first('test_scored') == ('a', 3)
+    st.scored_add('test_scored', {'b': 2.5, 'c': 1.25})
+    st.scored_trim(['test_scored', 'test_scored_missing'], 2.5)
+    assert st.scored_first('test_scored') == ('b', 2.5)
+    del st['test_scored']
+
+def _hash_thread(hst, n):
+    for i in range(n):
+        hst.update_subfield('test_hash', 'w2', 'status', 's{}'.format(i))
+
+def test_hash_update_subfield(hst):
+    # only the redis store supports hashes
+    if not store == 'redis':
+        return
+    hst['test_hash'] = {'w1': {'status': 's', 'id': 'w1'},
+                        'w2': {'status': 's', 'id': 'w2'}}
+    t = threading.Thread(target=_hash_thread, args=(hst, n))
+    t.start()
+    for i in range(n):
+        hst.update_subfield('test_hash', 'w1', 'status', 's{}'.format(i))
+    t.join()
+    assert hst['test_hash'] == {'w1': {'status': 's{}'.format(n-1), 'id': 'w1'},
+                                'w2': {'status': 's{}'.format(n-1), 'id': 'w2'}}
+    with pytest.raises(KeyError):
+        hst.update_subfield('test_hash', 'w3', 'status', 's')
+
+def test_hash_fields(hst):
+    # only the redis store supports hashes
+    if not store == 'redis':
+        return
+    del hst['test_hash']
+    with pytest.raises(KeyError):
+        hst['test_hash']
+    assert hst.add_if_empty('test_hash', 'w1', {'id': 'w1'}) == {'id': 'w1'}
+    assert hst.add_if_empty('test_hash', 'w2', {'id': 'w2'}) is None
+    hst.update('test_hash', 'w2', {'id': 'w2'})
+    assert hst['test_hash'] == {'w1': {'id': 'w1'}, 'w2': {'id': 'w2'}}
+    assert hst.pop_field('test_hash', 'w1') == {'id': 'w1'}
+    with pytest.raises(KeyError):
+        hst.pop_field('test_hash', 'w1')
+    hst['test_hash'] = {'w3': {'id': 'w3'}}
+    assert hst['test_hash'] == {'w3': {'id': 'w3'}}
+    hst.update_fields('test_hash', {'w3.status': 's', 'w3.times.last': 1.5, 'w5': {'id': 'w5'}})
+    assert hst['test_hash'] == {'w3': {'id': 'w3', 'status': 's', 'times': {'last': 1.5}}, 'w5': {'id': 'w5'}}
+    with pytest.raises(KeyError):
+        hst.update_fields('test_hash', {'w3.status': 't', 'w6.status': 's'})
+    assert hst['test_hash']['w3']['status'] == 's'
+    del hst['test_hash2']
+    assert hst.mget(['test_hash', 'test_hash2']) == [hst['test_hash'], None]
+    del hst['test_hash']
+    hst['test_hash'] = {'w3': {'id': 'w3'}}
+    hst.pop_field('test_hash', 'w3')
+    # the hash is removed with its last field, so it is empty again.
+    assert hst.add_if_empty('test_hash', 'w4', {'id': 'w4'}) == {'id': 'w4'}
+
 def test_within_transaction(st):
     # mongo store does not support within_transaction
     if not store == 'redis':